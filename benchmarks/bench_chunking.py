@@ -0,0 +1,84 @@
+"""
+チャンク分割(複数の画像をまとめて1回の変換処理にする)の効果を計測するベンチマーク
+
+小さい画像を大量に変換する場合の、1枚ずつ変換する従来の方式(--chunk-size 1)と
+チャンク分割した場合の処理速度を比較する
+
+    python benchmarks/bench_chunking.py --count 2000 --size 512 -j 8
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+from PIL import Image, PngImagePlugin
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import image_converter.image_converter as converter  # noqa: E402
+
+
+def make_small_images(folder, count, size):
+    """
+    プロンプト付きの小さいpng画像を作成する
+    """
+    image = Image.effect_noise((size, size), 40).convert("RGB")
+    metadata = PngImagePlugin.PngInfo()
+    metadata.add_text(
+        "parameters",
+        "1girl, solo\nNegative prompt: lowres\n"
+        f"Steps: 20, Sampler: Euler a, CFG scale: 7, Seed: 1, Size: {size}x{size}")
+    for i in range(count):
+        image.save(os.path.join(folder, f"{i:06d}.png"), pnginfo=metadata)
+
+
+def run(input_folder, output_folder, output_format, cpu_num, chunk_size):
+    start_time = time.perf_counter()
+    is_error, message = converter.convert_images_concurrently(
+        input_path=input_folder,
+        output_path=output_folder,
+        is_convert_subfolders=False,
+        output_format=output_format,
+        quality=80,
+        is_lossless=False,
+        is_fill_color=False,
+        fill_color="#ffffff",
+        cpu_num=cpu_num,
+        max_chunk_size=chunk_size)
+    if is_error:
+        raise RuntimeError(message)
+    return time.perf_counter() - start_time
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=2000)
+    parser.add_argument("--size", type=int, default=512)
+    parser.add_argument("--format", default="webp")
+    parser.add_argument("-j", "--cpu-num", type=int, default=os.cpu_count())
+    parser.add_argument("--chunk-sizes", default="1,4,16,64",
+                        help="比較するチャンクサイズの上限(カンマ区切り)")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        input_folder = os.path.join(tmpdir, "input")
+        os.makedirs(input_folder)
+        make_small_images(input_folder, args.count, args.size)
+
+        print(f"{args.count} images ({args.size}x{args.size}) -> {args.format}, "
+              f"cpu_num={args.cpu_num}")
+        print(f"{'chunk':>6} {'best sec':>10} {'files/s':>10}")
+        for chunk_size in [int(c) for c in args.chunk_sizes.split(",")]:
+            times = []
+            for i in range(args.repeat):
+                output_folder = os.path.join(tmpdir, f"output_{chunk_size}_{i}")
+                times.append(run(input_folder, output_folder,
+                                 args.format, args.cpu_num, chunk_size))
+            best = min(times)
+            print(f"{chunk_size:>6} {best:>10.3f} {args.count / best:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+変換処理の実行方法(プロセス / スレッド)ごとの処理速度を、画像サイズと出力形式ごとに比較するベンチマーク
+
+プールの起動時間を含めた1回の変換処理全体の時間を計測する
+(Windows / macOSではプロセスの起動時にモジュールの再読み込みが発生するため、差が大きくなる)
+
+    python benchmarks/bench_executor.py --sizes 256,1024,2048 --formats webp,avif,jpg,png -j 8
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+from PIL import Image, PngImagePlugin
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import image_converter.image_converter as converter  # noqa: E402
+from image_converter.worker_pool import (EXECUTOR_PROCESS,  # noqa: E402
+                                         EXECUTOR_THREAD)
+
+
+def make_images(folder, count, size):
+    """
+    プロンプト付きのpng画像を作成する
+    """
+    image = Image.effect_noise((size, size), 40).convert("RGB")
+    metadata = PngImagePlugin.PngInfo()
+    metadata.add_text(
+        "parameters",
+        "1girl, solo\nNegative prompt: lowres\n"
+        f"Steps: 20, Sampler: Euler a, CFG scale: 7, Seed: 1, Size: {size}x{size}")
+    for i in range(count):
+        image.save(os.path.join(folder, f"{i:06d}.png"), pnginfo=metadata)
+
+
+def run(input_folder, output_folder, output_format, cpu_num, executor_type):
+    is_lossless = output_format == "png"
+    start_time = time.perf_counter()
+    is_error, message = converter.convert_images_concurrently(
+        input_path=input_folder,
+        output_path=output_folder,
+        is_convert_subfolders=False,
+        output_format=output_format,
+        quality=100 if is_lossless else 80,
+        is_lossless=is_lossless,
+        is_fill_color=False,
+        fill_color="#ffffff",
+        cpu_num=cpu_num,
+        executor_type=executor_type)
+    if is_error:
+        raise RuntimeError(message)
+    return time.perf_counter() - start_time
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="256,1024,2048")
+    parser.add_argument("--formats", default="webp,avif,jpg,png")
+    parser.add_argument("--pixels", type=int, default=64 * 1024 * 1024,
+                        help="サイズごとの合計ピクセル数(画像の枚数はこの値から決める)")
+    parser.add_argument("-j", "--cpu-num", type=int, default=os.cpu_count())
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    executor_types = (EXECUTOR_PROCESS, EXECUTOR_THREAD)
+
+    print(f"cpu_num={args.cpu_num}, start method: {multiprocessing.get_start_method()}")
+    print(f"{'size':>6} {'count':>6} {'format':>6} "
+          + " ".join(f"{executor_type + ' f/s':>14}" for executor_type in executor_types)
+          + f" {'winner':>8}")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for size in [int(size) for size in args.sizes.split(",")]:
+            count = max(args.cpu_num, args.pixels // (size * size))
+            input_folder = os.path.join(tmpdir, f"input_{size}")
+            os.makedirs(input_folder)
+            make_images(input_folder, count, size)
+
+            for output_format in args.formats.split(","):
+                rates = []
+                for executor_type in executor_types:
+                    times = []
+                    for i in range(args.repeat):
+                        output_folder = os.path.join(
+                            tmpdir, f"output_{size}_{output_format}_{executor_type}_{i}")
+                        times.append(run(input_folder, output_folder,
+                                         output_format, args.cpu_num, executor_type))
+                    rates.append(count / min(times))
+                winner = executor_types[rates.index(max(rates))]
+                print(f"{size:>6} {count:>6} {output_format:>6} "
+                      + " ".join(f"{rate:>14.1f}" for rate in rates)
+                      + f" {winner:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+"""
+コーパス(benchmarks/corpus.py)を全ての出力形式・品質・可逆圧縮の有無・同時プロセス実行数の組み合わせで変換し、
+処理速度(files/sec)・メモリ使用量の最大値(MB)・出力サイズ(MB)を計測するベンチマーク
+
+--save-baseline で計測結果を保存しておき、変更後に --baseline で比較する
+処理速度の低下、メモリ使用量・出力サイズの増加が許容範囲(--tolerance)を超えた場合は終了コード1を返す
+(計測結果は実行環境に依存するため、ベースラインは同じマシンで保存したものと比較する)
+
+    python benchmarks/bench_suite.py --corpus corpus --save-baseline baseline.json
+    python benchmarks/bench_suite.py --corpus corpus --baseline baseline.json
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import PIL
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import image_converter.exts as exts  # noqa: E402
+import image_converter.image_converter as converter  # noqa: E402
+from corpus import make_corpus  # noqa: E402
+from image_converter.progress import FINISHED, ProgressStream  # noqa: E402
+from image_converter.resource_monitor import ResourceMonitor  # noqa: E402
+
+# 比較する指標と、値が大きいほど良いかどうか
+METRICS = {
+    "files_per_sec": True,
+    "peak_rss_mb": False,
+    "output_mb": False,
+    "files_failed": False,
+}
+
+
+def iter_settings(formats, qualities, is_include_lossless):
+    """
+    (出力形式, 品質, 可逆圧縮)の組み合わせを返す(GUIと同じく、pngは常に可逆圧縮、jpgは常に非可逆圧縮)
+    """
+    for output_format in formats:
+        if output_format == exts.PNG_EXT:
+            yield output_format, 100, True
+            continue
+        for quality in qualities:
+            yield output_format, quality, False
+        if output_format == exts.WEBP_EXT and is_include_lossless:
+            yield output_format, 100, True
+
+
+def setting_key(output_format, quality, is_lossless, cpu_num):
+    mode = "lossless" if is_lossless else f"q{quality}"
+    return f"{output_format}/{mode}/j{cpu_num}"
+
+
+def run(input_folder, output_folder, output_format, quality, is_lossless, cpu_num):
+    """
+    1回変換し、(処理速度, メモリ使用量の最大値, 出力サイズ, 変換に失敗した枚数)を返す
+    """
+    progress = ProgressStream()
+    summary = {}
+
+    def on_finished(event, snapshot):
+        if event == FINISHED:
+            summary.update(snapshot)
+
+    progress.subscribe(on_finished, interval=None)
+    resource_monitor = ResourceMonitor(interval=0.1)
+    start_time = time.perf_counter()
+    is_error, message = converter.convert_images_concurrently(
+        input_path=input_folder,
+        output_path=output_folder,
+        is_convert_subfolders=False,
+        output_format=output_format,
+        quality=quality,
+        is_lossless=is_lossless,
+        # jpgは透過できないため塗りつぶす
+        is_fill_color=output_format == exts.JPG_EXT,
+        fill_color="#ffffff",
+        cpu_num=cpu_num,
+        progress=progress,
+        resource_monitor=resource_monitor)
+    elapsed = time.perf_counter() - start_time
+    if is_error:
+        raise RuntimeError(message)
+    peak = resource_monitor.summary()["total_rss_mb"]
+    return (summary["done"] / elapsed,
+            peak["peak"] if peak else 0.0,
+            summary["bytes_out"] / 1024 / 1024,
+            summary["failed"])
+
+
+def compare(results, baseline, tolerance):
+    """
+    ベースラインと比較し、許容範囲を超えて悪化した指標を表示する。悪化した指標の数を返す
+    """
+    regressions = 0
+    print(f"\n{'setting':<24} {'metric':<14} {'baseline':>10} {'current':>10} {'change':>8}")
+    for key, metrics in results.items():
+        if key not in baseline:
+            print(f"{key:<24} (ベースラインなし)")
+            continue
+        for metric, is_higher_better in METRICS.items():
+            base = baseline[key][metric]
+            current = metrics[metric]
+            if base:
+                change = (current - base) / base
+            else:
+                # 変換に失敗した枚数など、ベースラインが0の場合は増減のみ判定する
+                change = 0.0 if current == base else math.copysign(math.inf, current - base)
+            is_regression = -change > tolerance if is_higher_better else change > tolerance
+            mark = "  NG" if is_regression else ""
+            regressions += is_regression
+            print(f"{key:<24} {metric:<14} {base:>10.2f} {current:>10.2f} {change:>+8.1%}{mark}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--corpus", default=None,
+                        help="コーパスのフォルダ(存在しない場合は作成する、省略時は一時フォルダに作成する)")
+    parser.add_argument("--sizes", default="512,1024,2048")
+    parser.add_argument("--count", type=int, default=2,
+                        help="コーパスの種類・透過の有無・解像度の組み合わせごとの枚数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--formats", default="webp,avif,jpg,png")
+    parser.add_argument("--qualities", default="80,95")
+    parser.add_argument("--no-lossless", action="store_true",
+                        help="webpの可逆圧縮を計測しない")
+    parser.add_argument("--cpu-nums", default=f"1,{os.cpu_count()}")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--baseline", default=None, help="比較するベースラインのJSON")
+    parser.add_argument("--save-baseline", default=None, help="計測結果をベースラインとして保存する")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="ベースラインとの比較で許容する変化の割合")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    formats = args.formats.split(",")
+    qualities = [int(quality) for quality in args.qualities.split(",")]
+    cpu_nums = [int(cpu_num) for cpu_num in args.cpu_nums.split(",")]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        corpus_folder = args.corpus or os.path.join(tmpdir, "corpus")
+        corpus = make_corpus(corpus_folder, sizes, args.count, args.seed)
+
+        results = {}
+        print(f"{'setting':<24} {'files/s':>10} {'peak MB':>10} {'output MB':>10} {'failed':>8}")
+        for output_format, quality, is_lossless in iter_settings(
+                formats, qualities, not args.no_lossless):
+            for cpu_num in cpu_nums:
+                key = setting_key(output_format, quality, is_lossless, cpu_num)
+                measurements = []
+                for i in range(args.repeat):
+                    output_folder = os.path.join(tmpdir, f"output_{len(results)}_{i}")
+                    measurements.append(run(corpus_folder, output_folder, output_format,
+                                            quality, is_lossless, cpu_num))
+                # 処理速度は最速の値、メモリ使用量は最大の値を用いる
+                results[key] = {
+                    "files_per_sec": round(max(m[0] for m in measurements), 3),
+                    "peak_rss_mb": round(max(m[1] for m in measurements), 3),
+                    "output_mb": round(measurements[0][2], 3),
+                    "files_failed": measurements[0][3],
+                }
+                print(f"{key:<24} {results[key]['files_per_sec']:>10.2f} "
+                      f"{results[key]['peak_rss_mb']:>10.1f} {results[key]['output_mb']:>10.2f} "
+                      f"{results[key]['files_failed']:>8}")
+
+    report = {
+        "corpus": corpus,
+        "environment": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "pillow": PIL.__version__,
+            "cpu_count": os.cpu_count(),
+        },
+        "results": results,
+    }
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline["corpus"] != corpus:
+            print("ベースラインとコーパスの作成条件が異なるため、比較できません")
+            return 1
+        if compare(results, baseline["results"], args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,92 @@
+"""
+変換処理を実行するプロセスの起動時に読み込まれるモジュールと、その読み込み時間を計測するベンチマーク
+
+python -X importtime で以下の2つを計測し、GUI(flet)などの不要なモジュールが読み込まれていないか、
+読み込み時間が上限を超えていないかを確認する(問題があれば終了コード1を返す)
+- worker: 変換処理のモジュール(image_converter.worker)
+- spawn main: spawnで起動したプロセスがmain.pyを読み込み直す場合(__mp_main__として実行)
+
+    python benchmarks/bench_worker_import.py --max-ms 300
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 変換処理のプロセスで読み込まれてはいけないモジュール
+FORBIDDEN_MODULES = (
+    "flet",
+    "flet_contrib",
+    "psutil",
+    "image_converter.config_loader",
+    "image_converter.theme_loader",
+    "image_converter.cli",
+)
+# 画像形式に応じて必要になった場合のみ読み込まれるモジュール
+LAZY_MODULES = ("piexif", "pillow_avif")
+
+TARGETS = {
+    "worker": "import image_converter.worker",
+    "spawn main": "import runpy; runpy.run_path('main.py', run_name='__mp_main__')",
+}
+
+
+def measure_import(code):
+    """
+    python -X importtime を実行し、{モジュール名: 読み込み時間(us)} と合計時間(us)を返す
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=ROOT_DIR, capture_output=True, text=True, check=True)
+    modules = {}
+    total_us = 0
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, _, name = line[len("import time:"):].split("|")
+        modules[name.strip()] = int(self_us)
+        total_us += int(self_us)
+    return modules, total_us
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--max-ms", type=float, default=300.0,
+                        help="読み込み時間の上限(ms)")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    is_ok = True
+    for target, code in TARGETS.items():
+        totals = []
+        for _ in range(args.repeat):
+            modules, total_us = measure_import(code)
+            totals.append(total_us)
+        best_ms = min(totals) / 1000
+
+        forbidden = [name for name in modules
+                     if name.split(".")[0] in FORBIDDEN_MODULES or name in FORBIDDEN_MODULES]
+        lazy = [name for name in modules if name.split(".")[0] in LAZY_MODULES]
+        slowest = sorted(modules.items(), key=lambda item: item[1], reverse=True)[:5]
+
+        print(f"[{target}] {best_ms:.1f} ms, {len(modules)} modules")
+        for name, self_us in slowest:
+            print(f"    {self_us / 1000:>8.1f} ms  {name}")
+        if forbidden:
+            is_ok = False
+            print(f"    NG: 不要なモジュールが読み込まれています: {', '.join(forbidden)}")
+        if lazy:
+            is_ok = False
+            print(f"    NG: 遅延読み込みするモジュールが読み込まれています: {', '.join(lazy)}")
+        if best_ms > args.max_ms:
+            is_ok = False
+            print(f"    NG: 読み込み時間が上限 ({args.max_ms} ms) を超えています")
+
+    return 0 if is_ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,216 @@
+"""
+ベンチマーク用のプロンプト付き画像(コーパス)を作成する
+
+同じ引数(シード)からは常に同じ画像が作成されるため、変更の前後で同じ画像を使って比較できる
+- a1111: parametersにプロンプトを保存したpng (AUTOMATIC1111 WebUI)
+- novelai: Description・Commentにプロンプトを保存したpng (NovelAI)
+- comfyui: prompt・workflowにノードの情報を保存したpng (ComfyUI、ノード数の多い大きなワークフロー)
+それぞれ不透明(RGB)と透過(RGBA)の画像を、指定した解像度ごとに作成する
+
+    python benchmarks/corpus.py corpus --sizes 512,1024,2048 --count 2
+"""
+import argparse
+import json
+import os
+import random
+
+from PIL import Image, ImageDraw, PngImagePlugin
+
+CORPUS_VERSION = 1
+KINDS = ("a1111", "novelai", "comfyui")
+ALPHA_VARIANTS = ("opaque", "alpha")
+# コーパスの作成条件を保存するファイル
+MANIFEST_NAME = "corpus.json"
+
+TAGS = ("1girl", "solo", "long hair", "smile", "looking at viewer", "outdoors", "sky",
+        "cloud", "blue eyes", "school uniform", "cherry blossoms", "upper body",
+        "masterpiece", "best quality", "detailed background", "sunlight")
+NEGATIVE_TAGS = ("lowres", "bad anatomy", "bad hands", "text", "error", "missing fingers",
+                 "cropped", "worst quality", "low quality", "jpeg artifacts", "signature")
+SAMPLERS = ("Euler a", "DPM++ 2M Karras", "DDIM")
+
+
+def make_prompt(rng, tags, count):
+    return ", ".join(rng.sample(tags, min(count, len(tags))))
+
+
+def make_pixels(rng, size, is_alpha):
+    """
+    写真に近い(圧縮しやすさが現実的な)画像を作成する
+    低解像度のノイズを拡大してグラデーションと図形を重ね、細かいノイズを加える
+    """
+    width, height = size
+    low = Image.frombytes("RGB", (16, 16), rng.randbytes(16 * 16 * 3))
+    image = low.resize(size, Image.BICUBIC)
+    draw = ImageDraw.Draw(image)
+    for _ in range(12):
+        x0, y0 = rng.randrange(width), rng.randrange(height)
+        x1, y1 = x0 + rng.randrange(width // 2 + 1), y0 + rng.randrange(height // 2 + 1)
+        color = tuple(rng.randrange(256) for _ in range(3))
+        draw.ellipse((x0, y0, x1, y1), fill=color)
+    noise = Image.frombytes("L", size, rng.randbytes(width * height))
+    image = Image.blend(image, Image.merge("RGB", (noise, noise, noise)), 0.08)
+    if not is_alpha:
+        return image
+    # 中央を不透明、周囲を透明にしたアルファチャンネルを追加する
+    alpha = Image.new("L", size, 0)
+    ImageDraw.Draw(alpha).ellipse(
+        (width // 8, height // 8, width * 7 // 8, height * 7 // 8), fill=255)
+    image.putalpha(alpha)
+    return image
+
+
+def make_a1111_metadata(rng, size):
+    width, height = size
+    metadata = PngImagePlugin.PngInfo()
+    metadata.add_text(
+        "parameters",
+        f"{make_prompt(rng, TAGS, 10)}\n"
+        f"Negative prompt: {make_prompt(rng, NEGATIVE_TAGS, 6)}\n"
+        f"Steps: {rng.randrange(20, 50)}, Sampler: {rng.choice(SAMPLERS)}, "
+        f"CFG scale: {rng.randrange(5, 12)}, Seed: {rng.randrange(2 ** 32)}, "
+        f"Size: {width}x{height}, Model hash: {rng.randbytes(5).hex()}, Model: model")
+    return metadata
+
+
+def make_novelai_metadata(rng, size):
+    width, height = size
+    prompt = make_prompt(rng, TAGS, 10)
+    comment = {
+        "prompt": prompt,
+        "steps": 28,
+        "height": height,
+        "width": width,
+        "scale": 5.0,
+        "uncond_scale": 1.0,
+        "cfg_rescale": 0.0,
+        "seed": rng.randrange(2 ** 32),
+        "n_samples": 1,
+        "noise_schedule": "native",
+        "sampler": "k_euler_ancestral",
+        "sm": False,
+        "sm_dyn": False,
+        "uc": make_prompt(rng, NEGATIVE_TAGS, 6),
+    }
+    metadata = PngImagePlugin.PngInfo()
+    metadata.add_text("Title", "AI generated image")
+    metadata.add_text("Description", prompt)
+    metadata.add_text("Software", "NovelAI")
+    metadata.add_text("Source", "Stable Diffusion XL C1E1DE52")
+    metadata.add_text("Generation time", f"{rng.uniform(1, 10):.3f}")
+    metadata.add_text("Comment", json.dumps(comment))
+    return metadata
+
+
+def make_comfyui_metadata(rng, size, node_count=200):
+    """
+    ノード数の多いComfyUIのワークフローを作成する(数十〜数百KBのテキストになる)
+    """
+    width, height = size
+    prompt = {}
+    nodes = []
+    for node_id in range(1, node_count + 1):
+        inputs = {
+            "seed": rng.randrange(2 ** 32),
+            "steps": rng.randrange(20, 50),
+            "cfg": rng.randrange(5, 12),
+            "sampler_name": "euler_ancestral",
+            "scheduler": "normal",
+            "denoise": 1,
+            "text": make_prompt(rng, TAGS, 8),
+            "width": width,
+            "height": height,
+        }
+        if node_id > 1:
+            inputs["model"] = [str(node_id - 1), 0]
+        prompt[str(node_id)] = {"inputs": inputs, "class_type": "KSampler"}
+        nodes.append({
+            "id": node_id,
+            "type": "KSampler",
+            "pos": [rng.randrange(4000), rng.randrange(4000)],
+            "size": {"0": 315, "1": 262},
+            "flags": {},
+            "order": node_id,
+            "mode": 0,
+            "inputs": [{"name": "model", "type": "MODEL", "link": node_id - 1}],
+            "outputs": [{"name": "LATENT", "type": "LATENT", "links": [node_id], "slot_index": 0}],
+            "properties": {"Node name for S&R": "KSampler"},
+            "widgets_values": [inputs["seed"], "randomize", inputs["steps"], inputs["cfg"],
+                               "euler_ancestral", "normal", 1],
+        })
+    workflow = {
+        "last_node_id": node_count,
+        "last_link_id": node_count,
+        "nodes": nodes,
+        "links": [[i, i, 0, i + 1, 0, "MODEL"] for i in range(1, node_count)],
+        "groups": [],
+        "config": {},
+        "extra": {},
+        "version": 0.4,
+    }
+    metadata = PngImagePlugin.PngInfo()
+    metadata.add_text("prompt", json.dumps(prompt))
+    metadata.add_text("workflow", json.dumps(workflow))
+    return metadata
+
+
+METADATA_MAKERS = {
+    "a1111": make_a1111_metadata,
+    "novelai": make_novelai_metadata,
+    "comfyui": make_comfyui_metadata,
+}
+
+
+def make_corpus(folder, sizes, count, seed=0):
+    """
+    folderにコーパスを作成し、作成条件(マニフェスト)を返す
+    作成済みで条件が同じ場合は作り直さない
+    """
+    manifest = {
+        "version": CORPUS_VERSION,
+        "sizes": list(sizes),
+        "count": count,
+        "seed": seed,
+        "kinds": list(KINDS),
+        "variants": list(ALPHA_VARIANTS),
+    }
+    manifest_path = os.path.join(folder, MANIFEST_NAME)
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            if json.load(f) == manifest:
+                return manifest
+
+    os.makedirs(folder, exist_ok=True)
+    for kind in KINDS:
+        for variant in ALPHA_VARIANTS:
+            for size in sizes:
+                for i in range(count):
+                    # ファイルごとにシードを決め、作成する順番や条件の組み合わせに依存しないようにする
+                    rng = random.Random(f"{seed}-{kind}-{variant}-{size}-{i}")
+                    image = make_pixels(rng, (size, size), variant == "alpha")
+                    metadata = METADATA_MAKERS[kind](rng, (size, size))
+                    image.save(os.path.join(folder, f"{kind}_{variant}_{size}_{i:03d}.png"),
+                               pnginfo=metadata)
+
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("folder", help="コーパスを作成するフォルダ")
+    parser.add_argument("--sizes", default="512,1024,2048")
+    parser.add_argument("--count", type=int, default=2,
+                        help="種類・透過の有無・解像度の組み合わせごとの枚数")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    make_corpus(args.folder, sizes, args.count, args.seed)
+    total = len(KINDS) * len(ALPHA_VARIANTS) * len(sizes) * args.count
+    print(f"{total} 枚の画像を {args.folder} に作成しました")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,7 @@
+import sys
+
+if __name__ == "__main__":
+    # 変換処理のプロセスがこのモジュールを読み込み直す場合に、
+    # コマンドライン用のモジュールを読み込まないようにする
+    from image_converter.cli import main
+    sys.exit(main())
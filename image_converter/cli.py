@@ -0,0 +1,433 @@
+import argparse
+import contextlib
+import json
+import os
+import sqlite3
+import sys
+import time
+
+import psutil
+
+import image_converter.exts as exts
+import image_converter.image_converter as converter
+from image_converter.conversion_cache import DEFAULT_MAX_MB, ConversionCache
+from image_converter.duplicates import DUPLICATES_OFF, DUPLICATES_POLICIES
+from image_converter.metadata_reader import iter_metadata
+from image_converter.passthrough import PASSTHROUGH_OFF, PASSTHROUGH_POLICIES
+from image_converter.progress import FINISHED, STARTED, ProgressStream
+from image_converter.prompt_index import PromptIndex
+from image_converter.resource_monitor import ResourceMonitor
+from image_converter.timing_report import TimingReport
+from image_converter.worker_pool import EXECUTOR_PROCESS, EXECUTOR_TYPES
+
+# GUIを使わずにコマンドラインから変換処理を実行する
+# flet や config.json の読み書きは行わない
+
+
+def build_parser():
+    """
+    コマンドライン引数のパーサーを作成する
+    """
+    parser = argparse.ArgumentParser(
+        prog="python -m image_converter",
+        description="プロンプト付き画像をプロンプトを残したまま変換する")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    convert_parser = subparsers.add_parser(
+        "convert", help="画像を一括で変換する")
+    convert_parser.add_argument(
+        "-i", "--input", required=True,
+        help="入力フォルダパス、またはファイルパス")
+    convert_parser.add_argument(
+        "-o", "--output", required=True,
+        help="出力フォルダパス")
+    convert_parser.add_argument(
+        "-s", "--subfolders", action="store_true",
+        help="サブフォルダ内の画像も変換する")
+    convert_parser.add_argument(
+        "-f", "--format", default=exts.WEBP_EXT,
+        choices=(exts.PNG_EXT, exts.JPG_EXT, exts.WEBP_EXT, exts.AVIF_EXT),
+        help="変換後の拡張子")
+    convert_parser.add_argument(
+        "-q", "--quality", type=int, default=100,
+        help="品質 (0-100)。可逆圧縮モードでは無視される")
+    convert_parser.add_argument(
+        "--lossless", action="store_true",
+        help="可逆圧縮モード (webpのみ選択可能)")
+    convert_parser.add_argument(
+        "--fill-color", default=None, metavar="COLOR",
+        help="透過部分を指定した色で塗りつぶす (例: #ffffff、jpg は指定しなくても白で塗りつぶす)")
+    convert_parser.add_argument(
+        "-j", "--cpu-num", type=int,
+        default=psutil.cpu_count(logical=False),
+        help="同時プロセス実行数")
+    convert_parser.add_argument(
+        "--sync", action="store_true",
+        help="同期モード: 出力フォルダへ直接出力し、前回から変更のあった画像のみ変換する")
+    convert_parser.add_argument(
+        "--delete-orphans", action="store_true",
+        help="同期モードで、入力ファイルが削除された画像を出力フォルダから削除する")
+    convert_parser.add_argument(
+        "--max-pending", type=int, default=None,
+        help="同時に投入しておく変換処理の最大数 (デフォルト: 同時プロセス実行数の4倍)")
+    convert_parser.add_argument(
+        "--chunk-size", type=int, default=None,
+        help="1回の変換処理でまとめて変換する画像の最大数 (デフォルト: 16、1で1枚ずつ変換)")
+    convert_parser.add_argument(
+        "--largest-first", action="store_true",
+        help="画像のヘッダーから変換コストを見積もり、大きい画像から順に変換する")
+    convert_parser.add_argument(
+        "--memory-budget-mb", type=int, default=None,
+        help="変換中の画像の推定メモリ使用量の合計の上限 (MB)")
+    convert_parser.add_argument(
+        "--max-tasks-per-worker", type=int, default=None,
+        help="1プロセスあたりこの枚数を変換したらプロセスを入れ替える")
+    convert_parser.add_argument(
+        "--max-worker-rss-mb", type=int, default=None,
+        help="プロセスのメモリ使用量がこの値 (MB) を超えたらプロセスを入れ替える")
+    convert_parser.add_argument(
+        "--executor", default=EXECUTOR_PROCESS,
+        choices=EXECUTOR_TYPES,
+        help="変換処理の実行方法 (auto は画像の枚数が少ない場合のみスレッドを使用する)")
+    convert_parser.add_argument(
+        "--progress-interval", type=float, default=None, metavar="SEC",
+        help="指定した間隔 (秒) ごとに進捗を標準エラー出力に表示する")
+    convert_parser.add_argument(
+        "--timing-report", default=None, metavar="PATH",
+        help="変換処理の段階ごとの処理時間を計測し、集計結果を出力する (拡張子が .csv の場合はCSV、それ以外はJSON)")
+    convert_parser.add_argument(
+        "--timing-top", type=int, default=10, metavar="N",
+        help="集計結果に含める処理時間の長い画像の枚数")
+    convert_parser.add_argument(
+        "--resource-log", default=None, metavar="PATH",
+        help="変換中のプロセスごとのメモリ・CPU使用率・読み書きの量とシステム全体のI/O待ちの割合を計測し、CSVで出力する")
+    convert_parser.add_argument(
+        "--resource-interval", type=float, default=0.5, metavar="SEC",
+        help="リソース使用量を計測する間隔 (秒)")
+    convert_parser.add_argument(
+        "--passthrough", default=PASSTHROUGH_OFF, choices=PASSTHROUGH_POLICIES,
+        help="既に出力形式・設定を満たしている画像を再エンコードせずに出力する "
+             "(copy: reflink・copy_file_range でコピー、link: ハードリンクを作成)")
+    convert_parser.add_argument(
+        "--cache-dir", default=None, metavar="PATH",
+        help="変換結果をキャッシュするフォルダ (同じ画像を同じ設定で変換する場合はキャッシュからコピーする)")
+    convert_parser.add_argument(
+        "--cache-max-mb", type=int, default=DEFAULT_MAX_MB,
+        help="キャッシュの合計サイズの上限 (MB)。超えた場合は最後に使われた日時が古いものから削除する")
+    convert_parser.add_argument(
+        "--cache-link", action="store_true",
+        help="キャッシュからコピーする代わりにハードリンクを作成する (出力ファイルを他のアプリで直接編集するとキャッシュのファイルも変わるため注意。サイズが変わったファイルはキャッシュから削除される。入力ファイルと更新日時が異なるキャッシュはハードリンクせずにコピーする)")
+    convert_parser.add_argument(
+        "--duplicates", default=DUPLICATES_OFF, choices=DUPLICATES_POLICIES,
+        help="変換前に重複した画像を探し、1枚のみ変換する "
+             "(link: 他の画像は変換結果のハードリンクを出力、skip: 他の画像は出力しない)")
+    convert_parser.add_argument(
+        "--perceptual", action="store_true",
+        help="--duplicates で、縮小してデコードした画像が同じ画像も重複とする (メタデータは比較しないため、重複とした画像の出力は残す画像の変換結果になり、その画像自体のプロンプトなどのメタデータは出力されない)")
+    convert_parser.add_argument(
+        "--duplicates-report", default=None, metavar="PATH",
+        help="見つかった重複した画像を JSON で出力する")
+    convert_parser.add_argument(
+        "--reduce-mode", action="store_true",
+        help="png と可逆圧縮の webp で、画質を変えずにより小さいピクセルの形式 "
+             "(不透明な RGBA → RGB、グレースケール → L、256 色以下 → P (png のみ)) に変換してから保存する")
+    convert_parser.add_argument(
+        "--max-width", type=int, default=None,
+        help="幅がこの値 (px) を超える画像を、縦横比を保って縮小する")
+    convert_parser.add_argument(
+        "--max-height", type=int, default=None,
+        help="高さがこの値 (px) を超える画像を、縦横比を保って縮小する")
+    convert_parser.add_argument(
+        "--scale", type=float, default=None,
+        help="画像を指定した倍率 (0-1) に縮小する (--max-width・--max-height と併用した場合は小さい方)")
+    convert_parser.set_defaults(func=run_convert)
+
+    extract_parser = subparsers.add_parser(
+        "extract-metadata", help="画像をデコードせずにプロンプト(メタデータ)を読み込み、JSON Linesで出力する")
+    extract_parser.add_argument(
+        "-i", "--input", required=True,
+        help="入力フォルダパス、またはファイルパス")
+    extract_parser.add_argument(
+        "-o", "--output", default=None,
+        help="出力ファイルパス (省略時は標準出力)")
+    extract_parser.add_argument(
+        "-s", "--subfolders", action="store_true",
+        help="サブフォルダ内の画像も対象にする")
+    extract_parser.add_argument(
+        "-j", "--workers", type=int, default=8,
+        help="並行して読み込むスレッド数")
+    extract_parser.set_defaults(func=run_extract_metadata)
+
+    index_parser = subparsers.add_parser(
+        "index", help="画像のプロンプトをSQLiteのデータベースに登録する(前回から変更のあった画像のみ読み込む)")
+    index_parser.add_argument(
+        "-i", "--input", required=True,
+        help="入力フォルダパス、またはファイルパス")
+    index_parser.add_argument(
+        "-d", "--database", required=True,
+        help="データベースのファイルパス")
+    index_parser.add_argument(
+        "-s", "--subfolders", action="store_true",
+        help="サブフォルダ内の画像も対象にする")
+    index_parser.add_argument(
+        "-j", "--workers", type=int, default=8,
+        help="並行して読み込むスレッド数")
+    index_parser.set_defaults(func=run_index)
+
+    search_parser = subparsers.add_parser(
+        "search", help="データベースに登録したプロンプトを全文検索し、JSON Linesで出力する")
+    search_parser.add_argument(
+        "query",
+        help="検索式 (SQLite FTS5の形式、例: \"1girl AND smile\"、\"negative_prompt: lowres\")")
+    search_parser.add_argument(
+        "-d", "--database", required=True,
+        help="データベースのファイルパス")
+    search_parser.add_argument(
+        "-n", "--limit", type=int, default=20,
+        help="出力する件数")
+    search_parser.set_defaults(func=run_search)
+
+    cache_parser = subparsers.add_parser(
+        "cache", help="変換結果のキャッシュを操作する")
+    cache_subparsers = cache_parser.add_subparsers(dest="cache_command", required=True)
+    cache_stats_parser = cache_subparsers.add_parser(
+        "stats", help="キャッシュの件数・合計サイズ・キャッシュから取り出した回数をJSONで出力する")
+    cache_stats_parser.add_argument(
+        "-c", "--cache-dir", required=True,
+        help="キャッシュのフォルダ")
+    cache_stats_parser.set_defaults(func=run_cache_stats)
+
+    return parser
+
+
+def get_resize(args):
+    """
+    縮小の設定を返す(指定されていない場合はNone)
+    """
+    resize = {key: value for key, value in (("max_width", args.max_width),
+                                            ("max_height", args.max_height),
+                                            ("scale", args.scale)) if value}
+    return resize or None
+
+
+def print_progress(event, snapshot):
+    """
+    進捗を標準エラー出力に1行ずつ出力する
+    """
+    if event == STARTED:
+        return
+    eta = snapshot["eta_sec"]
+    eta_text = f"{eta:.0f}s" if eta is not None else "-"
+    total = snapshot["total"] if snapshot["is_scan_done"] else f"{snapshot['total']}+"
+    print(f"[{snapshot['elapsed_sec']:.1f}s] {snapshot['processed']}/{total} "
+          f"({snapshot['failed']} failed) {snapshot['files_per_sec']:.1f} files/s "
+          f"{snapshot['mb_per_sec']:.1f} MB/s ETA {eta_text} "
+          f"saved {snapshot['bytes_saved'] / 1024 / 1024:.1f} MB",
+          file=sys.stderr)
+
+
+@contextlib.contextmanager
+def redirect_logs_to_stderr():
+    """
+    変換中のログを標準エラー出力に送り、標準出力には実行結果のJSONのみを出力できるようにする
+    ワーカープロセスもファイルディスクリプタ1を引き継ぐため、ファイルディスクリプタごと置き換える
+    元の標準出力に書き込むファイルオブジェクトを返す
+    """
+    sys.stdout.flush()
+    stdout_fd = os.dup(1)
+    os.dup2(2, 1)
+    stdout = open(stdout_fd, "w", encoding=sys.stdout.encoding or "utf-8",
+                  errors=sys.stdout.errors, closefd=False)
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            yield stdout
+    finally:
+        stdout.close()
+        sys.stderr.flush()
+        os.dup2(stdout_fd, 1)
+        os.close(stdout_fd)
+
+
+def run_convert(args):
+    """
+    変換処理を実行し、最後に実行結果をJSONで標準出力に出力する
+    変換中のログは標準エラー出力に出力する
+    """
+    output_format = args.format.lower()
+    # GUIと同じく、png は常に可逆圧縮、jpg は常に非可逆圧縮とする
+    if output_format == exts.PNG_EXT:
+        is_lossless = True
+    elif output_format == exts.JPG_EXT:
+        is_lossless = False
+    else:
+        is_lossless = args.lossless
+    quality = 100 if is_lossless else args.quality
+    # GUIと同じく、jpg は透過できないため常に塗りつぶす
+    is_fill_color = args.fill_color is not None or output_format == exts.JPG_EXT
+    fill_color = args.fill_color or "#ffffff"
+
+    progress = ProgressStream()
+    summary = {}
+
+    def on_finished(event, snapshot):
+        if event == FINISHED:
+            summary.update(snapshot)
+
+    progress.subscribe(on_finished, interval=None)
+    if args.progress_interval:
+        progress.subscribe(print_progress, interval=args.progress_interval)
+
+    timing_report = TimingReport(args.timing_top) if args.timing_report else None
+    resource_monitor = None
+    if args.resource_log:
+        resource_monitor = ResourceMonitor(args.resource_log, args.resource_interval)
+
+    start_time = time.perf_counter()
+    with redirect_logs_to_stderr():
+        is_error, message = converter.convert_images_concurrently(
+            input_path=args.input,
+            output_path=args.output,
+            is_convert_subfolders=args.subfolders,
+            output_format=output_format,
+            quality=quality,
+            is_lossless=is_lossless,
+            is_fill_color=is_fill_color,
+            fill_color=fill_color,
+            cpu_num=args.cpu_num,
+            is_sync=args.sync,
+            is_delete_orphans=args.delete_orphans,
+            max_pending=args.max_pending,
+            max_chunk_size=args.chunk_size,
+            is_largest_first=args.largest_first,
+            memory_budget_mb=args.memory_budget_mb,
+            max_tasks_per_worker=args.max_tasks_per_worker,
+            max_worker_rss_mb=args.max_worker_rss_mb,
+            executor_type=args.executor,
+            progress=progress,
+            timing_report=timing_report,
+            resource_monitor=resource_monitor,
+            passthrough=args.passthrough,
+            cache_dir=args.cache_dir,
+            cache_max_mb=args.cache_max_mb,
+            is_cache_link=args.cache_link,
+            duplicates_policy=args.duplicates,
+            is_perceptual_duplicates=args.perceptual,
+            duplicates_report=args.duplicates_report,
+            is_reduce_mode=args.reduce_mode,
+            resize=get_resize(args),
+        )
+    wall_time = time.perf_counter() - start_time
+
+    if timing_report is not None:
+        timing_report.write(args.timing_report)
+
+    result = {
+        "is_error": is_error,
+        "message": message,
+        "files_total": summary.get("total", 0),
+        "files_converted": summary.get("done", 0),
+        "files_failed": summary.get("failed", 0),
+        "files_passed_through": summary.get("passed_through", 0),
+        "files_from_cache": summary.get("cache_hits", 0),
+        "files_linked_duplicates": summary.get("duplicates", 0),
+        "wall_time_sec": round(wall_time, 3),
+        "files_per_sec": round(summary.get("done", 0) / wall_time, 3) if wall_time > 0 else 0.0,
+        "mb_in": round(summary.get("bytes_in", 0) / 1024 / 1024, 3),
+        "mb_out": round(summary.get("bytes_out", 0) / 1024 / 1024, 3),
+    }
+    if resource_monitor is not None:
+        result["resources"] = resource_monitor.summary()
+    print(json.dumps(result, ensure_ascii=False))
+
+    return 1 if is_error else 0
+
+
+def iter_input_files(input_path, is_subfolders):
+    """
+    入力ファイルパス、またはフォルダ内の対応画像ファイルのパスを順に返す
+    """
+    if os.path.isfile(input_path):
+        yield input_path
+        return
+    for _, files in converter.scan_image_files(input_path, is_subfolders):
+        yield from files
+
+
+def run_extract_metadata(args):
+    """
+    画像ごとに {"path": ファイルパス, "metadata": メタデータ} (失敗した場合は "error")を1行ずつ出力する
+    最後に処理枚数・処理時間を標準エラー出力に表示する
+    メタデータの復元に失敗した場合などのログは標準エラー出力に出力し、標準出力にはJSON Linesのみを出力する
+    """
+    start_time = time.perf_counter()
+    count = 0
+    errors = 0
+    with redirect_logs_to_stderr() as stdout:
+        output = open(args.output, "w", encoding="utf-8") if args.output else stdout
+        try:
+            for input_path, metadata, error in iter_metadata(
+                    iter_input_files(args.input, args.subfolders), args.workers):
+                count += 1
+                if error is None:
+                    line = {"path": input_path, "metadata": metadata}
+                else:
+                    errors += 1
+                    line = {"path": input_path, "error": error}
+                output.write(json.dumps(line, ensure_ascii=False) + "\n")
+        finally:
+            if output is not stdout:
+                output.close()
+    elapsed = time.perf_counter() - start_time
+    print(json.dumps({"files": count, "errors": errors, "wall_time_sec": round(elapsed, 3)}),
+          file=sys.stderr)
+    return 1 if errors else 0
+
+
+def run_index(args):
+    """
+    画像をデータベースに登録し、追加・更新・削除した件数を標準出力に出力する
+    読み込みに失敗した画像などのログは標準エラー出力に出力する
+    """
+    start_time = time.perf_counter()
+    index = PromptIndex(args.database)
+    try:
+        # フォルダを指定した場合は、見つからなかった画像をデータベースから削除する
+        root = None if os.path.isfile(args.input) else args.input
+        with redirect_logs_to_stderr():
+            stats = index.update(iter_input_files(args.input, args.subfolders), root, args.workers,
+                                 args.subfolders)
+    finally:
+        index.close()
+    stats["wall_time_sec"] = round(time.perf_counter() - start_time, 3)
+    print(json.dumps(stats))
+    return 1 if stats["errors"] else 0
+
+
+def run_search(args):
+    index = PromptIndex(args.database)
+    try:
+        rows = index.search(args.query, args.limit)
+    except sqlite3.OperationalError as e:
+        print(f"[Error] 検索に失敗しました\n{e}", file=sys.stderr)
+        return 1
+    finally:
+        index.close()
+    for row in rows:
+        print(json.dumps(row, ensure_ascii=False))
+    return 0
+
+
+def run_cache_stats(args):
+    cache = ConversionCache(args.cache_dir)
+    try:
+        print(json.dumps(cache.stats(), ensure_ascii=False))
+    finally:
+        cache.close()
+    return 0
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    converter.set_signals()
+    return args.func(args)
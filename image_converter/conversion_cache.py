@@ -0,0 +1,224 @@
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+from image_converter.passthrough import (PASSTHROUGH_COPY, PASSTHROUGH_LINK,
+                                         copy_file)
+
+# 変換結果のキャッシュ
+# 入力ファイルの内容のハッシュ(ピクセルとメタデータの両方を含む)と変換設定をキーにして、変換後のファイルを保存する
+# 同じ画像を同じ設定で変換する場合は、再エンコードせずにキャッシュからコピー(またはハードリンク)する
+# キャッシュの合計サイズが上限を超えた場合は、最後に使われた日時が古いものから削除する(LRU)
+
+CACHE_VERSION = 1
+DATABASE_NAME = "cache.sqlite3"
+OBJECTS_FOLDER = "objects"
+# ハッシュを計算する際に1回に読み込むサイズ
+HASH_CHUNK_SIZE = 1024 * 1024
+# 他のプロセスがデータベースに書き込み中の場合に待つ時間(秒)
+DATABASE_TIMEOUT = 30
+# キャッシュの合計サイズの上限のデフォルト(MB)
+DEFAULT_MAX_MB = 1024
+
+# スレッドごとのキャッシュ(sqlite3の接続はスレッド間で共有できないため)
+thread_local = threading.local()
+
+
+def hash_file(input_path):
+    hasher = hashlib.blake2b(digest_size=20)
+    with open(input_path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def make_key(input_path, output_format, quality, lossless, is_fill_color, fill_color, resize=None,
+             reduce_mode=False, is_passthrough=False):
+    """
+    入力ファイルの内容と変換設定からキャッシュのキーを作成する
+    is_passthroughがTrueの場合は、パススルーしない場合の変換結果と区別する
+    (パススルーできる画像はキャッシュに保存されないため、パススルーしない場合の変換結果を取り出さないようにする)
+    """
+    settings = {
+        "version": CACHE_VERSION,
+        "content": hash_file(input_path),
+        "output_format": output_format,
+        "quality": quality,
+        "lossless": bool(lossless),
+        # 塗りつぶさない場合は、塗りつぶす色は結果に影響しない
+        "fill_color": fill_color if is_fill_color else None,
+    }
+    # 縮小・ピクセルの形式の変換をしない場合は、それらの設定を追加する前と同じキーにする
+    if resize:
+        settings["resize"] = resize
+    if reduce_mode:
+        settings["reduce_mode"] = True
+    if is_passthrough:
+        settings["passthrough"] = True
+    payload = json.dumps(settings, sort_keys=True).encode("utf-8")
+    return hashlib.blake2b(payload, digest_size=20).hexdigest()
+
+
+def open_cache(cache_dir):
+    """
+    現在のスレッドで使うcache_dirのキャッシュを返す(スレッドごとに1回のみ開く)
+    """
+    caches = getattr(thread_local, "caches", None)
+    if caches is None:
+        caches = thread_local.caches = {}
+    if cache_dir not in caches:
+        caches[cache_dir] = ConversionCache(cache_dir)
+    return caches[cache_dir]
+
+
+class ConversionCache:
+    """
+    変換後のファイルを cache_dir/objects/キーの先頭2文字/キー.拡張子 に保存し、
+    サイズ・作成日時・最後に使われた日時・使われた回数をSQLiteに記録する
+    複数のプロセスから同時に読み書きできる
+    """
+    VERSION = 1
+    make_key = staticmethod(make_key)
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(os.path.join(cache_dir, OBJECTS_FOLDER), exist_ok=True)
+        self.connection = sqlite3.connect(
+            os.path.join(cache_dir, DATABASE_NAME), timeout=DATABASE_TIMEOUT)
+        self.connection.row_factory = sqlite3.Row
+        self.create_tables()
+
+    def create_tables(self):
+        self.connection.executescript("""
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+            CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                path TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                last_used REAL NOT NULL,
+                hits INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used);
+        """)
+        row = self.connection.execute("SELECT value FROM info WHERE key = 'version'").fetchone()
+        if row is None:
+            self.connection.execute(
+                "INSERT OR IGNORE INTO info (key, value) VALUES ('version', ?)", (str(self.VERSION),))
+            self.connection.commit()
+        elif int(row["value"]) != self.VERSION:
+            raise ValueError(f"unsupported cache version: {row['value']}")
+
+    def object_path(self, key, output_format):
+        return os.path.join(self.cache_dir, OBJECTS_FOLDER, key[:2], f"{key}.{output_format}")
+
+    def fetch(self, key, output_path, is_link=False, source_mtime_ns=None):
+        """
+        キャッシュにkeyの変換結果がある場合はoutput_pathにコピー(is_linkがTrueの場合はハードリンク)し、
+        コピーに使用した方法を返す。ない場合はNoneを返す
+        ハードリンクは更新日時を共有するため、キャッシュのファイルの更新日時がsource_mtime_ns(入力ファイルの
+        更新日時)と異なる場合は、ハードリンクせずにコピーする(呼び出し元で入力ファイルの更新日時をコピーする)
+        ハードリンクした出力ファイルは、再変換時に書き換えずに置き換えるため(copy_file, save_with_metadata)、
+        キャッシュのファイルは変更されない
+        """
+        row = self.connection.execute(
+            "SELECT path, size FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        object_path = os.path.join(self.cache_dir, row["path"])
+        try:
+            if os.path.getsize(object_path) != row["size"]:
+                # ハードリンク先が他のアプリで書き換えられた場合などは使わずに削除する
+                self.discard(key, object_path)
+                return None
+            if is_link and source_mtime_ns is not None and (
+                    os.stat(object_path).st_mtime_ns != source_mtime_ns):
+                is_link = False
+            method = copy_file(object_path, output_path,
+                               PASSTHROUGH_LINK if is_link else PASSTHROUGH_COPY)
+        except OSError:
+            # 他のプロセスが削除した場合など
+            return None
+        self.connection.execute(
+            "UPDATE entries SET last_used = ?, hits = hits + 1 WHERE key = ?", (time.time(), key))
+        self.connection.commit()
+        return method
+
+    def store(self, key, output_path, output_format):
+        """
+        変換後のファイルをキャッシュに保存する
+        """
+        object_path = self.object_path(key, output_format)
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        # copy_fileは一時ファイルに書き込んでから置き換えるため、書き込み途中のファイルを他のプロセスが読み込まない
+        copy_file(output_path, object_path, PASSTHROUGH_COPY)
+        # 出力ファイルの更新日時(入力ファイルと同じ)をコピーし、同じ入力ファイルからはハードリンクできるようにする
+        shutil.copystat(output_path, object_path)
+        now = time.time()
+        self.connection.execute(
+            "INSERT OR REPLACE INTO entries (key, path, size, created, last_used, hits) "
+            "VALUES (?, ?, ?, ?, ?, 0)",
+            (key, os.path.relpath(object_path, self.cache_dir), os.path.getsize(object_path),
+             now, now))
+        self.connection.commit()
+
+    def discard(self, key, object_path):
+        """
+        keyの変換結果をキャッシュから削除する
+        """
+        try:
+            os.remove(object_path)
+        except FileNotFoundError:
+            pass
+        self.connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+        self.connection.commit()
+
+    def evict(self, max_bytes):
+        """
+        合計サイズがmax_bytes以下になるまで、最後に使われた日時が古いものから削除する
+        削除した件数とサイズを返す
+        """
+        total = self.connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        removed = []
+        removed_bytes = 0
+        if total > max_bytes:
+            for row in self.connection.execute(
+                    "SELECT key, path, size FROM entries ORDER BY last_used"):
+                if total - removed_bytes <= max_bytes:
+                    break
+                try:
+                    os.remove(os.path.join(self.cache_dir, row["path"]))
+                except FileNotFoundError:
+                    pass
+                removed.append((row["key"],))
+                removed_bytes += row["size"]
+            self.connection.executemany("DELETE FROM entries WHERE key = ?", removed)
+            self.connection.commit()
+        return {"removed": len(removed), "removed_mb": removed_bytes / 1024 / 1024}
+
+    def stats(self):
+        """
+        キャッシュの件数・合計サイズ・使われた回数の合計などを返す
+        """
+        row = self.connection.execute(
+            "SELECT COUNT(*) AS entries, COALESCE(SUM(size), 0) AS size, "
+            "COALESCE(SUM(hits), 0) AS hits, MIN(last_used) AS oldest, MAX(last_used) AS newest "
+            "FROM entries").fetchone()
+        return {
+            "cache_dir": os.path.abspath(self.cache_dir),
+            "entries": row["entries"],
+            "size_mb": round(row["size"] / 1024 / 1024, 3),
+            "hits": row["hits"],
+            "oldest_used": row["oldest"],
+            "newest_used": row["newest"],
+        }
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,270 @@
+import collections
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+import image_converter.exts as exts
+from image_converter.conversion_cache import hash_file
+from image_converter.passthrough import (PASSTHROUGH_LINK, copy_file,
+                                         has_transparency, is_webp_lossless)
+from image_converter.worker import load_avif_plugin
+
+# 変換前に重複した画像を探し、1枚のみ変換する
+# 1. ファイルサイズでまとめる
+# 2. サイズが同じファイルを、先頭と末尾の一部のハッシュでまとめる
+# 3. 一部のハッシュが同じファイルを、全体のハッシュで確認する(完全に同じファイル)
+# 4. (is_perceptualの場合) 画像サイズが同じで、縮小してデコードした画像のハッシュ(dHash)の
+#    異なるビット数がPERCEPTUAL_MAX_DISTANCE以下のファイルをまとめる
+#    (形式や圧縮率だけが異なる、見た目がほぼ同じ画像。メタデータは比較しない)
+# - off: 重複を探さない
+# - link: 重複した画像のうち1枚のみ変換し、他はその変換結果のハードリンク(作成できない場合はコピー)を出力する
+# - skip: 重複した画像のうち1枚のみ変換し、他は出力しない
+DUPLICATES_OFF = "off"
+DUPLICATES_LINK = "link"
+DUPLICATES_SKIP = "skip"
+DUPLICATES_POLICIES = (DUPLICATES_OFF, DUPLICATES_LINK, DUPLICATES_SKIP)
+
+KIND_EXACT = "exact"
+KIND_PERCEPTUAL = "perceptual"
+
+# 一部のハッシュで読み込むサイズ(先頭と末尾のそれぞれ)
+PARTIAL_HASH_SIZE = 64 * 1024
+# ハッシュの計算・縮小したデコードに使用するスレッド数
+HASH_WORKERS = 8
+# dHashの計算に使う縮小後の画像サイズ(幅は隣のピクセルと比較するため1つ多い)
+DHASH_SIZE = (9, 8)
+DHASH_BITS = (DHASH_SIZE[0] - 1) * DHASH_SIZE[1]
+# dHashの異なるビット数がこの値以下の画像を、見た目が同じ画像とする
+PERCEPTUAL_MAX_DISTANCE = 4
+# 透過画像は、この色の背景に合成してからdHashを計算する(透明な部分のRGBの値は無視する)
+PERCEPTUAL_BACKGROUND = (128, 128, 128, 255)
+# 透過部分を比較するため、アルファチャンネルをこのサイズに縮小した値も比較する
+ALPHA_SIGNATURE_SIZE = (4, 4)
+# 縮小したアルファチャンネルの値の差が全てこの値以下の画像を、透過部分が同じ画像とする
+ALPHA_MAX_DIFFERENCE = 32
+# 不透明な画像の縮小したアルファチャンネルの値
+OPAQUE_SIGNATURE = (255,) * (ALPHA_SIGNATURE_SIZE[0] * ALPHA_SIGNATURE_SIZE[1])
+
+
+def partial_hash(input_path):
+    """
+    ファイルの先頭と末尾のPARTIAL_HASH_SIZEバイトのハッシュを返す
+    """
+    hasher = hashlib.blake2b(digest_size=20)
+    with open(input_path, "rb") as f:
+        hasher.update(f.read(PARTIAL_HASH_SIZE))
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if size > PARTIAL_HASH_SIZE * 2:
+            f.seek(-PARTIAL_HASH_SIZE, os.SEEK_END)
+            hasher.update(f.read(PARTIAL_HASH_SIZE))
+        elif size > PARTIAL_HASH_SIZE:
+            # 先頭の続きから末尾まで読み込む(ファイル全体のハッシュになる)
+            f.seek(PARTIAL_HASH_SIZE)
+            hasher.update(f.read())
+    return hasher.hexdigest()
+
+
+def perceptual_hash(input_path):
+    """
+    画像を縮小してデコードし、(幅, 高さ, dHash, 縮小したアルファチャンネルの値)を返す
+    jpgはデコード時に縮小する(draft)ため、全体をデコードするより速い
+    透過画像は背景に合成してからdHashを計算し、透明な部分のRGBの値の違いは無視する
+    読み込めない場合はNoneを返す
+    """
+    try:
+        if input_path.lower().endswith(exts.AVIF_EXT):
+            load_avif_plugin()
+        with Image.open(input_path) as image:
+            size = image.size
+            if has_transparency(image):
+                image = image.convert("RGBA")
+                alpha = image.getchannel("A").resize(ALPHA_SIGNATURE_SIZE, Image.BOX)
+                alpha_signature = tuple(alpha.getdata())
+                background = Image.new("RGBA", size, PERCEPTUAL_BACKGROUND)
+                gray = Image.alpha_composite(background, image).convert("L")
+            else:
+                alpha_signature = OPAQUE_SIGNATURE
+                image.draft("L", (DHASH_SIZE[0] * 4, DHASH_SIZE[1] * 4))
+                gray = image.convert("L")
+            small = gray.resize(DHASH_SIZE, Image.BILINEAR, reducing_gap=2.0)
+    except Exception:
+        return None
+    pixels = list(small.getdata())
+    width = DHASH_SIZE[0]
+    value = 0
+    for y in range(DHASH_SIZE[1]):
+        for x in range(width - 1):
+            value = (value << 1) | (pixels[y * width + x] < pixels[y * width + x + 1])
+    return size[0], size[1], value, alpha_signature
+
+
+def group_by(executor, paths, function):
+    """
+    function(path)の値が同じパスをまとめ、2つ以上のパスがあるグループのみ返す(Noneの値は除く)
+    """
+    groups = collections.defaultdict(list)
+    for path, key in zip(paths, executor.map(function, paths)):
+        if key is not None:
+            groups[key].append(path)
+    return [group for group in groups.values() if len(group) > 1]
+
+
+def is_same_alpha(signature, other):
+    return all(abs(a - b) <= ALPHA_MAX_DIFFERENCE for a, b in zip(signature, other))
+
+
+def group_similar(hashes, max_distance):
+    """
+    {パス: (幅, 高さ, dHash, 縮小したアルファチャンネルの値)}から、画像サイズが同じで
+    dHashの異なるビット数がmax_distance以下、かつ透過部分がほぼ同じパスをまとめる
+    dHashを(max_distance + 1)個に分割すると、条件を満たす2つのdHashは少なくとも1つの部分が一致するため、
+    部分が一致するものどうしのみ比較する
+    """
+    parent = {path: path for path in hashes}
+
+    def find(path):
+        while parent[path] != path:
+            parent[path] = parent[parent[path]]
+            path = parent[path]
+        return path
+
+    bands = max_distance + 1
+    band_bits = -(-DHASH_BITS // bands)
+    buckets = collections.defaultdict(list)
+    for path, (width, height, value, _) in hashes.items():
+        for band in range(bands):
+            band_value = (value >> (band * band_bits)) & ((1 << band_bits) - 1)
+            buckets[(width, height, band, band_value)].append(path)
+    for bucket in buckets.values():
+        for i, path in enumerate(bucket):
+            for other in bucket[i + 1:]:
+                if (find(path) != find(other)
+                        and bin(hashes[path][2] ^ hashes[other][2]).count("1") <= max_distance
+                        and is_same_alpha(hashes[path][3], hashes[other][3])):
+                    parent[find(other)] = find(path)
+
+    groups = collections.defaultdict(list)
+    for path in hashes:
+        groups[find(path)].append(path)
+    return [group for group in groups.values() if len(group) > 1]
+
+
+def source_rank(path):
+    """
+    見た目が同じ画像のうち残す画像を選ぶための順位(小さいほど優先)
+    可逆圧縮の画像(png・可逆圧縮のwebp)、ファイルサイズが大きい画像、パスの順に優先する
+    """
+    ext = os.path.splitext(path)[1][1:].lower()
+    try:
+        is_lossless = ext == exts.PNG_EXT or (ext == exts.WEBP_EXT and is_webp_lossless(path))
+        size = os.path.getsize(path)
+    except OSError:
+        is_lossless, size = False, 0
+    return not is_lossless, -size, path
+
+
+def find_duplicates(input_paths, is_perceptual=False, max_workers=None,
+                    max_distance=PERCEPTUAL_MAX_DISTANCE):
+    """
+    重複した画像を探し、{重複した画像のパス: (残す画像のパス, "exact" または "perceptual")}を返す
+    残す画像は、完全に同じファイルではパスが最初のもの、見た目が同じ画像ではsource_rankが最小のもの
+    (探索は並行して行われ、input_pathsの順は実行ごとに変わりうるため、順序には依存しない)
+    """
+    duplicate_of = {}
+
+    def add_group(group, kind):
+        # 先頭の画像を残す
+        for path in group[1:]:
+            duplicate_of[path] = (group[0], kind)
+
+    def file_size(path):
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return None
+
+    def safe_hash(function):
+        def wrapper(path):
+            try:
+                return function(path)
+            except OSError:
+                return None
+        return wrapper
+
+    with ThreadPoolExecutor(max_workers or HASH_WORKERS) as executor:
+        for same_size in group_by(executor, list(input_paths), file_size):
+            size = file_size(same_size[0])
+            for same_partial in group_by(executor, same_size, safe_hash(partial_hash)):
+                if size <= PARTIAL_HASH_SIZE * 2:
+                    # 一部のハッシュでファイル全体を読み込んでいる
+                    add_group(sorted(same_partial), KIND_EXACT)
+                    continue
+                for same_content in group_by(executor, same_partial, safe_hash(hash_file)):
+                    add_group(sorted(same_content), KIND_EXACT)
+
+        if is_perceptual:
+            # 完全に同じファイルは、残す画像のみ比較する
+            remaining = [path for path in input_paths if path not in duplicate_of]
+            hashes = {path: value for path, value in zip(
+                remaining, executor.map(perceptual_hash, remaining)) if value is not None}
+            for same_image in group_similar(hashes, max_distance):
+                same_image = sorted(same_image, key=source_rank)
+                add_group(same_image, KIND_PERCEPTUAL)
+                # 残さない画像と完全に同じファイルは、残す画像の重複とする
+                members = set(same_image[1:])
+                for path, (original, kind) in list(duplicate_of.items()):
+                    if original in members:
+                        duplicate_of[path] = (same_image[0], KIND_PERCEPTUAL)
+    return duplicate_of
+
+
+def write_report(report_path, duplicate_of, path_pairs):
+    """
+    重複した画像を、残す画像ごとにJSONで出力する
+    """
+    groups = collections.defaultdict(list)
+    for path, (original, kind) in duplicate_of.items():
+        groups[original].append({"file": path, "kind": kind, "output": path_pairs[path]})
+    report = {
+        "groups": [{"file": original, "output": path_pairs[original], "duplicates": duplicates}
+                   for original, duplicates in groups.items()],
+        "duplicates": len(duplicate_of),
+        "bytes": sum(os.path.getsize(path) for path in duplicate_of),
+    }
+    with open(report_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+def plan_duplicates(path_pairs, is_perceptual=False, report_path=None):
+    """
+    (入力パス, 出力パス)のうち重複した画像を除き、
+    (変換する(入力パス, 出力パス)のリスト, {残す画像の入力パス: [(重複した画像の入力パス, 出力パス)]})を返す
+    """
+    path_pairs = dict(path_pairs)
+    duplicate_of = find_duplicates(list(path_pairs), is_perceptual)
+    if report_path:
+        write_report(report_path, duplicate_of, path_pairs)
+    duplicates = collections.defaultdict(list)
+    for path, (original, _) in duplicate_of.items():
+        duplicates[original].append((path, path_pairs[path]))
+    unique_pairs = [(input_path, output_path) for input_path, output_path in path_pairs.items()
+                    if input_path not in duplicate_of]
+    return unique_pairs, dict(duplicates)
+
+
+def link_duplicate(result, input_path, output_path):
+    """
+    変換結果(result)を重複した画像の出力先にハードリンク(作成できない場合はコピー)し、変換結果を返す
+    """
+    copy_file(result["output_path"], output_path, PASSTHROUGH_LINK)
+    return {
+        "input_path": input_path,
+        "output_path": output_path,
+        "input_size": os.path.getsize(input_path),
+        "output_size": os.path.getsize(output_path),
+        "duplicate_of": result["input_path"],
+    }
@@ -1,22 +1,42 @@
-import ast
+import collections
 import datetime
-import glob
-import json
 import os
-import shutil
+import queue
 import signal
 import sys
 import threading
+import time
 import traceback
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-import piexif
-import piexif.helper
-import pillow_avif
-from PIL import Image, PngImagePlugin
-
 import image_converter.exts as exts
+from image_converter.conversion_cache import ConversionCache
+from image_converter.duplicates import (DUPLICATES_OFF, DUPLICATES_SKIP,
+                                        link_duplicate, plan_duplicates)
+from image_converter.passthrough import PASSTHROUGH_OFF
+from image_converter.progress import ProgressStream
+from image_converter.scheduler import (PendingTasks, iter_tasks,
+                                       plan_largest_first)
+from image_converter.sync_manifest import SyncManifest
+from image_converter.worker import convert_image_chunk
+from image_converter.worker_pool import (EXECUTOR_AUTO, EXECUTOR_PROCESS,
+                                         EXECUTOR_THREAD, WorkerPool)
+
+# フォルダ探索に使用するスレッド数
+SCAN_WORKERS = 8
+# 停止ボタンが押されたかを確認する間隔(秒)
+STOP_POLL_INTERVAL = 0.2
+# 1プロセスあたりに投入しておく変換処理の数
+PENDING_PER_WORKER = 4
+# 1回の変換処理でまとめて変換する画像の最大数
+MAX_CHUNK_SIZE = 16
+# executor_typeが"auto"の場合、この枚数以下ならスレッドで変換する
+AUTO_THREAD_MAX_FILES = 64
+# プロセスのメモリ使用量を確認する間隔(秒)
+RSS_CHECK_INTERVAL = 1.0
+# 探索完了後、残りの画像のコストを(プロセス数 x CHUNK_DIVISOR)個以上の変換処理に分割する
+CHUNK_DIVISOR = 4
 
 
 def is_supported_extension(path):
@@ -31,188 +51,110 @@ def is_supported_extension(path):
     #     return header.startswith(exts.SUPPORTED_EXTENSIONS_BIN)
 
 
-def extract_metadata(image, input_path):
-    """
-    画像のExif（メタデータ）を取得する
-    """
-    metadata = {}
-    if input_path.lower().endswith(exts.PNG_EXT):
-        metadata = image.info
-    elif input_path.lower().endswith((exts.JPEG_EXT, exts.JPG_EXT, exts.WEBP_EXT, exts.AVIF_EXT)):
-        if "exif" in image.info.keys():
-            exif_dict = piexif.load(image.info["exif"])
-            if piexif.ExifIFD.UserComment in exif_dict["Exif"]:
-                user_comment = exif_dict["Exif"][piexif.ExifIFD.UserComment]
-                metadata = {
-                    "parameters": piexif.helper.UserComment.load(user_comment)}
-    return metadata
-
-
-def fill_image_with_fill_color(image, fill_color, output_format):
-    """
-    透過部分を指定した色で塗りつぶす
-    """
-    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
-        if output_format == exts.JPG_EXT:
-            background = Image.new("RGB", image.size, fill_color)
-        else:
-            background = Image.new("RGBA", image.size, fill_color)
-        background.paste(image, mask=image.split()[3])  # アルファチャンネルをマスクとして使用
-        image = background
-    return image
-
-
-def convert_webui_to_novelai(metadata):
-    """
-    jpg, webp, avif向けに変換したNovelAIの画像のメタデータを(png向けに)復元する
-    """
-    try:
-        # "NAI:"以降の文字列を抽出してdict型に変換してから返す
-        md = metadata["parameters"][metadata["parameters"].find(
-            "NAI:")+4:].strip()
-        return ast.literal_eval(md)
-    except Exception:
-        tb = traceback.format_exc()
-        print(f"[Error] NovelAIのメタデータの取得に失敗しました\n{tb}")
-
-
-def convert_webui_to_comfyui(metadata):
-    """
-    jpg, webp, avif向けに変換したComfyUIの画像のメタデータを(png向けに)復元する
-    """
-    try:
-        # "ComfyUI:"以降の文字列を抽出してdict型に変換してから返す
-        md = metadata["parameters"][metadata["parameters"].find(
-            "ComfyUI:")+8:].strip()
-        return ast.literal_eval(md)
-    except Exception:
-        tb = traceback.format_exc()
-        print(f"[Error] ComfyUIのメタデータの取得に失敗しました\n{tb}")
-
-
-def convert_novelai_to_webui(metadata):
+def scan_image_files(input_path, is_convert_subfolders, max_workers=None):
     """
-    NovelAIの画像のメタデータをa1111(WebUI)で読み込める形式に変換する
-    jpg, webp, avif形式に変換してもNovelAIの画像のメタデータが残るように変換している
+    フォルダ内の対応画像ファイルをos.scandirで探索し、見つかったフォルダから順に
+    (フォルダパス, ファイルパスのリスト) を返す
+    サブフォルダは複数のスレッドで並行して探索する
+    globと同じくフォルダへのシンボリックリンクも探索するが、同じフォルダは1回のみ探索する
     """
+    max_workers = max_workers or SCAN_WORKERS
+    results = queue.SimpleQueue()
+    stop_event = threading.Event()
+    pending_lock = threading.Lock()
+    pending = 1
+    # 探索済みのフォルダの(デバイス, inode)
+    # シンボリックリンクが親フォルダを指している場合に、無限に探索しないようにする
+    visited = set()
+    visited_lock = threading.Lock()
+
+    def mark_visited(dirpath):
+        """
+        フォルダを探索済みとして記録する(既に探索済みの場合はFalseを返す)
+        """
+        try:
+            stat = os.stat(dirpath)
+        except OSError:
+            return False
+        key = (stat.st_dev, stat.st_ino)
+        with visited_lock:
+            if key in visited:
+                return False
+            visited.add(key)
+            return True
+
+    def scan_dir(dirpath):
+        nonlocal pending
+        files = []
+        try:
+            if stop_event.is_set():
+                return
+            subdirs = []
+            try:
+                with os.scandir(dirpath) as it:
+                    for entry in it:
+                        # globと同じく隠しファイル・隠しフォルダは対象外
+                        if entry.name.startswith("."):
+                            continue
+                        try:
+                            if entry.is_dir():
+                                subdirs.append(entry.path)
+                            elif is_supported_extension(entry.name) and entry.is_file():
+                                files.append(entry.path)
+                        except OSError:
+                            continue
+            except OSError as e:
+                print(f"[Error] '{dirpath}' の探索に失敗しました\n{e}")
+
+            if is_convert_subfolders and not stop_event.is_set():
+                subdirs = [subdir for subdir in subdirs if mark_visited(subdir)]
+                with pending_lock:
+                    pending += len(subdirs)
+                for subdir in subdirs:
+                    executor.submit(scan_dir, subdir)
+        finally:
+            files.sort()
+            results.put((dirpath, files))
+            with pending_lock:
+                pending -= 1
+                if pending == 0:
+                    # 全てのフォルダの探索が完了
+                    results.put(None)
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
     try:
-        json_info = json.loads(metadata["Comment"])
-
-        geninfo = f"""{metadata["Description"]}
-Negative prompt: {json_info["uc"]}
-Steps: {json_info["steps"]}, Sampler: {json_info["sampler"]}, CFG scale: {json_info["scale"]}, Seed: {json_info["seed"]}, Size: {json_info["width"]}x{json_info["height"]}, Clip skip: 2, ENSD: 31337, NAI: {metadata}"""
-    except Exception:
-        tb = traceback.format_exc()
-        print(f"[Error] NovelAIのメタデータの取得に失敗しました\n{tb}")
-
-    return geninfo
-
-
-def convert_comfyui_to_webui(metadata):
-    """
-    jpg, webp, avif形式に変換してもComfyUIの画像のメタデータが残るように変換している
-    """
-    return f"ComfyUI: {metadata}"
-
-
-def save_with_metadata(image, output_fullpath, output_format, quality, metadata, lossless):
-    """
-    画像を指定の拡張子で保存する
-    """
-    ext = output_format.lower()
-    exif_bytes = None
-
-    # Exif情報（メタデータ）を拡張子に合わせて整形
-    if ext == exts.PNG_EXT:
-        metadata_obj = PngImagePlugin.PngInfo()
-        for key, value in metadata.items():
-            if isinstance(key, str) and isinstance(value, str):
-                metadata_obj.add_text(key, value)
-        # pngのみpnginfoに保存する必要がある
-        image.save(output_fullpath, format=ext, pnginfo=metadata_obj,
-                   quality=quality, lossless=lossless)
-        return
-    elif ext in (exts.JPEG_EXT, exts.JPG_EXT, exts.WEBP_EXT, exts.AVIF_EXT):
-        if metadata.get("Software", None) == "NovelAI":
-            # NovelAIはWebUIで読み込める形にメタデータを変換する
-            md = convert_novelai_to_webui(metadata)
-        elif "prompt" in metadata or "workflow" in metadata:
-            # ComfyUIはそのままメタデータを保存
-            md = convert_comfyui_to_webui(metadata)
-        else:
-            # WebUIまたはその他のメタデータを保存
-            md = metadata.get("parameters", "")
-        exif_bytes = piexif.dump({"Exif": {piexif.ExifIFD.UserComment: piexif.helper.UserComment.dump(
-            md, encoding="unicode")}})
-
-    else:
-        raise ValueError(f"Invalid output format: {output_format}")
-
-    # extがjpgのとき、format="jpg"ではエラーが起こるため"jpeg"に変換
-    ext = exts.JPEG_EXT if ext == exts.JPG_EXT else ext
-    # メタデータ付き画像を保存
-    image.save(output_fullpath, format=ext, quality=quality,
-               exif=exif_bytes, lossless=lossless)
+        mark_visited(input_path)
+        executor.submit(scan_dir, input_path)
+        while True:
+            item = results.get()
+            if item is None:
+                break
+            if item[1]:
+                yield item
+    finally:
+        stop_event.set()
+        executor.shutdown(wait=True)
 
 
-def convert_image(conversion_params):
+def iter_input_output_path_pairs(input_path, output_folder_path, output_format, is_convert_subfolders, manifest=None):
     """
-    画像の変換を行う
+    入力ファイルパスと出力ファイルパスのペアを、フォルダを探索しながら順に返す
+    manifestを指定した場合(同期モード)は、前回から変更のない入力ファイルを除外し、
+    前回と同じ出力ファイルパスに上書きする
     """
-    input_path, output_path, output_format, quality, lossless, is_fill_color, fill_color = conversion_params
 
-    with Image.open(input_path) as image:
-        # アニメーション画像は変換しない
-        if input_path.endswith((exts.PNG_EXT, exts.WEBP_EXT, exts.AVIF_EXT)):
-            if image.is_animated:
-                print(f"[Error] '{input_path}' はアニメーション画像のため、変換できません")
+    # input_pathがファイル単体の場合
+    if os.path.isfile(input_path):
+        if not is_supported_extension(input_path):
+            return
+        if manifest is not None:
+            manifest.mark_seen(input_path)
+            prev_output_fullpath = manifest.get_output_path(input_path)
+            if prev_output_fullpath and prev_output_fullpath.endswith(f".{output_format}"):
+                if not manifest.is_unchanged(input_path):
+                    yield input_path, prev_output_fullpath
                 return
 
-        if output_format == exts.WEBP_EXT:
-            width, height = image.size
-            if width > 16383 or height > 16383:
-                print(
-                    f"[Error] '{input_path}' は画像の幅(高さ)の最大サイズが16383 pxを超えるため、変換できません")
-                return
-        elif output_format == exts.JPG_EXT:
-            width, height = image.size
-            if width > 65535 or height > 65535:
-                print(
-                    f"[Error] '{input_path}' は画像の幅(高さ)の最大サイズが65535 pxを超えるため、変換できません")
-
-            # 画像のプロンプト情報を取得
-        metadata = extract_metadata(image, input_path)
-
-        # NovelAIまたはComfyUIの画像を変換したことがあった場合、メタデータを復元する
-        if metadata.get("parameters", None):
-            if "NAI:" in metadata["parameters"]:
-                metadata = convert_webui_to_novelai(metadata)
-            elif "ComfyUI:" in metadata["parameters"]:
-                metadata = convert_webui_to_comfyui(metadata)
-
-        # 透明部分を塗りつぶす
-        if is_fill_color:
-            image = fill_image_with_fill_color(
-                image, fill_color, output_format)
-        try:
-            # 保存
-            save_with_metadata(image, output_path, output_format,
-                               quality, metadata, lossless)
-            # 更新日時などの属性をコピー
-            shutil.copystat(input_path, output_path)
-        except Exception:
-            tb = traceback.format_exc()
-            print(f"[Error] '{input_path}' の保存に失敗しました\n{tb}")
-
-
-def get_input_output_path_pairs(input_path, output_folder_path, output_format, is_convert_subfolders):
-    """
-    入力ファイルパスと出力ファイルパスのペアを全て取得する
-    """
-
-    path_pairs = {}
-    # input_pathがファイル単体の場合
-    if os.path.isfile(input_path) and is_supported_extension(input_path):
         os.makedirs(output_folder_path, exist_ok=True)
         path = Path(input_path)
         stem = path.stem
@@ -224,57 +166,91 @@ def get_input_output_path_pairs(input_path, output_folder_path, output_format, i
                 output_folder_path, f"{basename}.{output_format}"
             )
             if not os.path.exists(output_fullpath):
-                path_pairs[input_path] = output_fullpath
+                yield input_path, output_fullpath
                 break
             counter += 1
 
-        return path_pairs
-
-    # サブフォルダ内のファイルも探索する場合
-    if is_convert_subfolders:
-        search_pattern = os.path.join(input_path, '**/*')
-    else:
-        search_pattern = os.path.join(input_path, '*')
+        return
 
-    all_fullpaths = glob.glob(search_pattern, recursive=True)
+    reserved_output_fullpaths = set()
+    if manifest is not None:
+        # 前回の出力ファイルと名前が重複しないようにする
+        reserved_output_fullpaths = manifest.reserved_output_paths()
 
-    # 拡張子によるフィルタリング
-    filtered_input_fullpaths = [
-        path for path in all_fullpaths if is_supported_extension(path)]
+    for dirpath, input_fullpaths in scan_image_files(input_path, is_convert_subfolders):
+        # 出力先のフォルダパスを取得
+        relpath = os.path.relpath(dirpath, input_path)
+        output_folder = output_folder_path if relpath == os.curdir else os.path.join(
+            output_folder_path, relpath)
+        is_output_folder_created = False
 
-    if filtered_input_fullpaths:
+        # 出力ファイル名はフォルダ内でのみ重複しうるため、フォルダ単位で重複チェックする
         output_fullpaths = set()
         output_fullpaths_add = output_fullpaths.add
 
-        for input_fullpath in filtered_input_fullpaths:
-            # 出力ファイルパスを取得
-            output_fullpath = input_fullpath.replace(
-                input_path, output_folder_path)
-            output_path = Path(output_fullpath)
-            # ファイル名とフォルダを取得
-            stem = output_path.stem
-            output_folder = output_path.parent
-
-            # 出力先のフォルダを作成
-            os.makedirs(output_folder, exist_ok=True)
+        for input_fullpath in input_fullpaths:
+            output_fullpath = None
+            if manifest is not None:
+                manifest.mark_seen(input_fullpath)
+                prev_output_fullpath = manifest.get_output_path(input_fullpath)
+                if prev_output_fullpath and prev_output_fullpath.endswith(f".{output_format}"):
+                    # 変更のないファイルは変換しない
+                    if manifest.is_unchanged(input_fullpath):
+                        continue
+                    output_fullpath = prev_output_fullpath
+
+            if output_fullpath is None:
+                stem = Path(input_fullpath).stem
+                # 重複チェック
+                counter = 0
+                while True:
+                    basename = f"{stem}_{counter:03d}" if counter >= 1 else stem
+                    output_fullpath = os.path.join(
+                        output_folder, f"{basename}.{output_format}"
+                    )
+
+                    if (output_fullpath not in output_fullpaths
+                            and output_fullpath not in reserved_output_fullpaths):
+                        output_fullpaths_add(output_fullpath)
+                        break
+                    counter += 1
+
+            # 出力先のフォルダを作成(フォルダごとに1回のみ)
+            if not is_output_folder_created:
+                os.makedirs(output_folder, exist_ok=True)
+                is_output_folder_created = True
+
+            yield input_fullpath, output_fullpath
+
+
+def get_input_output_path_pairs(input_path, output_folder_path, output_format, is_convert_subfolders, manifest=None):
+    """
+    入力ファイルパスと出力ファイルパスのペアを全て取得する
+    """
+    return dict(iter_input_output_path_pairs(
+        input_path, output_folder_path, output_format, is_convert_subfolders, manifest))
 
-            # 重複チェック
-            counter = 0
-            while True:
-                basename = f"{stem}_{counter:03d}" if counter >= 1 else stem
-                output_fullpath = os.path.join(
-                    output_folder, f"{basename}.{output_format}"
-                )
 
-                if output_fullpath not in output_fullpaths:
-                    output_fullpaths_add(output_fullpath)
-                    path_pairs[input_fullpath] = output_fullpath
-                    break
-                counter += 1
+def remove_orphans(manifest):
+    """
+    入力ファイルが削除された画像を出力フォルダから削除する
+    """
+    removed = manifest.remove_orphans()
+    if removed:
+        print(f"入力ファイルが削除された {removed} 件の画像を出力フォルダから削除しました")
 
-    # print(path_pairs)
 
-    return path_pairs
+def evict_cache(cache_dir, cache_max_mb):
+    """
+    キャッシュの合計サイズが上限を超えた分を、最後に使われた日時が古いものから削除する
+    """
+    cache = ConversionCache(cache_dir)
+    try:
+        evicted = cache.evict(cache_max_mb * 1024 * 1024)
+    finally:
+        cache.close()
+    if evicted["removed"]:
+        print(f"キャッシュから {evicted['removed']} 件 ({evicted['removed_mb']:.1f} MB) を削除しました")
 
 
 def convert_images_concurrently(
@@ -287,80 +263,338 @@ def convert_images_concurrently(
         is_fill_color,
         fill_color,
         cpu_num,
-        pb_callbacks):
+        progress=None,
+        is_sync=False,
+        is_delete_orphans=False,
+        max_pending=None,
+        max_chunk_size=None,
+        is_largest_first=False,
+        memory_budget_mb=None,
+        max_tasks_per_worker=None,
+        max_worker_rss_mb=None,
+        executor_type=EXECUTOR_PROCESS,
+        worker_pool=None,
+        timing_report=None,
+        resource_monitor=None,
+        passthrough=PASSTHROUGH_OFF,
+        cache_dir=None,
+        cache_max_mb=None,
+        is_cache_link=False,
+        duplicates_policy=DUPLICATES_OFF,
+        is_perceptual_duplicates=False,
+        duplicates_report=None,
+        is_reduce_mode=False,
+        resize=None):
     """
     プロセスの実行をして、画像の変換を並行処理で行う
+    進捗はprogress(ProgressStream)に started, file_done, file_failed, finished イベントとして通知する
+    is_syncがTrueの場合は、タイムスタンプ付きのフォルダを作らずにoutput_pathへ直接出力し、
+    前回から変更のあった画像のみ変換する(同期モード)
+    max_pendingは同時に投入しておく変換処理の最大数(デフォルトはcpu_numのPENDING_PER_WORKER倍)
+    max_chunk_sizeは1回の変換処理でまとめて変換する画像の最大数(1にすると1枚ずつ変換する)
+    is_largest_firstがTrueの場合は、全ての画像のヘッダーから変換コストを見積もり、
+    コストの大きい画像から順に変換する(探索と変換は並行しなくなる)
+    memory_budget_mbを指定した場合は、画像のヘッダーから見積もった変換中のメモリ使用量の合計が
+    その値を超えないように投入する
+    max_tasks_per_worker(1プロセスあたりの変換枚数)、max_worker_rss_mb(1プロセスのメモリ使用量)を
+    超えたプロセスがある場合は、以降の変換処理を新しいプロセスで実行する
+    (実行中の変換処理の完了は待たず、古いプロセスは完了後に終了する)
+    executor_typeは変換処理の実行方法で、"process"(プロセス)、"thread"(スレッド)、
+    "auto"(画像の枚数が少ない場合のみスレッド)から選択する
+    worker_poolを指定した場合は、そのプロセスプールを使い回す(executor_typeは無視される)
+    timing_report(TimingReport)を指定した場合は、画像ごとに変換処理の段階ごとの処理時間を計測して集計する
+    resource_monitor(ResourceMonitor)を指定した場合は、変換中のプロセスごとのメモリ・CPU使用率・
+    読み書きの量を一定間隔で計測する(集計結果はresource_monitor.summary()で取得する)
+    passthroughが"copy"または"link"の場合は、既に出力形式・設定を満たしている画像を再エンコードせずに
+    コピー(reflink・copy_file_range)またはハードリンクで出力する
+    cache_dirを指定した場合は、入力ファイルの内容と変換設定をキーにして変換結果をキャッシュし、
+    同じ画像を同じ設定で変換する際はキャッシュからコピー(is_cache_linkがTrueの場合はハードリンク)する
+    cache_max_mbを指定した場合は、変換後にキャッシュの合計サイズが上限以下になるまで古いものから削除する
+    duplicates_policyが"link"または"skip"の場合は、変換前に全ての画像から重複した画像を探し、1枚のみ変換する
+    ("link"は他の画像の出力先に変換結果のハードリンクを作成し、"skip"は出力しない)
+    is_perceptual_duplicatesがTrueの場合は、縮小してデコードした画像が同じ画像も重複とする
+    duplicates_reportを指定した場合は、見つかった重複した画像をJSONで出力する
+    is_reduce_modeがTrueの場合は、pngと可逆圧縮のwebpで、画質を変えずにより小さいピクセルの形式
+    (不透明なRGBA → RGB、グレースケール → L、256色以下 → P(pngのみ))に変換してから保存する
+    resize({"max_width": 最大の幅, "max_height": 最大の高さ, "scale": 倍率})を指定した場合は、
+    縦横比を保って縮小してから保存する(jpgはデコード時に縮小する)
     """
 
     global should_stop
     should_stop = False
     isError = False
     message = ""
+    manifest = None
+    if progress is None:
+        progress = ProgressStream()
 
     try:
         print("変換処理を開始します...")
-        if not os.path.isfile(input_path):
+        progress.started()
+        if is_sync:
+            settings = {
+                "output_format": output_format,
+                "quality": quality,
+                "is_lossless": is_lossless,
+                "is_fill_color": is_fill_color,
+                "fill_color": fill_color,
+            }
+            # パススルー・ピクセルの形式の変換・縮小をしない場合は、以前のマニフェストと同じ設定として扱う
+            if passthrough != PASSTHROUGH_OFF:
+                settings["passthrough"] = passthrough
+            if is_reduce_mode:
+                settings["is_reduce_mode"] = is_reduce_mode
+            if resize:
+                settings["resize"] = resize
+            manifest = SyncManifest(input_path, output_path, settings, is_convert_subfolders)
+        elif not os.path.isfile(input_path):
             # output_pathにタイムスタンプ付きの出力フォルダを作成
             timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
             ls = "lossless" if is_lossless else "lossy"
             output_path = os.path.join(
                 output_path, f"{timestamp}_{output_format}_q{quality}_{ls}")
 
-        input_output_path_pairs = get_input_output_path_pairs(
-            input_path, output_path, output_format, is_convert_subfolders)
+        # フォルダを探索しながら、見つかった画像から順に変換処理を投入する
+        path_pairs = iter_input_output_path_pairs(
+            input_path, output_path, output_format, is_convert_subfolders, manifest)
+        # {残す画像の入力パス: [(重複した画像の入力パス, 出力パス)]}
+        duplicates = {}
+        if duplicates_policy != DUPLICATES_OFF:
+            # 全ての画像を探索してから、重複した画像を除いて投入する
+            path_pairs, duplicates = plan_duplicates(
+                path_pairs, is_perceptual_duplicates, duplicates_report)
+            duplicate_count = sum(len(group) for group in duplicates.values())
+            print(f"重複した画像が {duplicate_count} 枚見つかりました")
+            if duplicates_policy == DUPLICATES_SKIP:
+                duplicates = {}
+        memory_budget = memory_budget_mb * 1024 * 1024 if memory_budget_mb else None
+        if is_largest_first:
+            # 全ての画像を探索してから、変換コストの大きい画像から順に投入する
+            tasks = iter(plan_largest_first(
+                path_pairs, output_format, is_lossless, is_fill_color))
+        else:
+            # メモリ使用量を制限する場合のみ、画像のヘッダーを読み込んで見積もる
+            tasks = iter_tasks(path_pairs, output_format, is_lossless,
+                               is_fill_color, memory_budget is not None)
+        first_task = next(tasks, None)
+
+        if first_task is None:
+            if manifest is not None and manifest.seen:
+                if is_delete_orphans:
+                    remove_orphans(manifest)
+                message = "変更された画像ファイルはありません"
+                print(message)
+                progress.finished(isError, message)
+                return isError, message
 
-        if not input_output_path_pairs:
             message = "変換可能な画像ファイルが存在しません"
             print(f"[Error] {message}")
-            pb_callbacks["Error"]()
+            isError = True
+            progress.finished(isError, message)
             return isError, message
 
-        with ProcessPoolExecutor(max_workers=cpu_num) as executor:
-            futures = []
-            for input_fullpath, output_fullpath in input_output_path_pairs.items():
-                if should_stop:
-                    break
-                futures.append(executor.submit(
-                    convert_image,
-                    (input_fullpath,
-                        output_fullpath,
-                        output_format,
-                        quality,
-                        is_lossless,
-                        is_fill_color,
-                        fill_color)))
-
-            process_count = 0
-            process_total = len(futures)
-            pb_callbacks["start"](process_count, process_total)
-            # プロセス実行
-            for future in as_completed(futures):
-                try:
+        # 投入待ちの画像(探索済みで未投入の画像)
+        max_chunk_size = max_chunk_size or MAX_CHUNK_SIZE
+        pending_tasks = PendingTasks(
+            int(cpu_num), max_chunk_size, CHUNK_DIVISOR)
+        pending_tasks.append(*first_task)
+        pending_tasks_limit = max_chunk_size * int(cpu_num) * 2
+        if is_largest_first:
+            # 並べ替え済みの全ての画像を投入待ちにする
+            for task in tasks:
+                pending_tasks.append(*task)
+            pending_tasks.is_scan_done = True
+
+        if worker_pool is not None:
+            executor_type = worker_pool.executor_type
+        elif executor_type == EXECUTOR_AUTO:
+            # 画像の枚数が少ない場合は、プロセスの起動時間がかからないスレッドで変換する
+            while not pending_tasks.is_scan_done and len(pending_tasks) <= AUTO_THREAD_MAX_FILES:
+                task = next(tasks, None)
+                if task is None:
+                    pending_tasks.is_scan_done = True
+                else:
+                    pending_tasks.append(*task)
+            if pending_tasks.is_scan_done and len(pending_tasks) <= AUTO_THREAD_MAX_FILES:
+                executor_type = EXECUTOR_THREAD
+            else:
+                executor_type = EXECUTOR_PROCESS
+
+        # worker_poolが指定されていない場合は、今回の変換処理のみで使うプロセスプールを作成する
+        is_temporary_pool = worker_pool is None
+        if is_temporary_pool:
+            worker_pool = WorkerPool(executor_type)
+        executor = worker_pool.get(cpu_num)
+        if resource_monitor is not None:
+            resource_monitor.start(worker_pool)
+        try:
+            # 投入済みで未完了の変換処理の数をmax_pending以下に抑え、
+            # 処理数が多くても親プロセスのメモリ使用量が増えないようにする
+            max_pending = max_pending or int(cpu_num) * PENDING_PER_WORKER
+            # 投入済みで未完了の変換処理と、その推定メモリ使用量
+            futures = {}
+            in_flight_memory = 0
+            # 完了したFutureは順にcompletedに追加される
+            completed = queue.SimpleQueue()
+            # リンクする重複した画像も合計枚数に含める
+            process_total = sum(len(group) for group in duplicates.values())
+            # {プロセスID: プロセスを起動してから変換した画像の数}
+            worker_task_counts = collections.Counter()
+            last_rss_check_time = time.monotonic()
+            # 全ての画像で共通の変換オプション
+            options = {
+                "is_timing": timing_report is not None,
+                "passthrough": passthrough,
+                "cache_dir": cache_dir,
+                "is_cache_link": is_cache_link,
+                "is_reduce_mode": is_reduce_mode,
+                "resize": resize,
+            }
+
+            def collect_result(future):
+                nonlocal in_flight_memory
+                chunk_memory, pairs = futures.pop(future)
+                in_flight_memory -= chunk_memory
+                pid, results = future.result()
+                worker_task_counts[pid] += len(results)
+                for (input_fullpath, _), result in zip(pairs, results):
+                    record_result(input_fullpath, result)
+                    # 重複した画像の出力先に変換結果をリンクする
+                    for duplicate_input, duplicate_output in duplicates.pop(input_fullpath, ()):
+                        duplicate_result = None
+                        if result:
+                            try:
+                                duplicate_result = link_duplicate(
+                                    result, duplicate_input, duplicate_output)
+                            except OSError as e:
+                                print(f"[Error] '{duplicate_input}' の出力に失敗しました\n{e}")
+                        record_result(duplicate_input, duplicate_result)
+
+            def record_result(input_fullpath, result):
+                if result:
+                    if manifest is not None:
+                        manifest.record(
+                            result["input_path"], result["output_path"])
+                    if timing_report is not None:
+                        timing_report.add(result)
+                    progress.file_done(result)
+                else:
+                    progress.file_failed(input_fullpath)
+
+            def cancel_futures():
+                # Futureをキャンセル
+                for future in futures:
+                    if not future.running():
+                        future.cancel()
+
+            def wait_for_results(max_remaining):
+                # 未完了の変換処理がmax_remaining件以下になるまで結果を回収する
+                while len(futures) > max_remaining or should_stop:
                     if should_stop:
-                        # Futureをキャンセル
-                        for future in futures:
-                            if not future.running():
-                                future.cancel()
+                        cancel_futures()
                         raise Exception()
-                    else:
-                        process_count += 1
-                        _ = future.result()
-                        pb_callbacks["update"](process_count, process_total)
-                except KeyboardInterrupt:
-                    # ctrl+cで終了時
-                    # １つ１つのプロセスに対してにエラーハンドリングする必要がある
-                    for process in executor._processes.values():
-                        process.terminate()
-
-            message = "画像の変換処理が完了しました"
-            print(message)
+                    try:
+                        collect_result(completed.get(timeout=STOP_POLL_INTERVAL))
+                    except queue.Empty:
+                        continue
+
+            def needs_worker_recycle():
+                # 一定数の画像を変換した、またはメモリ使用量が上限を超えたプロセスがあるか
+                nonlocal last_rss_check_time
+                if worker_pool.executor_type != EXECUTOR_PROCESS:
+                    return False
+                if max_tasks_per_worker:
+                    # 入れ替え済みの古いプロセスの変換枚数は数えない
+                    if any(worker_task_counts[pid] >= max_tasks_per_worker
+                           for pid in worker_pool.get_pids()):
+                        return True
+                if max_worker_rss_mb and time.monotonic() - last_rss_check_time >= RSS_CHECK_INTERVAL:
+                    last_rss_check_time = time.monotonic()
+                    return worker_pool.get_max_rss() > max_worker_rss_mb * 1024 * 1024
+                return False
+
+            # プロセス実行
+            try:
+                while pending_tasks or not pending_tasks.is_scan_done:
+                    if should_stop:
+                        wait_for_results(0)
+
+                    # エンコーダーのメモリリークが蓄積しないように、プロセスを入れ替える
+                    if needs_worker_recycle():
+                        executor = worker_pool.recycle()
+                        worker_task_counts.clear()
+
+                    # 探索結果から投入待ちの画像を補充する
+                    if not pending_tasks.is_scan_done and len(pending_tasks) < pending_tasks_limit:
+                        task = next(tasks, None)
+                        if task is None:
+                            pending_tasks.is_scan_done = True
+                        else:
+                            pending_tasks.append(*task)
+
+                    chunk = []
+                    if pending_tasks and len(futures) < max_pending:
+                        # メモリ使用量の合計が上限を超えない画像のみ投入する
+                        # (実行中の変換処理がない場合は、上限を超える画像でも投入する)
+                        memory_available = None
+                        if memory_budget is not None and futures:
+                            memory_available = memory_budget - in_flight_memory
+                        # 複数の画像をまとめて1回の変換処理として投入する
+                        pairs, chunk_memory = pending_tasks.take_chunk(memory_available)
+                        chunk = [(input_fullpath,
+                                  output_fullpath,
+                                  output_format,
+                                  quality,
+                                  is_lossless,
+                                  is_fill_color,
+                                  fill_color,
+                                  options)
+                                 for input_fullpath, output_fullpath in pairs]
+
+                    if chunk:
+                        future = executor.submit(convert_image_chunk, chunk)
+                        futures[future] = (chunk_memory, pairs)
+                        in_flight_memory += chunk_memory
+                        future.add_done_callback(completed.put)
+                        process_total += len(chunk)
+                        progress.set_total(process_total + len(pending_tasks),
+                                           pending_tasks.is_scan_done)
+                    elif futures and (pending_tasks.is_scan_done
+                                      or len(pending_tasks) >= pending_tasks_limit):
+                        # 投入数・メモリ使用量が上限に達したら、空きができるまで待つ
+                        wait_for_results(len(futures) - 1)
+
+                    # 完了した変換結果を回収する
+                    while not completed.empty():
+                        collect_result(completed.get())
+
+                wait_for_results(0)
+            except KeyboardInterrupt:
+                # ctrl+cで終了時
+                # １つ１つのプロセスに対してにエラーハンドリングする必要がある
+                worker_pool.terminate()
+        finally:
+            if resource_monitor is not None:
+                resource_monitor.stop()
+            if is_temporary_pool:
+                worker_pool.shutdown()
+
+        # 全ての探索が完了した場合のみ削除する
+        if manifest is not None and is_delete_orphans:
+            remove_orphans(manifest)
+
+        if cache_dir is not None and cache_max_mb:
+            evict_cache(cache_dir, cache_max_mb)
+
+        message = "画像の変換処理が完了しました"
+        print(message)
 
     except PermissionError as e:
         isError = True
         message = "ファイルまたはフォルダのアクセス権限がありません"
         tb = traceback.format_exc()
         print(f"[Error] {message}\n{e}\n{tb}")
-        pb_callbacks["error"]()
+        progress.finished(isError, message)
         return isError, message
 
     except Exception as e:
@@ -371,11 +605,19 @@ def convert_images_concurrently(
             message = "変換中にエラーが発生しました"
         tb = traceback.format_exc()
         print(f"[Error] {message}\n{e}\n{tb}")
-        pb_callbacks["error"]()
+        progress.finished(isError, message)
 
         return isError, message
 
-    pb_callbacks["complete"]()
+    finally:
+        # 停止・エラー時も変換済みのファイルは記録しておく
+        if manifest is not None:
+            try:
+                manifest.save()
+            except Exception as e:
+                print(f"[Error] マニフェストの保存に失敗しました\n{e}")
+
+    progress.finished(isError, message)
     return isError, message
 
 
@@ -0,0 +1,130 @@
+import asyncio
+import threading
+
+import image_converter.image_converter as converter
+from image_converter.progress import FINISHED, STARTED, ProgressStream
+
+
+class ConversionJob:
+    """
+    変換処理をバックグラウンドのスレッドで実行し、asyncioのイベントループから
+    開始・待機・停止・進捗の取得ができるようにする
+    引数はconvert_images_concurrentlyと同じ(progressは省略可能)
+
+        job = ConversionJob(input_path=..., output_path=..., ...)
+        snapshots = job.progress()
+        job.start()
+        async for snapshot in snapshots:
+            print(snapshot["processed"], snapshot["total"])
+        isError, message = await job
+    """
+
+    def __init__(self, progress_interval=0.1, **kwargs):
+        self.progress_stream = kwargs.pop("progress", None) or ProgressStream()
+        self.kwargs = kwargs
+        self.loop = None
+        self.future = None
+        self.thread = None
+        self.is_cancelled = False
+        # progress()で作成した進捗の受け取り用のキュー
+        self.queues = []
+        self.last_snapshot = None
+        self.progress_stream.subscribe(self.on_progress, interval=progress_interval)
+
+    def start(self):
+        """
+        変換処理を開始する(イベントループ内で呼び出す)
+        """
+        if self.future is not None:
+            return self.future
+        self.loop = asyncio.get_running_loop()
+        self.future = self.loop.create_future()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.start()
+        return self.future
+
+    def run(self):
+        result = None
+        error = None
+        try:
+            if self.is_cancelled:
+                result = (True, "変換処理を停止しました")
+            else:
+                result = converter.convert_images_concurrently(
+                    progress=self.progress_stream, **self.kwargs)
+        except BaseException as e:
+            error = e
+        try:
+            self.loop.call_soon_threadsafe(self.finish, result, error)
+        except RuntimeError:
+            # イベントループが既に終了している
+            pass
+
+    def finish(self, result, error):
+        if not self.future.done():
+            if error is not None:
+                self.future.set_exception(error)
+            else:
+                self.future.set_result(result)
+        # 進捗の受け取りを終了させる
+        for queue in self.queues:
+            queue.put_nowait(None)
+
+    def cancel(self):
+        """
+        変換処理を停止する(実行中の変換処理の完了を待ってから終了する)
+        停止はプロセス全体で共有されるため、同時に実行中の他の変換処理も停止する
+        """
+        self.is_cancelled = True
+        if self.future is not None and not self.future.done():
+            converter.stop_process()
+
+    def done(self):
+        return self.future is not None and self.future.done()
+
+    async def wait(self):
+        """
+        変換処理の完了を待ち、(isError, message)を返す
+        """
+        self.start()
+        # 待機しているタスクがキャンセルされても、変換処理は継続させる
+        return await asyncio.shield(self.future)
+
+    def __await__(self):
+        return self.wait().__await__()
+
+    def on_progress(self, event, snapshot):
+        # 変換処理のスレッドから呼ばれる
+        if event == STARTED and self.is_cancelled:
+            # 開始前にcancel()された場合は、開始時に初期化された停止フラグを立て直す
+            converter.stop_process()
+        self.last_snapshot = snapshot
+        for queue in list(self.queues):
+            self.loop.call_soon_threadsafe(queue.put_nowait, snapshot)
+
+    def progress(self):
+        """
+        進捗のスナップショットを順に返す非同期イテレーターを取得する
+        finishedイベントを返すか、変換処理が終了すると終わる
+        start()より前に呼び出すと、startedイベントから受け取れる
+        """
+        queue = asyncio.Queue()
+        self.queues.append(queue)
+        return self.iter_progress(queue)
+
+    async def iter_progress(self, queue):
+        try:
+            # 終了後に作成されたキューには何も届かないため、最後のスナップショットのみ返す
+            if queue.empty() and self.done():
+                if self.last_snapshot is not None:
+                    yield self.last_snapshot
+                return
+            while True:
+                snapshot = await queue.get()
+                if snapshot is None:
+                    break
+                yield snapshot
+                if snapshot["event"] == FINISHED:
+                    break
+        finally:
+            self.queues.remove(queue)
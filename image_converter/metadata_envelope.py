@@ -0,0 +1,119 @@
+import ast
+import base64
+import json
+import struct
+import zlib
+
+# jpg, webp, avif形式のUserCommentに、NovelAI・ComfyUIのメタデータ(pngのテキストチャンク)を保存する形式
+# {"v": バージョン, "d": メタデータ} のJSON、大きい場合は {"v": バージョン, "z": zlibで圧縮してbase64にしたJSON}
+# 以前のバージョンで保存したPythonのdictの文字列(repr)も読み込める
+
+ENVELOPE_VERSION = 1
+# このバイト数を超えるメタデータは圧縮する
+COMPRESS_THRESHOLD = 512
+DATA_KEY = "d"
+COMPRESSED_DATA_KEY = "z"
+# 圧縮レベル(9にしてもサイズはほとんど変わらず、圧縮に時間がかかる)
+COMPRESS_LEVEL = 6
+VERSION_KEY = "v"
+
+# jpgのAPP1(Exif)セグメントに収まらない大きなメタデータは、zlibで圧縮して複数のAPP11セグメントに分割して保存する
+# セグメントのデータ: 識別子(8バイト) + 番号(2バイト、1から) + 総数(2バイト) + 圧縮したUserCommentの文字列(UTF-8)
+JPEG_EXIF_MAX_BYTES = 65533
+JPEG_METADATA_MARKER = b"\xff\xeb"
+JPEG_METADATA_IDENTIFIER = b"IMGCONV\x00"
+JPEG_METADATA_HEADER_SIZE = len(JPEG_METADATA_IDENTIFIER) + 4
+JPEG_METADATA_MAX_CHUNK = JPEG_EXIF_MAX_BYTES - JPEG_METADATA_HEADER_SIZE
+
+
+def encode_envelope(metadata):
+    """
+    メタデータ(文字列のキーと値のみ)をJSONの文字列にする
+    """
+    data = {key: str(value) for key, value in metadata.items()
+            if isinstance(key, str) and isinstance(value, str)}
+    payload = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+    encoded = payload.encode("utf-8")
+    if len(encoded) > COMPRESS_THRESHOLD:
+        compressed = base64.b64encode(zlib.compress(encoded, COMPRESS_LEVEL)).decode("ascii")
+        if len(compressed) < len(encoded):
+            return json.dumps({VERSION_KEY: ENVELOPE_VERSION, COMPRESSED_DATA_KEY: compressed},
+                              separators=(",", ":"))
+    return json.dumps({VERSION_KEY: ENVELOPE_VERSION, DATA_KEY: data},
+                      ensure_ascii=False, separators=(",", ":"))
+
+
+def decode_envelope(text):
+    """
+    encode_envelopeで作成した文字列、または以前のdictの文字列(repr)からメタデータを復元する
+    """
+    text = text.strip()
+    try:
+        envelope = json.loads(text)
+    except ValueError:
+        envelope = None
+    if isinstance(envelope, dict) and VERSION_KEY in envelope:
+        if envelope[VERSION_KEY] != ENVELOPE_VERSION:
+            raise ValueError(f"unsupported metadata envelope version: {envelope[VERSION_KEY]}")
+        if COMPRESSED_DATA_KEY in envelope:
+            return json.loads(zlib.decompress(base64.b64decode(envelope[COMPRESSED_DATA_KEY])))
+        return envelope[DATA_KEY]
+    # 以前のバージョンの形式
+    metadata = ast.literal_eval(text)
+    if not isinstance(metadata, dict):
+        raise ValueError("metadata is not a dict")
+    return metadata
+
+
+def decode_tagged_envelope(text, tag):
+    """
+    text内の "tag" 以降に保存されたメタデータを復元する
+    プロンプトにtagと同じ文字列が含まれる場合があるため、復元できる位置を先頭から順に探す
+    """
+    index = text.find(tag)
+    while index != -1:
+        try:
+            return decode_envelope(text[index + len(tag):])
+        except (ValueError, SyntaxError, zlib.error, MemoryError, RecursionError):
+            index = text.find(tag, index + 1)
+    raise ValueError(f"metadata after '{tag}' was not found")
+
+
+def build_jpeg_metadata_segments(text):
+    """
+    UserCommentの文字列を圧縮して分割し、jpgに追加するAPP11セグメントのバイト列を返す
+    """
+    payload = zlib.compress(text.encode("utf-8"), COMPRESS_LEVEL)
+    chunks = [payload[i:i + JPEG_METADATA_MAX_CHUNK]
+              for i in range(0, len(payload), JPEG_METADATA_MAX_CHUNK)]
+    segments = b""
+    for index, chunk in enumerate(chunks, start=1):
+        segments += (JPEG_METADATA_MARKER
+                     + struct.pack(">H", 2 + JPEG_METADATA_HEADER_SIZE + len(chunk))
+                     + JPEG_METADATA_IDENTIFIER
+                     + struct.pack(">HH", index, len(chunks))
+                     + chunk)
+    return segments
+
+
+def is_jpeg_metadata_segment(data):
+    return data.startswith(JPEG_METADATA_IDENTIFIER)
+
+
+def parse_jpeg_metadata_segments(segments):
+    """
+    APP11セグメントのデータ(マーカーと長さを除く)のリストから、UserCommentの文字列を復元する
+    このツールで保存したセグメントがない、または欠けている場合はNoneを返す
+    """
+    chunks = {}
+    total = None
+    for data in segments:
+        if not is_jpeg_metadata_segment(data):
+            continue
+        index, total = struct.unpack(
+            ">HH", data[len(JPEG_METADATA_IDENTIFIER):JPEG_METADATA_HEADER_SIZE])
+        chunks[index] = data[JPEG_METADATA_HEADER_SIZE:]
+    if total is None or sorted(chunks) != list(range(1, total + 1)):
+        return None
+    payload = b"".join(chunks[index] for index in range(1, total + 1))
+    return zlib.decompress(payload).decode("utf-8")
@@ -0,0 +1,338 @@
+import collections
+import os
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from image_converter.metadata_envelope import (is_jpeg_metadata_segment,
+                                               parse_jpeg_metadata_segments)
+from image_converter.worker import restore_metadata
+
+# 画像のピクセルをデコードせずに、ファイルのバイト列から直接プロンプト(メタデータ)を読み込む
+# Pillow・piexifを使わずに、メタデータが保存されている部分のみを読み込み、他の部分は読み飛ばす
+# - png: tEXt, zTXt, iTXtチャンク
+# - jpg: APP1(Exif)セグメント、Exifに収まらない大きなメタデータを保存したAPP11セグメント
+# - webp: EXIFチャンク
+# - avif: Exifアイテム
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+EXIF_HEADER = b"Exif\x00\x00"
+# ExifのIFDのタグ
+EXIF_IFD_POINTER_TAG = 0x8769
+USER_COMMENT_TAG = 0x9286
+# UserCommentの先頭8バイトの文字コード(piexif.helper.UserCommentと同じ)
+USER_COMMENT_ENCODINGS = {
+    b"ASCII\x00\x00\x00": "ascii",
+    b"JIS\x00\x00\x00\x00\x00": "shift_jis",
+    b"UNICODE\x00": "utf_16_be",
+}
+# Exifの型ごとの1要素のバイト数
+TIFF_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 7: 1, 9: 4, 10: 8}
+# 一括読み込み時に1スレッドあたりに投入しておく読み込み処理の数
+PENDING_PER_WORKER = 4
+
+
+def read_png_text(f):
+    """
+    pngのテキストチャンクを読み込み、{キー: 値}を返す(画像データのチャンクは読み飛ばす)
+    """
+    metadata = {}
+    f.seek(len(PNG_SIGNATURE))
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            break
+        length, chunk_type = struct.unpack(">I4s", header)
+        if chunk_type == b"IEND":
+            break
+        if chunk_type not in (b"tEXt", b"zTXt", b"iTXt"):
+            # チャンクのデータとCRCを読み飛ばす
+            f.seek(length + 4, os.SEEK_CUR)
+            continue
+        data = f.read(length)
+        f.seek(4, os.SEEK_CUR)
+        key, _, value = data.partition(b"\x00")
+        key = key.decode("latin-1")
+        if chunk_type == b"tEXt":
+            metadata[key] = value.decode("latin-1")
+        elif chunk_type == b"zTXt":
+            # 先頭1バイトは圧縮方式(0: zlibのみ)
+            metadata[key] = zlib.decompress(value[1:]).decode("latin-1")
+        else:
+            is_compressed = value[0] == 1
+            # 圧縮フラグ・圧縮方式の後に、言語タグ・翻訳されたキーがnull区切りで続く
+            _, _, rest = value[2:].partition(b"\x00")
+            _, _, text = rest.partition(b"\x00")
+            if is_compressed:
+                text = zlib.decompress(text)
+            metadata[key] = text.decode("utf-8")
+    return metadata
+
+
+def read_jpeg_segments(f):
+    """
+    jpgのAPP1(Exif)セグメントとAPP11セグメントを探し、
+    (Exifのバイト列, このツールで保存したAPP11セグメントのデータのリスト)を返す
+    画像データの手前で探索を終える
+    """
+    exif = None
+    metadata_segments = []
+    f.seek(2)
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            break
+        # フィルバイト(0xFF)を読み飛ばす
+        while marker[1] == 0xFF:
+            marker = marker[1:] + f.read(1)
+            if len(marker) < 2:
+                break
+        if len(marker) < 2 or marker[1] in (0xD9, 0xDA):
+            # EOI, SOS(画像データの開始)
+            break
+        if marker[1] == 0x01 or 0xD0 <= marker[1] <= 0xD7:
+            # 長さを持たないマーカー
+            continue
+        length = struct.unpack(">H", f.read(2))[0]
+        if marker[1] == 0xE1 and exif is None:
+            data = f.read(length - 2)
+            if data.startswith(EXIF_HEADER):
+                exif = data
+        elif marker[1] == 0xEB:
+            data = f.read(length - 2)
+            if is_jpeg_metadata_segment(data):
+                metadata_segments.append(data)
+        else:
+            f.seek(length - 2, os.SEEK_CUR)
+    return exif, metadata_segments
+
+
+def read_webp_exif(f):
+    """
+    webpのEXIFチャンクを探し、Exifのバイト列を返す
+    """
+    f.seek(12)
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            return None
+        chunk_type, length = struct.unpack("<4sI", header)
+        if chunk_type == b"EXIF":
+            return f.read(length)
+        # チャンクは偶数バイトに揃えられている
+        f.seek(length + (length & 1), os.SEEK_CUR)
+
+
+def iter_boxes(data, offset=0, end=None):
+    """
+    ISOBMFF(avif)のボックスを順に(タイプ, データの開始位置, 終了位置)として返す
+    """
+    end = len(data) if end is None else end
+    while offset + 8 <= end:
+        size, box_type = struct.unpack(">I4s", data[offset:offset + 8])
+        header_size = 8
+        if size == 1:
+            size = struct.unpack(">Q", data[offset + 8:offset + 16])[0]
+            header_size = 16
+        elif size == 0:
+            size = end - offset
+        if size < header_size:
+            return
+        yield box_type, offset + header_size, offset + size
+        offset += size
+
+
+def read_uint(data, offset, size):
+    if size == 0:
+        return 0, offset
+    return int.from_bytes(data[offset:offset + size], "big"), offset + size
+
+
+def find_avif_exif_item(meta, start, end):
+    """
+    metaボックスのiinf・ilocから、Exifアイテムの(ファイル内の位置, 長さ)のリストを返す
+    """
+    exif_item_ids = set()
+    locations = {}
+    # metaはフルボックスのため、バージョン・フラグの4バイトを読み飛ばす
+    for box_type, box_start, box_end in iter_boxes(meta, start + 4, end):
+        if box_type == b"iinf":
+            version = meta[box_start]
+            entry_start = box_start + 4 + (2 if version == 0 else 4)
+            for entry_type, infe_start, _ in iter_boxes(meta, entry_start, box_end):
+                if entry_type != b"infe" or meta[infe_start] < 2:
+                    continue
+                id_size = 2 if meta[infe_start] == 2 else 4
+                item_id, offset = read_uint(meta, infe_start + 4, id_size)
+                # item_protection_indexの後にアイテムの種類が続く
+                item_type = meta[offset + 2:offset + 6]
+                if item_type == b"Exif":
+                    exif_item_ids.add(item_id)
+        elif box_type == b"iloc":
+            version = meta[box_start]
+            offset = box_start + 4
+            offset_size = meta[offset] >> 4
+            length_size = meta[offset] & 0x0F
+            base_offset_size = meta[offset + 1] >> 4
+            index_size = meta[offset + 1] & 0x0F if version in (1, 2) else 0
+            offset += 2
+            item_count, offset = read_uint(meta, offset, 2 if version < 2 else 4)
+            for _ in range(item_count):
+                item_id, offset = read_uint(meta, offset, 2 if version < 2 else 4)
+                construction_method = 0
+                if version in (1, 2):
+                    construction_method, offset = read_uint(meta, offset, 2)
+                    construction_method &= 0x0F
+                # data_reference_index
+                offset += 2
+                base_offset, offset = read_uint(meta, offset, base_offset_size)
+                extent_count, offset = read_uint(meta, offset, 2)
+                extents = []
+                for _ in range(extent_count):
+                    if index_size:
+                        offset += index_size
+                    extent_offset, offset = read_uint(meta, offset, offset_size)
+                    extent_length, offset = read_uint(meta, offset, length_size)
+                    extents.append((base_offset + extent_offset, extent_length))
+                # ファイル内の位置で指定されたアイテムのみ対象にする
+                if construction_method == 0:
+                    locations[item_id] = extents
+    for item_id in sorted(exif_item_ids):
+        if item_id in locations:
+            return locations[item_id]
+    return None
+
+
+def read_avif_exif(f):
+    """
+    avifのExifアイテムを探し、Exifのバイト列を返す(mdatボックスは読み飛ばす)
+    """
+    f.seek(0)
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            return None
+        size, box_type = struct.unpack(">I4s", header)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack(">Q", f.read(8))[0]
+            header_size = 16
+        elif size == 0:
+            return None
+        if box_type != b"meta":
+            f.seek(size - header_size, os.SEEK_CUR)
+            continue
+        meta = header + f.read(size - header_size)
+        extents = find_avif_exif_item(meta, header_size, len(meta))
+        if not extents:
+            return None
+        data = b""
+        for extent_offset, extent_length in extents:
+            f.seek(extent_offset)
+            data += f.read(extent_length)
+        # 先頭4バイトはTIFFヘッダーまでのオフセット
+        tiff_offset = struct.unpack(">I", data[:4])[0]
+        return data[4 + tiff_offset:]
+
+
+def read_user_comment(exif):
+    """
+    Exifのバイト列からUserCommentを読み込む。ない場合はNoneを返す
+    """
+    if exif.startswith(EXIF_HEADER):
+        exif = exif[len(EXIF_HEADER):]
+    if exif[:4] == b"II*\x00":
+        endian = "<"
+    elif exif[:4] == b"MM\x00*":
+        endian = ">"
+    else:
+        return None
+
+    def read_ifd(offset):
+        # {タグ: (型, 要素数, 値またはオフセットの位置)}
+        entries = {}
+        count = struct.unpack(endian + "H", exif[offset:offset + 2])[0]
+        for i in range(count):
+            entry = offset + 2 + i * 12
+            tag, value_type, value_count = struct.unpack(
+                endian + "HHI", exif[entry:entry + 8])
+            entries[tag] = (value_type, value_count, entry + 8)
+        return entries
+
+    def read_value(value_type, value_count, position):
+        size = TIFF_TYPE_SIZES.get(value_type, 1) * value_count
+        if size > 4:
+            position = struct.unpack(endian + "I", exif[position:position + 4])[0]
+        return exif[position:position + size]
+
+    ifd0 = read_ifd(struct.unpack(endian + "I", exif[4:8])[0])
+    if EXIF_IFD_POINTER_TAG not in ifd0:
+        return None
+    exif_ifd_offset = struct.unpack(endian + "I", read_value(*ifd0[EXIF_IFD_POINTER_TAG]))[0]
+    exif_ifd = read_ifd(exif_ifd_offset)
+    if USER_COMMENT_TAG not in exif_ifd:
+        return None
+    user_comment = read_value(*exif_ifd[USER_COMMENT_TAG])
+    encoding = USER_COMMENT_ENCODINGS.get(user_comment[:8])
+    if encoding is None:
+        raise ValueError("unable to determine the encoding of UserComment")
+    return user_comment[8:].decode(encoding, errors="replace")
+
+
+def read_metadata(input_path):
+    """
+    画像のプロンプト(メタデータ)を、ピクセルをデコードせずに読み込む
+    extract_metadataと同じ形式(pngはテキストチャンク、jpg, webp, avifは{"parameters": UserComment})で、
+    NovelAI・ComfyUIの画像を変換したことがあった場合は元の形式に復元して返す
+    画像形式は拡張子ではなくファイルの先頭のバイト列から判定する
+    """
+    with open(input_path, "rb") as f:
+        head = f.read(12)
+        if head.startswith(PNG_SIGNATURE):
+            metadata = read_png_text(f)
+        else:
+            large_metadata = None
+            if head.startswith(b"\xff\xd8"):
+                exif, metadata_segments = read_jpeg_segments(f)
+                large_metadata = parse_jpeg_metadata_segments(metadata_segments)
+            elif head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+                exif = read_webp_exif(f)
+            elif head[4:8] == b"ftyp":
+                exif = read_avif_exif(f)
+            else:
+                raise ValueError("unsupported image format")
+            metadata = {}
+            if large_metadata is not None:
+                metadata = {"parameters": large_metadata}
+            elif exif:
+                user_comment = read_user_comment(exif)
+                if user_comment is not None:
+                    metadata = {"parameters": user_comment}
+    return restore_metadata(metadata)
+
+
+def read_metadata_or_error(input_path, read_function=read_metadata):
+    """
+    (入力ファイルパス, メタデータ, エラーメッセージ)を返す
+    """
+    try:
+        return input_path, read_function(input_path), None
+    except Exception as e:
+        return input_path, None, f"{type(e).__name__}: {e}"
+
+
+def iter_metadata(input_paths, max_workers, read_function=read_metadata):
+    """
+    複数の画像のメタデータを並行して読み込み、入力の順に
+    (入力ファイルパス, メタデータ, エラーメッセージ)を返す
+    読み込み中の画像の数を制限するため、大量の画像でもメモリ使用量が増えない
+    read_functionを指定した場合は、read_metadataの代わりにその関数で読み込む
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = collections.deque()
+        for input_path in input_paths:
+            futures.append(executor.submit(read_metadata_or_error, input_path, read_function))
+            if len(futures) >= max_workers * PENDING_PER_WORKER:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
@@ -0,0 +1,185 @@
+import contextlib
+import os
+import shutil
+import struct
+import threading
+
+import image_converter.exts as exts
+
+# 入力画像が既に出力形式・設定を満たしている場合に、再エンコードせずにファイルをコピーする(パススルー)
+# 再エンコードによる画質の劣化とCPU時間を避ける
+# - off: パススルーしない(常に再エンコードする)
+# - copy: reflink、copy_file_range、通常のコピーの順に、ファイルシステムが対応している方法でコピーする
+# - link: ハードリンクを作成する(作成できない場合はcopyと同じ方法でコピーする)
+PASSTHROUGH_OFF = "off"
+PASSTHROUGH_COPY = "copy"
+PASSTHROUGH_LINK = "link"
+PASSTHROUGH_POLICIES = (PASSTHROUGH_OFF, PASSTHROUGH_COPY, PASSTHROUGH_LINK)
+
+# コピーに使用した方法
+METHOD_HARDLINK = "hardlink"
+METHOD_REFLINK = "reflink"
+METHOD_COPY_FILE_RANGE = "copy_file_range"
+METHOD_COPY = "copy"
+
+# Pillowの画像形式と拡張子の対応
+IMAGE_FORMAT_EXTS = {
+    "PNG": exts.PNG_EXT,
+    "JPEG": exts.JPG_EXT,
+    "WEBP": exts.WEBP_EXT,
+    "AVIF": exts.AVIF_EXT,
+}
+# libjpegの品質50の輝度の量子化テーブルの合計(品質の推定に使う)
+JPEG_STANDARD_LUMINANCE_SUM = 3688
+# LinuxのFICLONE(reflink)のioctl
+FICLONE = 0x40049409
+# copy_file_rangeで1回にコピーする最大サイズ
+COPY_CHUNK_SIZE = 1024 * 1024 * 1024
+
+
+def estimate_jpeg_quality(image):
+    """
+    jpgの輝度の量子化テーブルから、保存時の品質(1-100)を推定する
+    量子化テーブルがない場合はNoneを返す
+    """
+    tables = getattr(image, "quantization", None)
+    if not tables or 0 not in tables:
+        return None
+    # libjpegは品質qのとき、標準のテーブルを q < 50 なら 5000/q %、それ以外は 200-2q % に拡大・縮小する
+    scale = sum(tables[0]) * 100 / JPEG_STANDARD_LUMINANCE_SUM
+    if scale <= 100:
+        quality = (200 - scale) / 2
+    else:
+        quality = 5000 / scale
+    return max(1, min(100, round(quality)))
+
+
+def is_webp_lossless(input_path):
+    """
+    webpの画像データのチャンクがVP8L(可逆圧縮)かどうかを判定する
+    """
+    with open(input_path, "rb") as f:
+        f.seek(12)
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return False
+            chunk_type, length = struct.unpack("<4sI", header)
+            if chunk_type == b"VP8L":
+                return True
+            if chunk_type == b"VP8 ":
+                return False
+            # チャンクは偶数バイトに揃えられている
+            f.seek(length + (length & 1), os.SEEK_CUR)
+
+
+def has_transparency(image):
+    return image.mode in ("RGBA", "LA", "PA") or (
+        image.mode == "P" and "transparency" in image.info)
+
+
+def can_pass_through(image, input_path, output_format, quality, lossless, is_fill_color):
+    """
+    入力画像(Image.openで開いたのみで、デコードしていない画像)を再エンコードせずに出力できるかを判定する
+    - 入力と出力の画像形式が同じ
+    - 透過部分の塗りつぶしが必要ない
+    - 可逆圧縮かどうかが同じ(pngは常に可逆圧縮、jpgは非可逆圧縮として扱う)
+    - jpgは推定した入力の品質が出力の品質以下(再エンコードしてもファイルサイズが小さくならない)
+    webp・avifの非可逆圧縮は入力の品質が分からず、指定した品質より高い品質の画像を
+    そのまま出力してしまう可能性があるため、パススルーしない
+    """
+    if IMAGE_FORMAT_EXTS.get(image.format) != output_format:
+        return False
+    if is_fill_color and has_transparency(image):
+        return False
+    if output_format == exts.PNG_EXT:
+        return True
+    if output_format == exts.JPG_EXT:
+        source_quality = estimate_jpeg_quality(image)
+        return source_quality is not None and source_quality <= quality
+    if output_format == exts.WEBP_EXT:
+        return bool(lossless) and is_webp_lossless(input_path)
+    return False
+
+
+def needs_metadata_normalization(metadata):
+    """
+    NovelAI・ComfyUIのメタデータが以前のバージョンの形式(dictの文字列)で保存されているかを判定する
+    (その場合はパススルーせずに再エンコードして、現在の形式で保存し直す)
+    """
+    parameters = metadata.get("parameters")
+    if not isinstance(parameters, str):
+        return False
+    for tag in ("NAI:", "ComfyUI:"):
+        # メタデータはparametersの末尾に保存されている
+        index = parameters.rfind(tag)
+        if index != -1 and not parameters[index + len(tag):].lstrip().startswith('{"v"'):
+            return True
+    return False
+
+
+def reflink(input_path, output_path):
+    """
+    copy-on-writeのファイルシステム(Btrfs, XFSなど)で、データを共有したコピーを作成する
+    """
+    import fcntl
+    with open(input_path, "rb") as src, open(output_path, "wb") as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def copy_with_copy_file_range(input_path, output_path):
+    """
+    カーネル内でデータをコピーする(ユーザー空間にデータを読み込まない)
+    """
+    with open(input_path, "rb") as src, open(output_path, "wb") as dst:
+        while os.copy_file_range(src.fileno(), dst.fileno(), COPY_CHUNK_SIZE):
+            pass
+
+
+@contextlib.contextmanager
+def replace_output(output_path):
+    """
+    出力先に直接書き込まず、同じフォルダの一時ファイルに書き込んでから出力先と置き換える
+    出力先が入力ファイルやキャッシュのハードリンクの場合でも、リンク先の内容は書き換わらない
+    """
+    temp_path = f"{output_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        yield temp_path
+        os.replace(temp_path, output_path)
+    finally:
+        # 書き込みに失敗した場合、または出力先が既に同じファイルのハードリンクだった場合
+        if os.path.lexists(temp_path):
+            os.remove(temp_path)
+
+
+def copy_file(input_path, output_path, policy):
+    """
+    policyに従って入力ファイルを出力先にコピーし、使用した方法を返す
+    出力先が既にある場合は、上書きせずに置き換える
+    """
+    with replace_output(output_path) as temp_path:
+        return copy_to_new_file(input_path, temp_path, policy)
+
+
+def copy_to_new_file(input_path, output_path, policy):
+    """
+    policyに従って入力ファイルを新しいファイルにコピーし、使用した方法を返す
+    対応していない方法は順に諦め、最後は通常のコピーを行う
+    """
+    if policy == PASSTHROUGH_LINK:
+        try:
+            os.link(input_path, output_path)
+            return METHOD_HARDLINK
+        except OSError:
+            # 別のドライブ、ハードリンクに対応していないファイルシステムなど
+            pass
+    if hasattr(os, "copy_file_range"):
+        for method, function in ((METHOD_REFLINK, reflink),
+                                 (METHOD_COPY_FILE_RANGE, copy_with_copy_file_range)):
+            try:
+                function(input_path, output_path)
+                return method
+            except (OSError, ImportError):
+                pass
+    shutil.copyfile(input_path, output_path)
+    return METHOD_COPY
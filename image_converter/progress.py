@@ -0,0 +1,131 @@
+import threading
+import time
+
+# イベントの種類
+STARTED = "started"
+FILE_DONE = "file_done"
+FILE_FAILED = "file_failed"
+FINISHED = "finished"
+
+
+class ProgressStream:
+    """
+    変換処理の進捗をイベントとして購読者(GUI・CLI・ログなど)に通知する
+    ファイルごとのイベントは集計だけ行い、購読者には指定した間隔ごとに集計結果(スナップショット)を通知する
+    started・finishedイベントは間隔に関係なく必ず通知する
+    """
+
+    def __init__(self):
+        # [callback, 通知間隔(秒), 最後に通知した時刻]
+        self.subscribers = []
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.start_time = time.monotonic()
+        self.done = 0
+        self.failed = 0
+        # 再エンコードせずにコピーした画像の数
+        self.passed_through = 0
+        # キャッシュから取り出した画像の数
+        self.cache_hits = 0
+        # 重複した画像の変換結果をリンクした画像の数
+        self.duplicates = 0
+        self.total = 0
+        self.is_scan_done = False
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.is_error = False
+        self.message = ""
+
+    def subscribe(self, callback, interval=0.1):
+        """
+        callback(event, snapshot)を登録する
+        intervalが0の場合は全てのイベントを、Noneの場合はstarted・finishedイベントのみを通知する
+        """
+        with self.lock:
+            self.subscribers.append([callback, interval, 0.0])
+
+    def unsubscribe(self, callback):
+        with self.lock:
+            self.subscribers = [
+                subscriber for subscriber in self.subscribers if subscriber[0] != callback]
+
+    def started(self):
+        self.reset()
+        self.publish(STARTED, force=True)
+
+    def set_total(self, total, is_scan_done):
+        """
+        投入済みの画像の合計枚数を更新する(探索しながら変換するため、探索が完了するまで増えていく)
+        """
+        self.total = total
+        self.is_scan_done = is_scan_done
+
+    def file_done(self, result):
+        self.done += 1
+        if "passthrough" in result:
+            self.passed_through += 1
+        if result.get("cache") == "hit":
+            self.cache_hits += 1
+        if "duplicate_of" in result:
+            self.duplicates += 1
+        self.bytes_in += result["input_size"]
+        self.bytes_out += result["output_size"]
+        self.publish(FILE_DONE, result)
+
+    def file_failed(self, input_path):
+        self.failed += 1
+        self.publish(FILE_FAILED, {"input_path": input_path})
+
+    def finished(self, is_error, message):
+        self.is_error = is_error
+        self.message = message
+        self.is_scan_done = True
+        self.publish(FINISHED, force=True)
+
+    def snapshot(self, event=None, detail=None):
+        """
+        現在の進捗の集計結果を取得する
+        """
+        elapsed = time.monotonic() - self.start_time
+        processed = self.done + self.failed
+        files_per_sec = processed / elapsed if elapsed > 0 else 0.0
+        eta = None
+        if self.is_scan_done and files_per_sec > 0:
+            eta = max(0, self.total - processed) / files_per_sec
+        return {
+            "event": event,
+            "detail": detail,
+            "done": self.done,
+            "failed": self.failed,
+            "passed_through": self.passed_through,
+            "cache_hits": self.cache_hits,
+            "duplicates": self.duplicates,
+            "processed": processed,
+            "total": self.total,
+            "is_scan_done": self.is_scan_done,
+            "elapsed_sec": elapsed,
+            "files_per_sec": files_per_sec,
+            "mb_per_sec": self.bytes_in / 1024 / 1024 / elapsed if elapsed > 0 else 0.0,
+            "eta_sec": eta,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "bytes_saved": self.bytes_in - self.bytes_out,
+            "is_error": self.is_error,
+            "message": self.message,
+        }
+
+    def publish(self, event, detail=None, force=False):
+        if not self.subscribers:
+            return
+        now = time.monotonic()
+        snapshot = None
+        for subscriber in self.subscribers:
+            callback, interval, last_time = subscriber
+            if not force and (interval is None or now - last_time < interval):
+                continue
+            subscriber[2] = now
+            if snapshot is None:
+                snapshot = self.snapshot(event, detail)
+            callback(event, snapshot)
@@ -0,0 +1,298 @@
+import json
+import os
+import re
+import sqlite3
+import sys
+import time
+
+from image_converter.metadata_reader import iter_metadata, read_metadata
+from image_converter.scheduler import read_image_header
+
+# プロンプトの生成元
+SOURCE_WEBUI = "WebUI"
+SOURCE_NOVELAI = "NovelAI"
+SOURCE_COMFYUI = "ComfyUI"
+
+# WebUIの "Steps: 20, Sampler: Euler a, ..." を分割する(値はダブルクォートで囲まれている場合がある)
+WEBUI_PARAM_PATTERN = re.compile(r'\s*([\w ]+):\s*("(?:\\.|[^\\"])+"|[^,]*)(?:,|$)')
+NEGATIVE_PROMPT_PREFIX = "Negative prompt:"
+
+
+def to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_webui_parameters(parameters):
+    """
+    WebUIのparameters(プロンプト、Negative prompt、生成設定の3つの部分)を分解する
+    """
+    lines = parameters.strip().split("\n")
+    settings = {}
+    # 最後の行が生成設定(Steps: ...)の場合のみ分解する
+    if lines and len(WEBUI_PARAM_PATTERN.findall(lines[-1])) >= 3:
+        settings = dict(WEBUI_PARAM_PATTERN.findall(lines.pop()))
+    prompt_lines = []
+    negative_lines = None
+    for line in lines:
+        if negative_lines is None and line.startswith(NEGATIVE_PROMPT_PREFIX):
+            negative_lines = [line[len(NEGATIVE_PROMPT_PREFIX):].strip()]
+        elif negative_lines is not None:
+            negative_lines.append(line)
+        else:
+            prompt_lines.append(line)
+    return {
+        "prompt": "\n".join(prompt_lines).strip(),
+        "negative_prompt": "\n".join(negative_lines).strip() if negative_lines else "",
+        "seed": to_int(settings.get("Seed")),
+        "sampler": settings.get("Sampler"),
+        "steps": to_int(settings.get("Steps")),
+    }
+
+
+def parse_novelai_metadata(metadata):
+    comment = metadata.get("Comment", "{}")
+    if isinstance(comment, str):
+        comment = json.loads(comment)
+    return {
+        "prompt": metadata.get("Description", comment.get("prompt", "")),
+        "negative_prompt": comment.get("uc", ""),
+        "seed": to_int(comment.get("seed")),
+        "sampler": comment.get("sampler"),
+        "steps": to_int(comment.get("steps")),
+    }
+
+
+def parse_comfyui_metadata(metadata):
+    """
+    ComfyUIのprompt(ノードのグラフ)から、サンプラーのノードにつながっているテキストを取り出す
+    """
+    graph = metadata.get("prompt", "{}")
+    if isinstance(graph, str):
+        graph = json.loads(graph)
+    fields = {"prompt": "", "negative_prompt": "", "seed": None, "sampler": None, "steps": None}
+
+    def linked_text(link):
+        # 入力が [ノードID, 出力番号] の場合、つながっているノードのテキストを返す
+        if isinstance(link, list) and link:
+            node = graph.get(str(link[0]), {})
+            text = node.get("inputs", {}).get("text")
+            if isinstance(text, str):
+                return text
+        return ""
+
+    for node in graph.values():
+        if not isinstance(node, dict) or "KSampler" not in node.get("class_type", ""):
+            continue
+        inputs = node.get("inputs", {})
+        fields["prompt"] = linked_text(inputs.get("positive"))
+        fields["negative_prompt"] = linked_text(inputs.get("negative"))
+        fields["seed"] = to_int(inputs.get("seed", inputs.get("noise_seed")))
+        fields["sampler"] = inputs.get("sampler_name")
+        fields["steps"] = to_int(inputs.get("steps"))
+        break
+
+    if not fields["prompt"]:
+        # サンプラーのノードが見つからない場合は、全てのテキストを対象にする
+        texts = [node.get("inputs", {}).get("text") for node in graph.values()
+                 if isinstance(node, dict)]
+        fields["prompt"] = "\n".join(text for text in texts if isinstance(text, str))
+    return fields
+
+
+def parse_prompt_metadata(metadata):
+    """
+    メタデータから(生成元, {prompt, negative_prompt, seed, sampler, steps})を返す
+    プロンプトがない場合は(None, 空の値)を返す
+    """
+    if metadata.get("Software") == "NovelAI":
+        return SOURCE_NOVELAI, parse_novelai_metadata(metadata)
+    if "prompt" in metadata or "workflow" in metadata:
+        return SOURCE_COMFYUI, parse_comfyui_metadata(metadata)
+    if metadata.get("parameters"):
+        return SOURCE_WEBUI, parse_webui_parameters(metadata["parameters"])
+    return None, {"prompt": "", "negative_prompt": "", "seed": None, "sampler": None, "steps": None}
+
+
+def read_index_entry(input_path):
+    """
+    画像のヘッダーとメタデータを読み込み、インデックスに登録する値を返す
+    """
+    header = read_image_header(input_path)
+    width, height = header[:2] if header else (None, None)
+    metadata = read_metadata(input_path)
+    try:
+        source, fields = parse_prompt_metadata(metadata)
+    except (ValueError, AttributeError, TypeError):
+        # メタデータの形式が想定と異なる場合は、プロンプトなしとして登録する
+        source, fields = parse_prompt_metadata({})
+    return {
+        "width": width,
+        "height": height,
+        "source": source,
+        **fields,
+    }
+
+
+class PromptIndex:
+    """
+    画像のパス・サイズ・更新日時・画像サイズ・生成元・プロンプトなどをSQLiteに保存し、
+    FTS5でプロンプトを全文検索できるようにする
+    サイズ・更新日時が前回から変わった画像のみ読み込み直すため、2回目以降は差分のみ更新される
+    """
+    VERSION = 1
+    BATCH_SIZE = 1000
+    COLUMNS = ("path", "size", "mtime_ns", "width", "height", "source",
+               "prompt", "negative_prompt", "seed", "sampler", "steps")
+
+    def __init__(self, database_path):
+        self.connection = sqlite3.connect(database_path)
+        self.connection.row_factory = sqlite3.Row
+        self.create_tables()
+
+    def create_tables(self):
+        self.connection.executescript("""
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+            CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS images (
+                id INTEGER PRIMARY KEY,
+                path TEXT NOT NULL UNIQUE,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                width INTEGER,
+                height INTEGER,
+                source TEXT,
+                prompt TEXT,
+                negative_prompt TEXT,
+                seed INTEGER,
+                sampler TEXT,
+                steps INTEGER
+            );
+            CREATE VIRTUAL TABLE IF NOT EXISTS images_fts USING fts5(
+                prompt, negative_prompt, content='images', content_rowid='id');
+            -- imagesの変更を全文検索のインデックスに反映する
+            CREATE TRIGGER IF NOT EXISTS images_ai AFTER INSERT ON images BEGIN
+                INSERT INTO images_fts(rowid, prompt, negative_prompt)
+                VALUES (new.id, new.prompt, new.negative_prompt);
+            END;
+            CREATE TRIGGER IF NOT EXISTS images_ad AFTER DELETE ON images BEGIN
+                INSERT INTO images_fts(images_fts, rowid, prompt, negative_prompt)
+                VALUES ('delete', old.id, old.prompt, old.negative_prompt);
+            END;
+            CREATE TRIGGER IF NOT EXISTS images_au AFTER UPDATE ON images BEGIN
+                INSERT INTO images_fts(images_fts, rowid, prompt, negative_prompt)
+                VALUES ('delete', old.id, old.prompt, old.negative_prompt);
+                INSERT INTO images_fts(rowid, prompt, negative_prompt)
+                VALUES (new.id, new.prompt, new.negative_prompt);
+            END;
+        """)
+        row = self.connection.execute("SELECT value FROM info WHERE key = 'version'").fetchone()
+        if row is None:
+            self.connection.execute(
+                "INSERT INTO info (key, value) VALUES ('version', ?)", (str(self.VERSION),))
+            self.connection.commit()
+        elif int(row["value"]) != self.VERSION:
+            raise ValueError(f"unsupported index version: {row['value']}")
+
+    def update(self, input_paths, root=None, max_workers=8, is_subfolders=True):
+        """
+        input_pathsの画像をインデックスに登録する
+        サイズ・更新日時が前回と同じ画像は読み込まず、rootを指定した場合は
+        root以下(is_subfoldersがFalseの場合はroot直下のみ)で見つからなかった(削除された)画像を
+        インデックスから削除する
+        {"added", "updated", "unchanged", "removed", "errors"}の件数を返す
+        """
+        stats = {"added": 0, "updated": 0, "unchanged": 0, "removed": 0, "errors": 0}
+        known = {row["path"]: (row["size"], row["mtime_ns"])
+                 for row in self.connection.execute("SELECT path, size, mtime_ns FROM images")}
+        seen = set()
+        file_stats = {}
+
+        def iter_changed_paths():
+            for input_path in input_paths:
+                input_path = os.path.abspath(input_path)
+                seen.add(input_path)
+                try:
+                    stat = os.stat(input_path)
+                except OSError:
+                    continue
+                file_stat = (stat.st_size, stat.st_mtime_ns)
+                if known.get(input_path) == file_stat:
+                    stats["unchanged"] += 1
+                    continue
+                file_stats[input_path] = file_stat
+                yield input_path
+
+        rows = []
+        for input_path, entry, error in iter_metadata(
+                iter_changed_paths(), max_workers, read_index_entry):
+            file_stat = file_stats.pop(input_path)
+            if error is not None:
+                stats["errors"] += 1
+                print(f"[Error] '{input_path}' の読み込みに失敗しました\n{error}", file=sys.stderr)
+                continue
+            stats["updated" if input_path in known else "added"] += 1
+            rows.append((input_path, *file_stat, entry["width"], entry["height"], entry["source"],
+                         entry["prompt"], entry["negative_prompt"], entry["seed"],
+                         entry["sampler"], entry["steps"]))
+            if len(rows) >= self.BATCH_SIZE:
+                self.write_rows(rows)
+                rows = []
+        self.write_rows(rows)
+
+        if root is not None:
+            root = os.path.abspath(root)
+
+            def is_in_scope(path):
+                # サブフォルダを探索しない場合、サブフォルダ内の画像は見つからなくても削除されたとは限らない
+                if is_subfolders:
+                    return path.startswith(os.path.join(root, ""))
+                return os.path.dirname(path) == root
+
+            removed = [(path,) for path in known
+                       if path not in seen and is_in_scope(path)]
+            self.connection.executemany("DELETE FROM images WHERE path = ?", removed)
+            stats["removed"] = len(removed)
+        self.connection.execute(
+            "INSERT OR REPLACE INTO info (key, value) VALUES ('updated_at', ?)", (str(time.time()),))
+        self.connection.commit()
+        return stats
+
+    def write_rows(self, rows):
+        if not rows:
+            return
+        columns = ", ".join(self.COLUMNS)
+        placeholders = ", ".join("?" for _ in self.COLUMNS)
+        updates = ", ".join(f"{column} = excluded.{column}" for column in self.COLUMNS[1:])
+        self.connection.executemany(
+            f"INSERT INTO images ({columns}) VALUES ({placeholders}) "
+            f"ON CONFLICT(path) DO UPDATE SET {updates}", rows)
+        self.connection.commit()
+
+    def search(self, query, limit=20):
+        """
+        プロンプト・Negative promptを全文検索し、一致度の高い順に返す
+        queryはFTS5の検索式("1girl AND smile"、"negative_prompt: lowres"など)
+        検索式として解釈できない場合("smile, blue sky"など)は、カンマ区切りのタグを全て含む画像を検索する
+        """
+        try:
+            return self.match(query, limit)
+        except sqlite3.OperationalError:
+            tags = [tag.strip() for tag in query.split(",")]
+            # タグごとに"で囲み、フレーズとして検索する("は""にエスケープする)
+            phrases = " ".join('"{}"'.format(tag.replace('"', '""')) for tag in tags if tag)
+            if not phrases:
+                return []
+            return self.match(phrases, limit)
+
+    def match(self, query, limit):
+        rows = self.connection.execute(
+            "SELECT images.* FROM images_fts JOIN images ON images.id = images_fts.rowid "
+            "WHERE images_fts MATCH ? ORDER BY bm25(images_fts) LIMIT ?", (query, limit))
+        return [{column: row[column] for column in self.COLUMNS} for row in rows]
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,215 @@
+import collections
+import csv
+import os
+import threading
+import time
+
+import psutil
+
+# 時系列ファイルの列
+# roleは main(親プロセス)、worker(変換処理のプロセス)、system(システム全体)のいずれか
+# read_mb, write_mbは前回の計測からの増分、cpu_percentは100で1コア分
+SAMPLE_FIELDS = ("elapsed_sec", "role", "pid", "rss_mb",
+                 "cpu_percent", "iowait_percent", "read_mb", "write_mb")
+MAIN_ROLE = "main"
+WORKER_ROLE = "worker"
+SYSTEM_ROLE = "system"
+
+
+class RunningStat:
+    """
+    計測値の最大値と平均値を、全ての値を保持せずに求める
+    """
+
+    def __init__(self):
+        self.peak = 0.0
+        self.total = 0.0
+        self.count = 0
+
+    def add(self, value):
+        self.peak = max(self.peak, value)
+        self.total += value
+        self.count += 1
+
+    def to_dict(self):
+        mean = self.total / self.count if self.count else 0.0
+        return {"peak": round(self.peak, 3), "mean": round(mean, 3)}
+
+
+def to_mb(value):
+    return round(value / 1024 / 1024, 3)
+
+
+class ResourceMonitor:
+    """
+    変換処理中に一定間隔で、プロセスごとのメモリ使用量(RSS)・CPU使用率・読み書きしたバイト数と、
+    システム全体のCPU使用率・I/O待ちの割合を計測する
+    pathを指定した場合は、計測値をCSVの時系列ファイルに追記していく
+    stop()で最大値・平均値の集計結果を返す
+    """
+
+    def __init__(self, path=None, interval=0.5):
+        self.path = path
+        self.interval = interval
+        self.worker_pool = None
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.file = None
+        self.writer = None
+        self.start_time = None
+        # pid -> psutil.Process(cpu_percentは同じオブジェクトで前回からの使用率を求めるため保持する)
+        self.processes = {}
+        # pid -> 前回計測時の(読み込み, 書き込み)バイト数
+        self.last_io = {}
+        self.last_disk_io = None
+        self.samples = 0
+        self.workers_peak = 0
+        self.read_bytes = 0
+        self.write_bytes = 0
+        self.stats = collections.defaultdict(RunningStat)
+
+    def start(self, worker_pool):
+        """
+        worker_poolのプロセスの計測を開始する(プロセスが入れ替わった場合も追跡する)
+        """
+        self.worker_pool = worker_pool
+        self.start_time = time.monotonic()
+        if self.path:
+            self.file = open(self.path, "w", encoding="utf-8", newline="")
+            self.writer = csv.writer(self.file)
+            self.writer.writerow(SAMPLE_FIELDS)
+        # 初回の呼び出しは基準値の取得のみ行われるため、開始時に呼び出しておく
+        psutil.cpu_percent()
+        psutil.cpu_times_percent()
+        self.last_disk_io = psutil.disk_io_counters()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.sample()
+            except Exception as e:
+                print(f"[Error] リソース使用量の計測に失敗しました\n{e}")
+
+    def stop(self):
+        """
+        計測を終了し、集計結果を返す
+        """
+        if self.thread is not None:
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
+            # 計測間隔より短い変換処理でも値が残るように、終了時にも計測する
+            try:
+                self.sample()
+            except Exception as e:
+                print(f"[Error] リソース使用量の計測に失敗しました\n{e}")
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        return self.summary()
+
+    def sample_process(self, pid, role, elapsed):
+        """
+        1つのプロセスを計測し、(RSS, CPU使用率)を返す。終了したプロセスの場合はNoneを返す
+        """
+        try:
+            process = self.processes.get(pid)
+            if process is None:
+                process = psutil.Process(pid)
+                process.cpu_percent()
+                self.processes[pid] = process
+                cpu_percent = 0.0
+            else:
+                cpu_percent = process.cpu_percent()
+            rss = process.memory_info().rss
+            try:
+                io = process.io_counters()
+                io_bytes = (io.read_bytes, io.write_bytes)
+            except (AttributeError, psutil.AccessDenied):
+                # macOSなどではプロセスごとの読み書きの量を取得できない
+                io_bytes = (0, 0)
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            self.processes.pop(pid, None)
+            self.last_io.pop(pid, None)
+            return None
+
+        last_read, last_write = self.last_io.get(pid, io_bytes)
+        read_delta = io_bytes[0] - last_read
+        write_delta = io_bytes[1] - last_write
+        self.last_io[pid] = io_bytes
+        self.read_bytes += read_delta
+        self.write_bytes += write_delta
+        if self.writer is not None:
+            self.writer.writerow((round(elapsed, 3), role, pid, to_mb(rss),
+                                  round(cpu_percent, 1), "", to_mb(read_delta), to_mb(write_delta)))
+        return rss, cpu_percent
+
+    def sample(self):
+        elapsed = time.monotonic() - self.start_time
+        self.samples += 1
+
+        main = self.sample_process(os.getpid(), MAIN_ROLE, elapsed)
+        total_rss = main[0] if main else 0
+        worker_pids = self.worker_pool.get_pids() if self.worker_pool is not None else []
+        worker_rss = 0
+        worker_cpu = 0.0
+        worker_count = 0
+        for pid in worker_pids:
+            result = self.sample_process(pid, WORKER_ROLE, elapsed)
+            if result is None:
+                continue
+            rss, cpu_percent = result
+            self.stats["worker_rss_mb"].add(rss / 1024 / 1024)
+            worker_rss += rss
+            worker_cpu += cpu_percent
+            worker_count += 1
+        # 終了したプロセスの情報を削除する
+        for pid in set(self.processes) - set(worker_pids) - {os.getpid()}:
+            self.processes.pop(pid, None)
+            self.last_io.pop(pid, None)
+        self.workers_peak = max(self.workers_peak, worker_count)
+        total_rss += worker_rss
+        self.stats["total_rss_mb"].add(total_rss / 1024 / 1024)
+        if worker_count:
+            self.stats["worker_cpu_percent"].add(worker_cpu)
+        elif main:
+            # スレッドで変換する場合は親プロセスのCPU使用率を用いる
+            self.stats["worker_cpu_percent"].add(main[1])
+
+        system_cpu = psutil.cpu_percent()
+        iowait = getattr(psutil.cpu_times_percent(), "iowait", None)
+        disk_io = psutil.disk_io_counters()
+        read_delta = write_delta = 0
+        if disk_io is not None and self.last_disk_io is not None:
+            read_delta = disk_io.read_bytes - self.last_disk_io.read_bytes
+            write_delta = disk_io.write_bytes - self.last_disk_io.write_bytes
+        self.last_disk_io = disk_io
+        self.stats["system_cpu_percent"].add(system_cpu)
+        if iowait is not None:
+            self.stats["iowait_percent"].add(iowait)
+        if self.writer is not None:
+            self.writer.writerow((round(elapsed, 3), SYSTEM_ROLE, "", to_mb(psutil.virtual_memory().used),
+                                  system_cpu, "" if iowait is None else iowait,
+                                  to_mb(read_delta), to_mb(write_delta)))
+            self.file.flush()
+
+    def summary(self):
+        """
+        計測値の最大値・平均値を返す
+        worker_cpu_percentは全ての変換処理のプロセスの合計(100で1コア分)
+        """
+        elapsed = time.monotonic() - self.start_time if self.start_time else 0.0
+        result = {
+            "interval_sec": self.interval,
+            "samples": self.samples,
+            "duration_sec": round(elapsed, 3),
+            "workers_peak": self.workers_peak,
+            "read_mb": to_mb(self.read_bytes),
+            "write_mb": to_mb(self.write_bytes),
+        }
+        for name in ("worker_rss_mb", "total_rss_mb", "worker_cpu_percent",
+                     "system_cpu_percent", "iowait_percent"):
+            result[name] = self.stats[name].to_dict() if name in self.stats else None
+        return result
@@ -0,0 +1,170 @@
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+import image_converter.exts as exts
+from image_converter.worker import load_avif_plugin
+
+# 出力形式ごとの1ピクセルあたりの変換コストの目安(pngを1とした相対値)
+FORMAT_COSTS = {
+    exts.PNG_EXT: 1.0,
+    exts.JPG_EXT: 0.4,
+    exts.WEBP_EXT: 1.5,
+    exts.AVIF_EXT: 6.0,
+}
+# webpの可逆圧縮は非可逆圧縮より重いため、コストを上乗せする
+WEBP_LOSSLESS_COST = 4.0
+# ヘッダーの読み込みに使用するスレッド数
+HEADER_READ_WORKERS = 8
+
+# デコード後の1ピクセルあたりのバイト数(Pillowは複数バンドの画像を1ピクセル4バイトで保持する)
+MODE_BYTES_PER_PIXEL = {
+    "1": 1,
+    "L": 1,
+    "P": 1,
+    "I;16": 2,
+}
+# 出力形式ごとのエンコード時のメモリ使用量の目安(デコード後の画像サイズに対する倍率)
+ENCODE_MEMORY_FACTORS = {
+    exts.PNG_EXT: 1.5,
+    exts.JPG_EXT: 1.0,
+    exts.WEBP_EXT: 2.0,
+    exts.AVIF_EXT: 3.0,
+}
+
+
+def read_image_header(input_path):
+    """
+    画像のヘッダーのみを読み込み、(幅, 高さ, モード)を返す
+    ピクセルのデコードは行わない。読み込めない場合はNoneを返す
+    """
+    try:
+        if input_path.lower().endswith(exts.AVIF_EXT):
+            load_avif_plugin()
+        with Image.open(input_path) as image:
+            width, height = image.size
+            return width, height, image.mode
+    except Exception:
+        return None
+
+
+def estimate_conversion_cost(header, output_format, is_lossless):
+    """
+    画像サイズと出力形式から変換処理の重さを見積もる
+    """
+    if header is None:
+        return 1.0
+    width, height, _ = header
+    if output_format == exts.WEBP_EXT and is_lossless:
+        factor = WEBP_LOSSLESS_COST
+    else:
+        factor = FORMAT_COSTS.get(output_format, 1.0)
+    return max(1.0, width * height * factor)
+
+
+def estimate_peak_memory(header, output_format, is_fill_color):
+    """
+    画像サイズとモードから、変換処理中のメモリ使用量の最大値(バイト)を見積もる
+    デコード後の画像 + 透過部分の塗りつぶし用の画像 + エンコーダーの作業領域
+    """
+    if header is None:
+        return 0
+    width, height, mode = header
+    decoded_size = width * height * MODE_BYTES_PER_PIXEL.get(mode, 4)
+    # 塗りつぶし・jpg向けの変換では別の画像が作成される
+    copies = 2 if is_fill_color or output_format == exts.JPG_EXT else 1
+    return int(decoded_size * (copies + ENCODE_MEMORY_FACTORS.get(output_format, 2.0)))
+
+
+def make_task(input_fullpath, output_fullpath, header, output_format, is_lossless, is_fill_color):
+    """
+    変換タスク(入力ファイルパス, 出力ファイルパス, 変換コスト, メモリ使用量)を作成する
+    """
+    return (input_fullpath,
+            output_fullpath,
+            estimate_conversion_cost(header, output_format, is_lossless),
+            estimate_peak_memory(header, output_format, is_fill_color))
+
+
+def iter_tasks(path_pairs, output_format, is_lossless, is_fill_color, is_read_header):
+    """
+    入出力パスのペアを順に変換タスクにする
+    is_read_headerがFalseの場合はヘッダーを読み込まず、全て同じコストとして扱う
+    """
+    for input_fullpath, output_fullpath in path_pairs:
+        if is_read_header:
+            yield make_task(input_fullpath, output_fullpath, read_image_header(input_fullpath),
+                            output_format, is_lossless, is_fill_color)
+        else:
+            yield input_fullpath, output_fullpath, 1.0, 0
+
+
+def plan_largest_first(path_pairs, output_format, is_lossless, is_fill_color):
+    """
+    全ての画像のヘッダーを並行して読み込み、変換コストの大きい順に並べ替えた変換タスクのリストを返す
+    """
+    path_pairs = list(path_pairs)
+    with ThreadPoolExecutor(max_workers=HEADER_READ_WORKERS) as executor:
+        headers = executor.map(
+            read_image_header, [input_fullpath for input_fullpath, _ in path_pairs])
+        tasks = [make_task(input_fullpath, output_fullpath, header,
+                           output_format, is_lossless, is_fill_color)
+                 for (input_fullpath, output_fullpath), header in zip(path_pairs, headers)]
+    tasks.sort(key=lambda task: task[2], reverse=True)
+    return tasks
+
+
+class PendingTasks:
+    """
+    探索済みで未投入の画像を保持し、1回の変換処理でまとめて変換する単位(チャンク)に分けて取り出す
+    """
+
+    def __init__(self, cpu_num, max_chunk_size, chunk_divisor):
+        self.cpu_num = cpu_num
+        self.max_chunk_size = max_chunk_size
+        self.chunk_divisor = chunk_divisor
+        self.tasks = collections.deque()
+        self.total_cost = 0.0
+        # 全ての画像の探索が完了したか
+        self.is_scan_done = False
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def append(self, input_fullpath, output_fullpath, cost=1.0, memory=0):
+        self.tasks.append((input_fullpath, output_fullpath, cost, memory))
+        self.total_cost += cost
+
+    def take_chunk(self, memory_available=None):
+        """
+        先頭からチャンクを取り出し、(チャンク, チャンクのメモリ使用量)を返す
+        探索中は投入待ちの画像をまとめ(最大max_chunk_size枚)、探索完了後は残りのコストを
+        (プロセス数 x chunk_divisor)個以上に分割できる大きさにして、終盤ほどチャンクを小さくする
+        コストの大きい画像は1枚だけのチャンクになる
+        memory_availableを指定した場合は、メモリ使用量がその値を超える画像を取り出さない
+        (チャンク内の画像は1枚ずつ変換されるため、チャンクのメモリ使用量は最大の画像の値とする)
+        """
+        if self.is_scan_done:
+            cost_budget = self.total_cost / (self.cpu_num * self.chunk_divisor)
+        else:
+            cost_budget = self.total_cost
+
+        chunk = []
+        chunk_cost = 0.0
+        chunk_memory = 0
+        while self.tasks and len(chunk) < self.max_chunk_size:
+            _, _, cost, memory = self.tasks[0]
+            if chunk and chunk_cost + cost > cost_budget:
+                break
+            if memory_available is not None and memory > memory_available:
+                break
+            input_fullpath, output_fullpath, _, _ = self.tasks.popleft()
+            chunk.append((input_fullpath, output_fullpath))
+            chunk_cost += cost
+            chunk_memory = max(chunk_memory, memory)
+            self.total_cost -= cost
+        if not self.tasks:
+            # 浮動小数点の誤差が残らないようにする
+            self.total_cost = 0.0
+        return chunk, chunk_memory
@@ -0,0 +1,135 @@
+import json
+import os
+
+
+class SyncManifest:
+    """
+    同期モード用のマニフェスト
+    前回の変換時の入力ファイルのサイズ・更新日時と出力先を出力フォルダに保存しておき、
+    変更のない入力ファイルを変換対象から除外する
+    """
+    # json keys
+    VERSION_KEY = "version"
+    SETTINGS_KEY = "settings"
+    ENTRIES_KEY = "entries"
+
+    VERSION = 1
+    FILENAME = ".image_converter_manifest.json"
+
+    def __init__(self, input_root, output_root, settings, is_convert_subfolders=True):
+        self.input_root = input_root
+        self.output_root = output_root
+        self.is_convert_subfolders = is_convert_subfolders
+        self.datafile = os.path.join(output_root, self.FILENAME)
+        self.settings = settings
+        # 入力ファイルの相対パス -> [サイズ, 更新日時(ns), 出力ファイルの相対パス]
+        self.entries = {}
+        self.seen = set()
+
+        try:
+            self.load()
+        except (FileNotFoundError, ValueError, KeyError):
+            # 初回実行時、またはマニフェストが壊れている場合は全て変換し直す
+            self.entries = {}
+
+    def load(self):
+        with open(self.datafile, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data[self.VERSION_KEY] != self.VERSION:
+            raise ValueError(f"unsupported manifest version: {data[self.VERSION_KEY]}")
+        self.entries = data[self.ENTRIES_KEY]
+        # 変換設定が変わった場合は全てのファイルを変換し直す
+        # (出力ファイルパスは再利用するため、サイズだけ無効な値にしておく)
+        if data[self.SETTINGS_KEY] != self.settings:
+            for entry in self.entries.values():
+                entry[0] = -1
+
+    def save(self):
+        os.makedirs(self.output_root, exist_ok=True)
+        tmpfile = f"{self.datafile}.tmp"
+        with open(tmpfile, "w", encoding="utf-8") as f:
+            json.dump({
+                self.VERSION_KEY: self.VERSION,
+                self.SETTINGS_KEY: self.settings,
+                self.ENTRIES_KEY: self.entries,
+            }, f, ensure_ascii=False, separators=(",", ":"))
+        # 書き込み途中で停止してもマニフェストが壊れないように置き換える
+        os.replace(tmpfile, self.datafile)
+
+    def relpath(self, input_fullpath):
+        if os.path.isfile(self.input_root):
+            return os.path.basename(input_fullpath)
+        return os.path.relpath(input_fullpath, self.input_root)
+
+    def reserved_output_paths(self):
+        """
+        マニフェストに記録済みの出力ファイルパスを全て取得する
+        """
+        return {os.path.join(self.output_root, entry[2])
+                for entry in self.entries.values()}
+
+    def get_output_path(self, input_fullpath):
+        """
+        前回の出力ファイルパスを取得する（記録がなければNone）
+        """
+        entry = self.entries.get(self.relpath(input_fullpath))
+        if entry is None:
+            return None
+        return os.path.join(self.output_root, entry[2])
+
+    def mark_seen(self, input_fullpath):
+        """
+        今回の探索で見つかった入力ファイルとして記録する
+        """
+        self.seen.add(self.relpath(input_fullpath))
+
+    def is_unchanged(self, input_fullpath):
+        """
+        前回の変換から入力ファイルが変更されていないかを判定する
+        """
+        entry = self.entries.get(self.relpath(input_fullpath))
+        if entry is None:
+            return False
+        try:
+            stat = os.stat(input_fullpath)
+        except OSError:
+            return False
+        return (entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns
+                and os.path.exists(os.path.join(self.output_root, entry[2])))
+
+    def record(self, input_fullpath, output_fullpath):
+        """
+        変換に成功したファイルを記録する
+        """
+        stat = os.stat(input_fullpath)
+        self.entries[self.relpath(input_fullpath)] = [
+            stat.st_size,
+            stat.st_mtime_ns,
+            os.path.relpath(output_fullpath, self.output_root),
+        ]
+
+    def is_in_scope(self, key):
+        """
+        今回の探索の対象になる入力ファイルかを判定する
+        (サブフォルダを探索しない場合のサブフォルダ内のファイルなどは、見つからなくても削除されたとは限らない)
+        """
+        if os.path.isfile(self.input_root):
+            return key == os.path.basename(self.input_root)
+        return self.is_convert_subfolders or os.path.dirname(key) == ""
+
+    def remove_orphans(self):
+        """
+        今回の探索の対象のうち、入力ファイルが削除された出力ファイルを削除する
+        削除したファイル数を返す
+        """
+        removed = 0
+        for key in [key for key in self.entries
+                    if key not in self.seen and self.is_in_scope(key)]:
+            output_fullpath = os.path.join(self.output_root, self.entries[key][2])
+            try:
+                os.remove(output_fullpath)
+                removed += 1
+            except FileNotFoundError:
+                pass
+            del self.entries[key]
+        return removed
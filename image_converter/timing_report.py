@@ -0,0 +1,131 @@
+import collections
+import csv
+import heapq
+import itertools
+import json
+import math
+import os
+
+# 変換処理の段階(image_converter.worker.convert_imageで計測する順)
+STAGES = ("cache", "open", "passthrough", "decode", "metadata", "restore", "resize", "fill", "reduce", "encode", "copystat")
+# 1枚あたりの合計時間
+TOTAL_STAGE = "total"
+PERCENTILES = (50, 90, 99)
+CSV_FIELDS = ("section", "stage", "format", "input_path", "count", "mean_ms") \
+    + tuple(f"p{p}_ms" for p in PERCENTILES) + ("max_ms",)
+
+
+def percentile(sorted_values, p):
+    """
+    昇順に並んだ値のpパーセンタイル(最近傍順位法)を返す
+    """
+    index = max(0, math.ceil(p / 100 * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+def summarize(values):
+    """
+    処理時間(秒)のリストから、件数・平均・パーセンタイル・最大値(ミリ秒)を求める
+    """
+    values = sorted(values)
+    summary = {
+        "count": len(values),
+        "mean_ms": round(sum(values) / len(values) * 1000, 3),
+    }
+    for p in PERCENTILES:
+        summary[f"p{p}_ms"] = round(percentile(values, p) * 1000, 3)
+    summary["max_ms"] = round(values[-1] * 1000, 3)
+    return summary
+
+
+def stage_order(stage):
+    if stage in STAGES:
+        return STAGES.index(stage)
+    return len(STAGES)
+
+
+class TimingReport:
+    """
+    変換結果の段階ごとの処理時間を集計し、段階・入力形式ごとのパーセンタイルと
+    処理時間の長い上位top_n枚の画像をJSONまたはCSVで出力する
+    """
+
+    def __init__(self, top_n=10):
+        self.top_n = top_n
+        # (段階, 入力形式) -> 処理時間(秒)のリスト
+        self.durations = collections.defaultdict(list)
+        # 処理時間の長い画像(合計時間の小さい順のヒープ)
+        self.slowest = []
+        self.counter = itertools.count()
+
+    def add(self, result):
+        """
+        convert_imageの変換結果を追加する("timings"がない場合は無視する)
+        """
+        timings = result.get("timings")
+        if not timings:
+            return
+        input_format = os.path.splitext(result["input_path"])[1].lower().lstrip(".")
+        total = sum(timings.values())
+        for stage, duration in timings.items():
+            self.durations[(stage, input_format)].append(duration)
+        self.durations[(TOTAL_STAGE, input_format)].append(total)
+
+        item = (total, next(self.counter), result["input_path"], input_format, timings)
+        if len(self.slowest) < self.top_n:
+            heapq.heappush(self.slowest, item)
+        elif self.top_n > 0:
+            heapq.heappushpop(self.slowest, item)
+
+    def to_dict(self):
+        stages = []
+        for stage, input_format in sorted(
+                self.durations, key=lambda key: (stage_order(key[0]), key[1])):
+            stages.append({
+                "stage": stage,
+                "format": input_format,
+                **summarize(self.durations[(stage, input_format)]),
+            })
+        slowest = []
+        for total, _, input_path, input_format, timings in sorted(self.slowest, reverse=True):
+            slowest.append({
+                "input_path": input_path,
+                "format": input_format,
+                "total_ms": round(total * 1000, 3),
+                "stages_ms": {stage: round(duration * 1000, 3)
+                              for stage, duration in sorted(
+                                  timings.items(), key=lambda item: stage_order(item[0]))},
+            })
+        return {"stages": stages, "slowest": slowest}
+
+    def write(self, path):
+        """
+        集計結果をファイルに出力する(拡張子が.csvの場合はCSV、それ以外はJSON)
+        CSVでは、処理時間の長い画像は段階ごとに1行(count=1)として出力する
+        """
+        report = self.to_dict()
+        if not path.lower().endswith(".csv"):
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            return
+
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=CSV_FIELDS)
+            writer.writeheader()
+            for row in report["stages"]:
+                writer.writerow({"section": "stages", **row})
+            for item in report["slowest"]:
+                stages_ms = {**item["stages_ms"], TOTAL_STAGE: item["total_ms"]}
+                for stage, duration_ms in stages_ms.items():
+                    row = {
+                        "section": "slowest",
+                        "stage": stage,
+                        "format": item["format"],
+                        "input_path": item["input_path"],
+                        "count": 1,
+                        "mean_ms": duration_ms,
+                        "max_ms": duration_ms,
+                    }
+                    for p in PERCENTILES:
+                        row[f"p{p}_ms"] = duration_ms
+                    writer.writerow(row)
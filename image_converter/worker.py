@@ -0,0 +1,555 @@
+import json
+import os
+import shutil
+import time
+import traceback
+
+from PIL import Image, ImageChops, PngImagePlugin
+
+import image_converter.exts as exts
+from image_converter.metadata_envelope import (JPEG_EXIF_MAX_BYTES,
+                                               build_jpeg_metadata_segments,
+                                               decode_tagged_envelope,
+                                               encode_envelope,
+                                               parse_jpeg_metadata_segments)
+from image_converter.passthrough import (METHOD_HARDLINK, PASSTHROUGH_OFF,
+                                         can_pass_through, copy_file,
+                                         needs_metadata_normalization,
+                                         replace_output)
+
+# 変換処理を実行するプロセスで読み込まれるモジュール
+# プロセスの起動を速くするため、GUI(flet)・psutil・設定ファイル関連のモジュールは読み込まない
+# piexif・pillow_avifは必要な画像形式を変換する場合のみ読み込む
+
+
+def load_piexif():
+    """
+    jpg, webp, avifのExifの読み書きに使うpiexifを読み込む
+    """
+    import piexif
+    import piexif.helper
+    return piexif
+
+
+def load_avif_plugin():
+    """
+    avif形式の読み書きに必要なプラグインを読み込む
+    """
+    import pillow_avif  # noqa: F401
+
+
+def open_conversion_cache(cache_dir):
+    """
+    変換結果のキャッシュを開く(キャッシュを使う場合のみsqlite3を読み込む)
+    """
+    from image_converter.conversion_cache import open_cache
+    return open_cache(cache_dir)
+
+
+def preload_codecs():
+    """
+    プロセスの起動時に、画像の読み書きに使うモジュールを全て読み込んでおく
+    """
+    load_piexif()
+    load_avif_plugin()
+    Image.init()
+
+
+def warm_up():
+    """
+    プロセスを起動させるための空の処理
+    """
+    return None
+
+
+class StageTimer:
+    """
+    1枚の画像の変換処理の段階(stage)ごとの処理時間を計測する
+    lap(stage)を呼ぶたびに、前回のlap(または作成時)からの経過時間をstageの処理時間として記録する
+    """
+
+    def __init__(self):
+        self.timings = {}
+        self.last_time = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        self.timings[stage] = self.timings.get(stage, 0.0) + now - self.last_time
+        self.last_time = now
+
+
+def extract_metadata(image, input_path):
+    """
+    画像のExif（メタデータ）を取得する
+    """
+    metadata = {}
+    if input_path.lower().endswith(exts.PNG_EXT):
+        metadata = image.info
+    elif input_path.lower().endswith((exts.JPEG_EXT, exts.JPG_EXT, exts.WEBP_EXT, exts.AVIF_EXT)):
+        # jpgのExifに収まらない大きなメタデータは、APP11セグメントに分割して保存している
+        large_metadata = parse_jpeg_metadata_segments(
+            [data for marker, data in getattr(image, "applist", []) if marker == "APP11"])
+        if large_metadata is not None:
+            metadata = {"parameters": large_metadata}
+        elif "exif" in image.info.keys():
+            piexif = load_piexif()
+            exif_dict = piexif.load(image.info["exif"])
+            if piexif.ExifIFD.UserComment in exif_dict["Exif"]:
+                user_comment = exif_dict["Exif"][piexif.ExifIFD.UserComment]
+                metadata = {
+                    "parameters": piexif.helper.UserComment.load(user_comment)}
+    return metadata
+
+
+def get_palette_alpha_extrema(image):
+    """
+    パレット画像で使われている色の透明度の(最小値, 最大値)を返す
+    """
+    transparency = image.info["transparency"]
+    used = [index for index, count in enumerate(image.histogram()) if count]
+    if isinstance(transparency, bytes):
+        # 色ごとの透明度(tRNS)。指定がない色は不透明
+        alphas = [transparency[index] if index < len(transparency) else 255 for index in used]
+    else:
+        # 透明な色の番号
+        alphas = [0 if index == transparency else 255 for index in used]
+    return min(alphas), max(alphas)
+
+
+def fill_image_with_fill_color(image, fill_color, output_format):
+    """
+    透過部分を指定した色で塗りつぶす
+    アルファチャンネルが全て不透明な場合は塗りつぶさない(jpg以外はそのまま返す)
+    """
+    if image.mode == "P" and "transparency" in image.info:
+        alpha_extrema = get_palette_alpha_extrema(image)
+    elif image.mode in ("RGBA", "LA", "PA"):
+        # 全てのバンドのgetextrema()より、アルファチャンネルのみ取り出して調べる方が速い
+        alpha_extrema = image.getchannel("A").getextrema()
+    elif "transparency" in image.info:
+        # RGB・グレースケールの透明な色(pngのtRNS)
+        image = image.convert("RGBA")
+        alpha_extrema = image.getchannel("A").getextrema()
+    else:
+        return image
+
+    if alpha_extrema[0] == 255:
+        # jpgはアルファチャンネルを保存できないため、RGBに変換する
+        return image.convert("RGB") if output_format == exts.JPG_EXT else image
+
+    source = image if image.mode == "RGBA" else image.convert("RGBA")
+    background = Image.new("RGB", image.size, fill_color)
+    # RGBAの画像をマスクにすると、アルファチャンネルを分離せずにそのまま合成に使う
+    background.paste(source, mask=source)
+    return background
+
+
+# 縮小時のreducing_gap(reduceで整数分の1に縮小してから、残りをLANCZOSで縮小する)
+RESIZE_REDUCING_GAP = 3.0
+# ピクセルの形式を判定する際、先に1/SAMPLE_STEPに間引いた画像で判定する
+MODE_SAMPLE_STEP = 8
+# パレット(P)に変換できる最大の色数
+PALETTE_MAX_COLORS = 256
+
+
+def get_resize_size(size, resize):
+    """
+    resize({"max_width": 最大の幅, "max_height": 最大の高さ, "scale": 倍率})から、
+    縦横比を保った縮小後の(幅, 高さ)を返す。縮小しない場合はNoneを返す(拡大はしない)
+    """
+    width, height = size
+    ratio = 1.0
+    if resize.get("scale"):
+        ratio = min(ratio, resize["scale"])
+    if resize.get("max_width"):
+        ratio = min(ratio, resize["max_width"] / width)
+    if resize.get("max_height"):
+        ratio = min(ratio, resize["max_height"] / height)
+    if ratio >= 1.0:
+        return None
+    return max(1, round(width * ratio)), max(1, round(height * ratio))
+
+
+def resize_image(image, resize_size):
+    """
+    画像をresize_sizeに縮小する
+    (jpgはデコード前にdraftを指定しておくと、デコード時に1/2・1/4・1/8に縮小される)
+    """
+    if image.mode == "P":
+        # パレット画像はNEARESTでしか縮小できないため、先にRGB(A)に変換する
+        image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+    if image.mode.startswith("I;16"):
+        # 16bitのグレースケール(I;16・I;16B・I;16L)はLANCZOSで縮小できないため、
+        # 32bitの整数(I)で縮小してから元の形式に戻す
+        mode = image.mode
+        resized = image.convert("I").resize(resize_size, Image.LANCZOS, reducing_gap=RESIZE_REDUCING_GAP)
+        return resized.convert(mode)
+    # RGBA・LAは、Pillowがアルファチャンネルを乗算してから縮小する
+    return image.resize(resize_size, Image.LANCZOS, reducing_gap=RESIZE_REDUCING_GAP)
+
+
+def is_opaque(image):
+    return image.getchannel("A").getextrema()[0] == 255
+
+
+def is_grayscale(image):
+    """
+    全てのピクセルがR=G=Bかどうかを判定する
+    """
+    red, green, blue = image.split()[:3]
+    return (ImageChops.difference(red, green).getbbox() is None
+            and ImageChops.difference(green, blue).getbbox() is None)
+
+
+def is_same_pixels(image, converted):
+    """
+    変換後の画像を元の形式に戻したとき、元の画像と全てのピクセルが一致するかを判定する
+    (getbboxはデフォルトではRGBAのアルファチャンネルのみ調べるため、全てのチャンネルを調べる)
+    """
+    difference = ImageChops.difference(converted.convert(image.mode), image)
+    return difference.getbbox(alpha_only=False) is None
+
+
+def reduce_pixel_mode(image, output_format, lossless):
+    """
+    画質を変えずに、より小さいピクセルの形式(モード)に変換する
+    - アルファチャンネルが全て不透明: RGBA → RGB、LA → L
+    - (pngのみ) 全てのピクセルがR=G=B: RGB → L、RGBA → LA
+    - (pngのみ) 色数が256色以下: RGB・RGBA → P
+    webpのPillowのエンコーダーはRGB・RGBAのみ対応しているため、可逆圧縮の場合にアルファチャンネルのみ削除する
+    間引いた画像で条件を満たさない場合は画像全体を調べず、満たす場合のみ画像全体で確認する
+    """
+    if output_format == exts.PNG_EXT:
+        is_png = True
+    elif output_format == exts.WEBP_EXT and lossless:
+        is_png = False
+    else:
+        return image
+    if image.mode not in ("RGBA", "RGB", "LA"):
+        return image
+
+    width, height = image.size
+    sample = image.resize((max(1, width // MODE_SAMPLE_STEP), max(1, height // MODE_SAMPLE_STEP)),
+                          Image.NEAREST)
+
+    if image.mode in ("RGBA", "LA") and is_opaque(sample) and is_opaque(image):
+        mode = "RGB" if image.mode == "RGBA" else "L"
+        image = image.convert(mode)
+        sample = sample.convert(mode)
+    if not is_png or image.mode in ("L", "LA"):
+        return image
+
+    if is_grayscale(sample) and is_grayscale(image):
+        # R=G=Bの場合、Lへの変換(0.299R + 0.587G + 0.114B)で値は変わらない
+        return image.convert("LA" if image.mode == "RGBA" else "L")
+
+    if sample.getcolors(PALETTE_MAX_COLORS) is not None and image.getcolors(PALETTE_MAX_COLORS) is not None:
+        if image.mode == "RGB":
+            # 色数が256色以下の場合、メディアンカットは全ての色をそのままパレットにする
+            converted = image.quantize(PALETTE_MAX_COLORS, Image.Quantize.MEDIANCUT,
+                                       dither=Image.Dither.NONE)
+        else:
+            converted = image.quantize(PALETTE_MAX_COLORS, Image.Quantize.FASTOCTREE,
+                                       dither=Image.Dither.NONE)
+        if is_same_pixels(image, converted):
+            return converted
+    return image
+
+
+def convert_webui_to_novelai(metadata):
+    """
+    jpg, webp, avif向けに変換したNovelAIの画像のメタデータを(png向けに)復元する
+    """
+    try:
+        # "NAI:"以降の文字列を抽出してdict型に変換してから返す
+        return decode_tagged_envelope(metadata["parameters"], "NAI:")
+    except Exception:
+        tb = traceback.format_exc()
+        print(f"[Error] NovelAIのメタデータの取得に失敗しました\n{tb}")
+
+
+def convert_webui_to_comfyui(metadata):
+    """
+    jpg, webp, avif向けに変換したComfyUIの画像のメタデータを(png向けに)復元する
+    """
+    try:
+        # "ComfyUI:"以降の文字列を抽出してdict型に変換してから返す
+        return decode_tagged_envelope(metadata["parameters"], "ComfyUI:")
+    except Exception:
+        tb = traceback.format_exc()
+        print(f"[Error] ComfyUIのメタデータの取得に失敗しました\n{tb}")
+
+
+def restore_metadata(metadata):
+    """
+    NovelAIまたはComfyUIの画像をjpg, webp, avif向けに変換したことがあった場合、
+    メタデータを元の形式に復元する(それ以外の場合、復元に失敗した場合はそのまま返す)
+    """
+    parameters = metadata.get("parameters", None)
+    if parameters:
+        converters = [("NAI:", convert_webui_to_novelai), ("ComfyUI:", convert_webui_to_comfyui)]
+        # ComfyUIのメタデータは "ComfyUI:" から始まり、プロンプトに "NAI:" を含む場合があるため先に試す
+        if parameters.startswith("ComfyUI:"):
+            converters.reverse()
+        for tag, convert in converters:
+            if tag in parameters:
+                restored = convert(metadata)
+                if restored is not None:
+                    return restored
+    return metadata
+
+
+def convert_novelai_to_webui(metadata):
+    """
+    NovelAIの画像のメタデータをa1111(WebUI)で読み込める形式に変換する
+    jpg, webp, avif形式に変換してもNovelAIの画像のメタデータが残るように変換している
+    """
+    try:
+        json_info = json.loads(metadata["Comment"])
+
+        geninfo = f"""{metadata["Description"]}
+Negative prompt: {json_info["uc"]}
+Steps: {json_info["steps"]}, Sampler: {json_info["sampler"]}, CFG scale: {json_info["scale"]}, Seed: {json_info["seed"]}, Size: {json_info["width"]}x{json_info["height"]}, Clip skip: 2, ENSD: 31337, NAI: {encode_envelope(metadata)}"""
+    except Exception:
+        tb = traceback.format_exc()
+        print(f"[Error] NovelAIのメタデータの取得に失敗しました\n{tb}")
+
+    return geninfo
+
+
+def convert_comfyui_to_webui(metadata):
+    """
+    jpg, webp, avif形式に変換してもComfyUIの画像のメタデータが残るように変換している
+    """
+    return f"ComfyUI: {encode_envelope(metadata)}"
+
+
+def save_with_metadata(image, output_fullpath, output_format, quality, metadata, lossless):
+    """
+    画像を指定の拡張子で保存する
+    出力先が入力ファイルのハードリンクの場合があるため、出力先には直接書き込まずに置き換える
+    """
+    ext = output_format.lower()
+    exif_bytes = None
+    extra = b""
+
+    # Exif情報（メタデータ）を拡張子に合わせて整形
+    if ext == exts.PNG_EXT:
+        metadata_obj = PngImagePlugin.PngInfo()
+        for key, value in metadata.items():
+            if isinstance(key, str) and isinstance(value, str):
+                metadata_obj.add_text(key, value)
+        # pngのみpnginfoに保存する必要がある
+        with replace_output(output_fullpath) as temp_path:
+            image.save(temp_path, format=ext, pnginfo=metadata_obj,
+                       quality=quality, lossless=lossless)
+        return
+    elif ext in (exts.JPEG_EXT, exts.JPG_EXT, exts.WEBP_EXT, exts.AVIF_EXT):
+        if metadata.get("Software", None) == "NovelAI":
+            # NovelAIはWebUIで読み込める形にメタデータを変換する
+            md = convert_novelai_to_webui(metadata)
+        elif "prompt" in metadata or "workflow" in metadata:
+            # ComfyUIはそのままメタデータを保存
+            md = convert_comfyui_to_webui(metadata)
+        else:
+            # WebUIまたはその他のメタデータを保存
+            md = metadata.get("parameters", "")
+        piexif = load_piexif()
+        exif_bytes = piexif.dump({"Exif": {piexif.ExifIFD.UserComment: piexif.helper.UserComment.dump(
+            md, encoding="unicode")}})
+        if ext in (exts.JPEG_EXT, exts.JPG_EXT) and len(exif_bytes) > JPEG_EXIF_MAX_BYTES:
+            # jpgのAPP1セグメントは64KBまでのため、圧縮して複数のAPP11セグメントに分割して保存する
+            extra = build_jpeg_metadata_segments(md)
+            exif_bytes = b""
+
+    else:
+        raise ValueError(f"Invalid output format: {output_format}")
+
+    # extがjpgのとき、format="jpg"ではエラーが起こるため"jpeg"に変換
+    ext = exts.JPEG_EXT if ext == exts.JPG_EXT else ext
+    # メタデータ付き画像を保存
+    with replace_output(output_fullpath) as temp_path:
+        image.save(temp_path, format=ext, quality=quality,
+                   exif=exif_bytes, lossless=lossless, extra=extra)
+
+
+def conversion_result(input_path, output_path, timer, passthrough_method=None):
+    """
+    変換結果(入出力のパスとファイルサイズ)を作成する
+    """
+    result = {
+        "input_path": input_path,
+        "output_path": output_path,
+        "input_size": os.path.getsize(input_path),
+        "output_size": os.path.getsize(output_path),
+    }
+    if passthrough_method is not None:
+        result["passthrough"] = passthrough_method
+    if timer is not None:
+        result["timings"] = timer.timings
+    return result
+
+
+def convert_image(conversion_params):
+    """
+    画像の変換を行う
+    変換に成功した場合は入出力のパスとファイルサイズを返す
+    optionsの"is_timing"がTrueの場合は、段階ごとの処理時間(秒)も"timings"として返す
+    optionsの"passthrough"が"off"以外で、入力画像が既に出力形式・設定を満たしている場合は、
+    再エンコードせずにファイルをコピーし、コピーに使用した方法を"passthrough"として返す
+    optionsの"cache_dir"を指定した場合は、同じ内容の画像を同じ設定で変換した結果をキャッシュから取り出し、
+    "cache"として"hit"(キャッシュから取り出した)または"stored"(変換してキャッシュに保存した)を返す
+    optionsの"resize"({"max_width", "max_height", "scale"})を指定した場合は、縦横比を保って縮小する
+    """
+    input_path, output_path, output_format, quality, lossless, is_fill_color, fill_color, options = conversion_params
+    # 計測しない場合は、各段階でNoneかどうかの判定のみ行う
+    timer = StageTimer() if options.get("is_timing") else None
+
+    cache = None
+    if options.get("cache_dir"):
+        cache = open_conversion_cache(options["cache_dir"])
+        cache_key = cache.make_key(input_path, output_format, quality, lossless, is_fill_color, fill_color,
+                                   options.get("resize"), options.get("is_reduce_mode", False),
+                                   options.get("passthrough", PASSTHROUGH_OFF) != PASSTHROUGH_OFF)
+        method = cache.fetch(cache_key, output_path, options.get("is_cache_link", False),
+                             os.stat(input_path).st_mtime_ns)
+        if timer is not None:
+            timer.lap("cache")
+        if method is not None:
+            if method != METHOD_HARDLINK:
+                shutil.copystat(input_path, output_path)
+            result = conversion_result(input_path, output_path, timer)
+            result["cache"] = "hit"
+            return result
+
+    if input_path.lower().endswith(exts.AVIF_EXT) or output_format == exts.AVIF_EXT:
+        load_avif_plugin()
+
+    with Image.open(input_path) as image:
+        if timer is not None:
+            timer.lap("open")
+        # アニメーション画像は変換しない
+        if input_path.endswith((exts.PNG_EXT, exts.WEBP_EXT, exts.AVIF_EXT)):
+            if image.is_animated:
+                print(f"[Error] '{input_path}' はアニメーション画像のため、変換できません")
+                return
+
+        resize_size = None
+        if options.get("resize"):
+            resize_size = get_resize_size(image.size, options["resize"])
+            if resize_size is not None:
+                # jpgはデコード時に縮小する(デコード前に指定する必要がある)
+                image.draft(image.mode, resize_size)
+
+        # 既に出力形式・設定を満たしている画像は、デコード・再エンコードせずにコピーする
+        metadata = None
+        passthrough = options.get("passthrough", PASSTHROUGH_OFF)
+        if resize_size is None and passthrough != PASSTHROUGH_OFF and can_pass_through(
+                image, input_path, output_format, quality, lossless, is_fill_color):
+            metadata = extract_metadata(image, input_path)
+            # 以前の形式で保存したメタデータは、再エンコードして現在の形式で保存し直す
+            if not needs_metadata_normalization(metadata):
+                try:
+                    method = copy_file(input_path, output_path, passthrough)
+                    if method != METHOD_HARDLINK:
+                        shutil.copystat(input_path, output_path)
+                except Exception:
+                    tb = traceback.format_exc()
+                    print(f"[Error] '{input_path}' のコピーに失敗しました\n{tb}")
+                    return
+                if timer is not None:
+                    timer.lap("passthrough")
+                return conversion_result(input_path, output_path, timer, method)
+
+        if output_format == exts.WEBP_EXT:
+            width, height = resize_size or image.size
+            if width > 16383 or height > 16383:
+                print(
+                    f"[Error] '{input_path}' は画像の幅(高さ)の最大サイズが16383 pxを超えるため、変換できません")
+                return
+        elif output_format == exts.JPG_EXT:
+            width, height = resize_size or image.size
+            if width > 65535 or height > 65535:
+                print(
+                    f"[Error] '{input_path}' は画像の幅(高さ)の最大サイズが65535 pxを超えるため、変換できません")
+
+        if timer is not None:
+            # 通常は保存時にデコードされるため、計測時のみデコードを分けて行う
+            image.load()
+            timer.lap("decode")
+
+            # 画像のプロンプト情報を取得
+        if metadata is None:
+            metadata = extract_metadata(image, input_path)
+        if timer is not None:
+            timer.lap("metadata")
+
+        # NovelAIまたはComfyUIの画像を変換したことがあった場合、メタデータを復元する
+        if metadata.get("parameters", None):
+            metadata = restore_metadata(metadata)
+            if timer is not None:
+                timer.lap("restore")
+
+        # 縮小する(塗りつぶし・保存するピクセル数を減らすため、先に縮小する)
+        if resize_size is not None:
+            image = resize_image(image, resize_size)
+            if timer is not None:
+                timer.lap("resize")
+
+        # 透明部分を塗りつぶす
+        if is_fill_color:
+            image = fill_image_with_fill_color(
+                image, fill_color, output_format)
+            if timer is not None:
+                timer.lap("fill")
+
+        # 画質を変えずに、より小さいピクセルの形式に変換する
+        if options.get("is_reduce_mode"):
+            image = reduce_pixel_mode(image, output_format, lossless)
+            if timer is not None:
+                timer.lap("reduce")
+        try:
+            # 保存
+            save_with_metadata(image, output_path, output_format,
+                               quality, metadata, lossless)
+            if timer is not None:
+                timer.lap("encode")
+            # 更新日時などの属性をコピー
+            shutil.copystat(input_path, output_path)
+            if timer is not None:
+                timer.lap("copystat")
+        except Exception:
+            tb = traceback.format_exc()
+            print(f"[Error] '{input_path}' の保存に失敗しました\n{tb}")
+            return
+
+    result = conversion_result(input_path, output_path, timer)
+    if cache is not None:
+        try:
+            cache.store(cache_key, output_path, output_format)
+            result["cache"] = "stored"
+        except Exception:
+            # キャッシュに保存できなくても、変換結果はそのまま使う
+            tb = traceback.format_exc()
+            print(f"[Error] '{input_path}' の変換結果をキャッシュに保存できませんでした\n{tb}")
+        if timer is not None:
+            timer.lap("cache")
+    return result
+
+
+def convert_image_chunk(conversion_params_list):
+    """
+    複数の画像をまとめて変換する
+    プロセス間通信の回数を減らすため、1回の変換処理で複数の画像を受け取り、
+    (変換したプロセスのID, 結果のリスト)をまとめて返す
+    """
+    results = []
+    for conversion_params in conversion_params_list:
+        try:
+            results.append(convert_image(conversion_params))
+        except Exception:
+            # 1枚の失敗で同じチャンクの他の画像が変換されなくならないようにする
+            tb = traceback.format_exc()
+            print(f"[Error] '{conversion_params[0]}' の変換に失敗しました\n{tb}")
+            results.append(None)
+    return os.getpid(), results
@@ -0,0 +1,131 @@
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import psutil
+
+from image_converter.worker import preload_codecs, warm_up
+
+# 変換処理の実行方法
+EXECUTOR_PROCESS = "process"
+EXECUTOR_THREAD = "thread"
+EXECUTOR_AUTO = "auto"
+EXECUTOR_TYPES = (EXECUTOR_PROCESS, EXECUTOR_THREAD, EXECUTOR_AUTO)
+
+
+def create_executor(executor_type, cpu_num, is_preload=False):
+    """
+    変換処理を実行するプロセスプール(またはスレッドプール)を作成する
+    Pillowはデコード・エンコード中にGILを解放するため、スレッドでも並列に変換できる
+    is_preloadがTrueの場合は、プロセスの起動時に全ての画像形式のモジュールを読み込む
+    """
+    if executor_type == EXECUTOR_THREAD:
+        return ThreadPoolExecutor(max_workers=int(cpu_num))
+    if executor_type == EXECUTOR_PROCESS:
+        initializer = preload_codecs if is_preload else None
+        return ProcessPoolExecutor(max_workers=int(cpu_num), initializer=initializer)
+    raise ValueError(f"Invalid executor type: {executor_type}")
+
+
+class WorkerPool:
+    """
+    変換処理を実行するプロセスプールを保持し、複数回の変換処理で使い回す
+    同時プロセス実行数が変わった場合のみプロセスプールを作り直す
+    is_preloadがTrueの場合は、プロセスの起動時に全ての画像形式のモジュールを読み込んでおく
+    """
+
+    def __init__(self, executor_type=EXECUTOR_PROCESS, is_preload=False):
+        self.executor_type = executor_type
+        self.is_preload = is_preload
+        self.executor = None
+        self.cpu_num = None
+        # recycle()で入れ替えた後、実行中の変換処理が完了するまで残っているプロセス
+        self.retiring_processes = []
+        self.lock = threading.Lock()
+
+    def start(self, cpu_num):
+        """
+        バックグラウンドでプロセスを起動しておき、最初の変換処理をすぐに開始できるようにする
+        """
+        threading.Thread(target=self.warm_up, args=(cpu_num,), daemon=True).start()
+
+    def warm_up(self, cpu_num):
+        try:
+            executor = self.get(cpu_num)
+            # 全てのプロセスを起動させてモジュールを読み込ませる
+            for future in [executor.submit(warm_up) for _ in range(int(cpu_num))]:
+                future.result()
+        except Exception as e:
+            print(f"[Error] プロセスの起動に失敗しました\n{e}")
+
+    def get(self, cpu_num):
+        """
+        同時プロセス実行数がcpu_numのプロセスプールを取得する
+        """
+        with self.lock:
+            is_broken = getattr(self.executor, "_broken", False)
+            if self.executor is None or self.cpu_num != int(cpu_num) or is_broken:
+                if self.executor is not None:
+                    self.executor.shutdown(wait=not is_broken)
+                self.executor = create_executor(
+                    self.executor_type, cpu_num, self.is_preload)
+                self.cpu_num = int(cpu_num)
+            return self.executor
+
+    def recycle(self):
+        """
+        同じ数のプロセスで新しいプロセスプールを作成し、以降の変換処理は新しいプロセスで実行する
+        投入済みの変換処理の完了は待たず、古いプロセスはそれらが完了したら終了する
+        """
+        with self.lock:
+            if self.executor is not None:
+                old_executor = self.executor
+                # shutdown()後は_processesがNoneになるため、先に保持しておく
+                self.retiring_processes = [
+                    process for process in self.retiring_processes if process.is_alive()]
+                self.retiring_processes.extend((old_executor._processes or {}).values())
+                self.executor = create_executor(
+                    self.executor_type, self.cpu_num, self.is_preload)
+                old_executor.shutdown(wait=False)
+            return self.executor
+
+    def terminate(self):
+        """
+        実行中のプロセスを強制終了する(次回のget()で作り直される)
+        """
+        with self.lock:
+            if self.executor_type == EXECUTOR_PROCESS and self.executor is not None:
+                processes = list((self.executor._processes or {}).values())
+                for process in processes + self.retiring_processes:
+                    if process.is_alive():
+                        process.terminate()
+                self.retiring_processes = []
+
+    def get_pids(self):
+        """
+        プロセスプール内の各プロセスのプロセスIDを取得する(スレッドプールの場合は空)
+        """
+        executor = self.executor
+        if self.executor_type != EXECUTOR_PROCESS or executor is None:
+            return []
+        # シャットダウン済みのプロセスプールでは_processesがNoneになる
+        processes = executor._processes or {}
+        return [process.pid for process in list(processes.values())]
+
+    def get_max_rss(self):
+        """
+        プロセスプール内の各プロセスのメモリ使用量(RSS)の最大値を取得する
+        """
+        max_rss = 0
+        for pid in self.get_pids():
+            try:
+                max_rss = max(max_rss, psutil.Process(pid).memory_info().rss)
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                continue
+        return max_rss
+
+    def shutdown(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+                self.executor = None
+                self.cpu_num = None
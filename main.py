@@ -2,32 +2,42 @@ import os
 import re
 import time
 
-import flet
-import psutil
-from flet import (AlertDialog, Card, Checkbox, Column, Container,
-                  CrossAxisAlignment, Divider, Dropdown, ElevatedButton,
-                  FilePicker, FilePickerFileType, FilePickerResultEvent,
-                  FloatingActionButton, FontWeight, Icon, MainAxisAlignment,
-                  Margin, NavigationDrawer, ProgressBar, ProgressRing, Ref,
-                  Row, ScrollMode, Slider, Stack, Switch, Text, TextButton,
-                  TextDecoration, TextField, TextSpan, TextStyle, alignment,
-                  colors, dropdown, icons)
-from flet_contrib.color_picker import ColorPicker
-
-import image_converter.exts as exts
-import image_converter.image_converter as converter
-from image_converter.config_loader import ConfigLoader
-from image_converter.theme_loader import ThemeLoader
+# 変換処理のプロセスは起動時にmain.pyを読み込み直すため(spawn)、
+# GUIで使うモジュールはmain()の中で読み込み、各プロセスで読み込まれないようにする
 
 
 def main(page):
+    import psutil
+    from flet import (AlertDialog, Card, Checkbox, Column, Container,
+                      CrossAxisAlignment, Divider, Dropdown, ElevatedButton,
+                      FilePicker, FilePickerFileType, FilePickerResultEvent,
+                      FloatingActionButton, FontWeight, Icon,
+                      MainAxisAlignment, Margin, NavigationDrawer,
+                      ProgressBar, ProgressRing, Ref, Row, ScrollMode, Slider,
+                      Stack, Switch, Text, TextButton, TextDecoration,
+                      TextField, TextSpan, TextStyle, alignment, colors,
+                      dropdown, icons)
+    from flet_contrib.color_picker import ColorPicker
+
+    import image_converter.exts as exts
+    import image_converter.image_converter as converter
+    import image_converter.progress as progress_events
+    from image_converter.config_loader import ConfigLoader
+    from image_converter.job import ConversionJob
+    from image_converter.theme_loader import ThemeLoader
+    from image_converter.worker_pool import WorkerPool
+
     # variables
     font_bold = FontWeight.BOLD
     is_running_process = False
+    conversion_job = None
     LIGHT_THEME = "light"
     DARK_THEME = "dark"
     config = ConfigLoader()
     theme = ThemeLoader()
+    # 変換処理用のプロセスをバックグラウンドで起動しておき、変換のたびに使い回す
+    worker_pool = WorkerPool(is_preload=True)
+    worker_pool.start(config.cpu_num)
 
     # page settings
     page.title = "Image Converter with prompts"
@@ -159,15 +169,21 @@ def main(page):
         pb_text.value = ""
         page.update()
 
-    def start_progress_bar(current, total):
+    def start_progress_bar():
         conversion_pb.value = 0
         conversion_pb.color = colors.BLUE
-        pb_text.value = f"{current}/{total}"
+        pb_text.value = ""
         page.update()
 
-    def update_progress_bar(current, total):
-        conversion_pb.value = current / total
-        pb_text.value = f"{current}/{total}"
+    def update_progress_bar(snapshot):
+        processed = snapshot["processed"]
+        total = snapshot["total"]
+        conversion_pb.value = processed / total if total > 0 else None
+        # 探索中は合計枚数が増えていくため、探索が完了するまで残り時間を表示しない
+        total_text = f"{total}" if snapshot["is_scan_done"] else f"{total}+"
+        pb_text.value = f"{processed}/{total_text} ({snapshot['files_per_sec']:.1f}枚/秒)"
+        if snapshot["eta_sec"] is not None:
+            pb_text.value += f" 残り{int(snapshot['eta_sec'])}秒"
         conversion_pb.update()
         pb_text.update()
 
@@ -180,6 +196,19 @@ def main(page):
         conversion_pb.value = 100
         conversion_pb.update()
 
+    def on_progress(event, snapshot):
+        if event == progress_events.STARTED:
+            start_progress_bar()
+        elif event == progress_events.FINISHED:
+            if snapshot["total"] > 0:
+                update_progress_bar(snapshot)
+            if snapshot["is_error"]:
+                error_progress_bar()
+            else:
+                complete_progress_bar()
+        else:
+            update_progress_bar(snapshot)
+
     # format value
 
     def switch_options_value(ext):
@@ -266,6 +295,7 @@ def main(page):
         page.update()
         converter.stop_process()
         time.sleep(5)
+        worker_pool.terminate()
         page.window_destroy()
 
     quit_dialog = AlertDialog(
@@ -287,6 +317,7 @@ def main(page):
             if is_running_process:
                 open_quit_dialog()
             else:
+                worker_pool.shutdown()
                 page.window_destroy()
 
     page.on_window_event = on_window_close
@@ -365,7 +396,7 @@ def main(page):
         icon=icons.SETTINGS, on_click=show_end_drawer)
 
     # run
-    def run_conversion(e):
+    async def run_conversion(e):
         # check input value
         is_input_path_empty = input_path_textfield.current.value == ""
         is_output_path_empty = output_path_textfield.current.value == ""
@@ -450,12 +481,15 @@ def main(page):
         page.update()
 
         # Actual comversion logic goes here
-        nonlocal is_running_process
+        nonlocal is_running_process, conversion_job
         is_running_process = True
 
         start_time = time.time()
         # 実行
-        isError, message = converter.convert_images_concurrently(
+        # 変換処理はバックグラウンドで実行し、完了を待つ間も画面を操作できるようにする
+        # 進捗の表示はファイルごとではなく一定間隔ごとにまとめて更新する
+        conversion_job = ConversionJob(
+            progress_interval=0.1,
             input_path=input_path,
             output_path=output_path,
             is_convert_subfolders=is_convert_subfolders,
@@ -465,11 +499,14 @@ def main(page):
             is_fill_color=is_fill_color,
             fill_color=t_color,
             cpu_num=cpu_num,
-            pb_callbacks={"start": start_progress_bar,
-                          "update": update_progress_bar,
-                          "complete": complete_progress_bar,
-                          "error": error_progress_bar}
+            worker_pool=worker_pool
         )
+        snapshots = conversion_job.progress()
+        conversion_job.start()
+        async for snapshot in snapshots:
+            on_progress(snapshot["event"], snapshot)
+        isError, message = await conversion_job
+        conversion_job = None
 
         log_output.current.value += message
 
@@ -490,7 +527,8 @@ def main(page):
 
     # stop
     def stop_conversion(e):
-        converter.stop_process()
+        if conversion_job is not None:
+            conversion_job.cancel()
         stop_btn.current.disabled = True
         stop_btn.current.update()
 
@@ -759,5 +797,9 @@ def main(page):
 
 
 if __name__ == "__main__":
+    import flet
+
+    import image_converter.image_converter as converter
+
     converter.set_signals()
     flet.app(target=main)
@@ -0,0 +1,52 @@
+import os
+
+import image_converter.exts as exts
+from image_converter.conversion_cache import ConversionCache, make_key
+from image_converter.passthrough import METHOD_HARDLINK
+
+
+def write_bytes(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+    return str(path)
+
+
+def test_make_key_separates_optional_settings(tmp_path):
+    path = write_bytes(tmp_path / "a.png", b"image")
+    args = (path, exts.WEBP_EXT, 90, False, False, "#ffffff")
+    base = make_key(*args)
+    # 無効な設定はキーを変えない(以前のキャッシュをそのまま使える)
+    assert make_key(*args, None, False, False) == base
+    keys = {
+        base,
+        make_key(*args, resize={"max_width": 512}),
+        make_key(*args, reduce_mode=True),
+        make_key(*args, is_passthrough=True),
+    }
+    assert len(keys) == 4
+
+
+def test_make_key_ignores_fill_color_when_not_filling(tmp_path):
+    path = write_bytes(tmp_path / "a.png", b"image")
+    assert (make_key(path, exts.PNG_EXT, 100, True, False, "#000000")
+            == make_key(path, exts.PNG_EXT, 100, True, False, "#ffffff"))
+    assert (make_key(path, exts.PNG_EXT, 100, True, True, "#000000")
+            != make_key(path, exts.PNG_EXT, 100, True, True, "#ffffff"))
+
+
+def test_link_fetch_copies_when_source_mtime_differs(tmp_path):
+    output = write_bytes(tmp_path / "out.webp", b"converted")
+    os.utime(output, ns=(1_600_000_000_000_000_000, 1_600_000_000_000_000_000))
+    cache = ConversionCache(str(tmp_path / "cache"))
+    try:
+        cache.store("ab" * 20, output, exts.WEBP_EXT)
+        # 入力ファイルと更新日時が同じ場合のみハードリンクする
+        linked = str(tmp_path / "linked.webp")
+        assert cache.fetch("ab" * 20, linked, True, 1_600_000_000_000_000_000) == METHOD_HARDLINK
+        copied = str(tmp_path / "copied.webp")
+        assert cache.fetch("ab" * 20, copied, True, 1_700_000_000_000_000_000) != METHOD_HARDLINK
+        assert os.stat(copied).st_nlink == 1
+        with open(copied, "rb") as f:
+            assert f.read() == b"converted"
+    finally:
+        cache.close()
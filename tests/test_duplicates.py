@@ -0,0 +1,83 @@
+import os
+
+from PIL import Image
+
+from image_converter.duplicates import (KIND_EXACT, KIND_PERCEPTUAL,
+                                        PARTIAL_HASH_SIZE, find_duplicates,
+                                        partial_hash)
+
+
+def write_bytes(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+    return str(path)
+
+
+def make_gradient(size=(256, 256)):
+    image = Image.new("RGB", size)
+    image.putdata([(x, y, (x + y) // 2) for y in range(size[1]) for x in range(size[0])])
+    return image
+
+
+def make_half_transparent(hidden, size=(256, 256)):
+    """
+    左半分が透明(RGBはhiddenの色または画像)、右半分がグラデーションの画像を作成する
+    """
+    image = make_gradient(size).convert("RGBA")
+    half = (size[0] // 2, size[1])
+    if not isinstance(hidden, Image.Image):
+        hidden = Image.new("RGB", half, hidden)
+    hidden = hidden.convert("RGBA")
+    hidden.putalpha(0)
+    image.paste(hidden, (0, 0))
+    return image
+
+
+def test_partial_hash_covers_whole_file_between_one_and_two_chunks(tmp_path):
+    # 先頭のPARTIAL_HASH_SIZEバイトのみ同じで、残りが異なるファイル
+    head = os.urandom(PARTIAL_HASH_SIZE)
+    tail_size = PARTIAL_HASH_SIZE // 2
+    a = write_bytes(tmp_path / "a.png", head + b"\x00" * tail_size)
+    b = write_bytes(tmp_path / "b.png", head + b"\x01" * tail_size)
+    assert partial_hash(a) != partial_hash(b)
+    assert find_duplicates([a, b]) == {}
+
+
+def test_exact_duplicates_keep_first_path(tmp_path):
+    data = os.urandom(PARTIAL_HASH_SIZE + 100)
+    c, a, b = (write_bytes(tmp_path / name, data) for name in ("c.png", "a.png", "b.png"))
+    expected = {b: (a, KIND_EXACT), c: (a, KIND_EXACT)}
+    assert find_duplicates([c, a, b]) == expected
+    assert find_duplicates([b, c, a]) == expected
+
+
+def test_perceptual_duplicates_keep_lossless_source(tmp_path):
+    image = make_gradient()
+    png = str(tmp_path / "z.png")
+    jpg = str(tmp_path / "a.jpg")
+    image.save(png)
+    image.save(jpg, quality=95)
+    assert find_duplicates([jpg, png], is_perceptual=True) == {jpg: (png, KIND_PERCEPTUAL)}
+
+
+def test_perceptual_duplicates_ignore_color_under_transparent_pixels(tmp_path):
+    # 透明な部分のRGBのみが異なる(見た目は同じ)pngと可逆圧縮のwebp
+    png = str(tmp_path / "a.png")
+    webp = str(tmp_path / "b.webp")
+    noise = Image.effect_noise((128, 256), 100)
+    make_half_transparent(Image.merge("RGB", (noise, noise.rotate(90), noise.rotate(180)))).save(png)
+    make_half_transparent((0, 0, 0)).save(webp, lossless=True)
+    assert find_duplicates([png, webp], is_perceptual=True) == {webp: (png, KIND_PERCEPTUAL)}
+
+
+def test_perceptual_duplicates_compare_transparency(tmp_path):
+    opaque = str(tmp_path / "a.png")
+    transparent = str(tmp_path / "b.png")
+    image = make_gradient()
+    image.save(opaque)
+    # RGBは同じで、ほぼ全体が透明な画像
+    image = image.convert("RGBA")
+    image.putalpha(Image.new("L", image.size, 0))
+    image.putpixel((0, 0), (0, 0, 0, 255))
+    image.save(transparent)
+    assert find_duplicates([opaque, transparent], is_perceptual=True) == {}
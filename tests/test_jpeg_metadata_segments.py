@@ -0,0 +1,55 @@
+import json
+import os
+import struct
+
+from PIL import Image
+
+import image_converter.exts as exts
+from image_converter.metadata_envelope import (JPEG_METADATA_MARKER,
+                                               build_jpeg_metadata_segments,
+                                               parse_jpeg_metadata_segments)
+from image_converter.metadata_reader import read_metadata
+from image_converter.worker import save_with_metadata
+
+
+def split_segments(segments):
+    """
+    build_jpeg_metadata_segmentsのバイト列を、セグメントのデータ(マーカーと長さを除く)のリストにする
+    """
+    result = []
+    offset = 0
+    while offset < len(segments):
+        assert segments[offset:offset + 2] == JPEG_METADATA_MARKER
+        length = struct.unpack(">H", segments[offset + 2:offset + 4])[0]
+        result.append(segments[offset + 4:offset + 2 + length])
+        offset += 2 + length
+    return result
+
+
+def test_segments_round_trip_across_multiple_segments():
+    # 圧縮してもAPP11セグメント1つに収まらないメタデータ
+    text = os.urandom(100 * 1024).hex()
+    segments = split_segments(build_jpeg_metadata_segments(text))
+    assert len(segments) > 1
+    # セグメントの長さ(2バイト)は長さ自体を含めて0xFFFF以下
+    assert all(len(data) + 2 <= 0xFFFF for data in segments)
+    assert parse_jpeg_metadata_segments(segments) == text
+    # 順番が入れ替わっていても復元でき、欠けている場合は復元しない
+    assert parse_jpeg_metadata_segments(segments[::-1]) == text
+    assert parse_jpeg_metadata_segments(segments[1:]) is None
+    assert parse_jpeg_metadata_segments([b"other"]) is None
+
+
+def test_large_metadata_round_trips_through_jpg(tmp_path):
+    # 圧縮してUserComment(UTF-16)にしてもAPP1セグメントに収まらないメタデータ
+    workflow = {"nodes": [{"id": i, "widgets_values": [os.urandom(16).hex()]} for i in range(4000)]}
+    metadata = {"prompt": json.dumps({"1": {"inputs": {"text": "1girl"}}}),
+                "workflow": json.dumps(workflow)}
+    parameters = {"parameters": "1girl, " * 10000 + "\nSteps: 20"}
+    for name, expected in (("comfyui", metadata), ("webui", parameters)):
+        path = str(tmp_path / f"{name}.jpg")
+        save_with_metadata(Image.new("RGB", (8, 8)), path, exts.JPG_EXT, 90, expected, False)
+        assert read_metadata(path) == expected
+        with Image.open(path) as image:
+            image.load()
+            assert "exif" not in image.info
@@ -0,0 +1,60 @@
+import json
+
+import pytest
+from PIL import Image
+
+import image_converter.exts as exts
+from image_converter.metadata_envelope import (COMPRESS_THRESHOLD,
+                                               COMPRESSED_DATA_KEY, DATA_KEY,
+                                               decode_envelope,
+                                               decode_tagged_envelope,
+                                               encode_envelope)
+from image_converter.metadata_reader import read_metadata
+from image_converter.worker import save_with_metadata
+
+
+def make_novelai_metadata(prompt="1girl, smile"):
+    comment = {"uc": "lowres", "steps": 28, "sampler": "k_euler", "scale": 5.0,
+               "seed": 1, "width": 8, "height": 8}
+    return {"Software": "NovelAI", "Description": prompt, "Comment": json.dumps(comment)}
+
+
+def test_envelope_round_trip():
+    small = {"parameters": "1girl, 笑顔\nSteps: 20"}
+    assert json.loads(encode_envelope(small))[DATA_KEY] == small
+    assert decode_envelope(encode_envelope(small)) == small
+    # 大きいメタデータは圧縮して保存する
+    large = {"prompt": json.dumps({str(i): {"inputs": {"text": "1girl"}} for i in range(100)})}
+    assert len(large["prompt"]) > COMPRESS_THRESHOLD
+    assert COMPRESSED_DATA_KEY in json.loads(encode_envelope(large))
+    assert decode_envelope(encode_envelope(large)) == large
+
+
+def test_envelope_keeps_only_string_items():
+    assert decode_envelope(encode_envelope({"a": "b", "c": 1, 2: "d"})) == {"a": "b"}
+
+
+def test_decode_legacy_repr_and_reject_unknown_version():
+    metadata = {"Software": "NovelAI", "Comment": '{"seed": 1}'}
+    assert decode_envelope(repr(metadata)) == metadata
+    with pytest.raises(ValueError):
+        decode_envelope('{"v":999,"d":{}}')
+
+
+def test_decode_tagged_envelope_skips_tag_in_prompt():
+    metadata = {"prompt": "{}"}
+    text = f"sign saying ComfyUI: hello\nComfyUI: {encode_envelope(metadata)}"
+    assert decode_tagged_envelope(text, "ComfyUI:") == metadata
+    with pytest.raises(ValueError):
+        decode_tagged_envelope("sign saying ComfyUI: hello", "ComfyUI:")
+
+
+@pytest.mark.parametrize("output_format", [exts.JPG_EXT, exts.WEBP_EXT])
+def test_novelai_and_comfyui_metadata_round_trip(tmp_path, output_format):
+    comfyui = {"prompt": json.dumps({"1": {"inputs": {"text": "NAI: 1girl"}}}),
+               "workflow": json.dumps({"nodes": []})}
+    for name, metadata in (("novelai", make_novelai_metadata("1girl, NAI: sign")),
+                           ("comfyui", comfyui)):
+        path = str(tmp_path / f"{name}.{output_format}")
+        save_with_metadata(Image.new("RGB", (8, 8)), path, output_format, 90, metadata, False)
+        assert read_metadata(path) == metadata
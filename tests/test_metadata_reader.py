@@ -0,0 +1,23 @@
+from PIL import Image, PngImagePlugin
+
+from image_converter.metadata_reader import read_metadata
+
+
+def save_png(path, text):
+    info = PngImagePlugin.PngInfo()
+    for key, value in text.items():
+        info.add_text(key, value)
+    Image.new("RGB", (8, 8)).save(path, pnginfo=info)
+    return str(path)
+
+
+def test_read_metadata_returns_png_text(tmp_path):
+    text = {"parameters": "1girl, smile\nSteps: 20, Seed: 1"}
+    assert read_metadata(save_png(tmp_path / "a.png", text)) == text
+
+
+def test_read_metadata_keeps_prompt_that_only_mentions_tags(tmp_path):
+    # "NAI:"・"ComfyUI:"を含むが、変換時に保存したメタデータではないプロンプト
+    for tag in ("NAI:", "ComfyUI:"):
+        text = {"parameters": f"1girl, sign saying {tag} hello\nSteps: 20"}
+        assert read_metadata(save_png(tmp_path / "a.png", text)) == text
@@ -0,0 +1,111 @@
+import os
+
+import pytest
+from PIL import Image
+
+import image_converter.exts as exts
+from image_converter.passthrough import (METHOD_HARDLINK, PASSTHROUGH_COPY,
+                                         PASSTHROUGH_LINK, can_pass_through,
+                                         copy_file,
+                                         needs_metadata_normalization,
+                                         replace_output)
+from image_converter.worker import save_with_metadata
+
+
+def make_image():
+    image = Image.new("RGB", (64, 64))
+    image.putdata([(x * 4, y * 4, 128) for y in range(64) for x in range(64)])
+    return image
+
+
+def check(path, output_format, quality, lossless, is_fill_color=False):
+    with Image.open(path) as image:
+        return can_pass_through(image, str(path), output_format, quality, lossless, is_fill_color)
+
+
+def test_jpg_passes_through_only_up_to_requested_quality(tmp_path):
+    path = tmp_path / "a.jpg"
+    make_image().save(path, quality=80)
+    assert check(path, exts.JPG_EXT, 90, False)
+    assert check(path, exts.JPG_EXT, 80, False)
+    assert not check(path, exts.JPG_EXT, 50, False)
+
+
+def test_lossy_webp_is_always_reencoded(tmp_path):
+    # 非可逆圧縮のwebpは入力の品質が分からないため、品質の高い画像をそのまま出力しない
+    path = tmp_path / "a.webp"
+    make_image().save(path, quality=95)
+    assert not check(path, exts.WEBP_EXT, 50, False)
+    assert not check(path, exts.WEBP_EXT, 100, False)
+
+
+def test_lossless_webp_and_png_pass_through(tmp_path):
+    webp = tmp_path / "a.webp"
+    png = tmp_path / "a.png"
+    make_image().save(webp, lossless=True)
+    make_image().save(png)
+    assert check(webp, exts.WEBP_EXT, 100, True)
+    assert not check(webp, exts.WEBP_EXT, 80, False)
+    assert check(png, exts.PNG_EXT, 100, True)
+    assert not check(png, exts.WEBP_EXT, 100, True)
+
+
+def test_transparent_image_is_reencoded_when_filling(tmp_path):
+    path = tmp_path / "a.png"
+    make_image().convert("RGBA").save(path)
+    assert check(path, exts.PNG_EXT, 100, True)
+    assert not check(path, exts.PNG_EXT, 100, True, is_fill_color=True)
+
+
+def write_source(tmp_path):
+    source = tmp_path / "source.png"
+    make_image().save(source)
+    return str(source), source.read_bytes()
+
+
+def test_link_policy_creates_hardlink_and_copy_does_not(tmp_path):
+    source, _ = write_source(tmp_path)
+    linked = str(tmp_path / "linked.png")
+    copied = str(tmp_path / "copied.png")
+    assert copy_file(source, linked, PASSTHROUGH_LINK) == METHOD_HARDLINK
+    assert os.path.samefile(source, linked)
+    assert os.stat(source).st_nlink == 2
+    assert copy_file(source, copied, PASSTHROUGH_COPY) != METHOD_HARDLINK
+    assert not os.path.samefile(source, copied)
+    assert sorted(os.listdir(tmp_path)) == ["copied.png", "linked.png", "source.png"]
+
+
+def test_overwriting_hardlinked_output_keeps_source(tmp_path):
+    source, data = write_source(tmp_path)
+    output = str(tmp_path / "output.png")
+    other = tmp_path / "other.png"
+    Image.new("RGB", (8, 8)).save(other)
+    copy_file(source, output, PASSTHROUGH_LINK)
+    # 既に同じファイルのハードリンクの場合も一時ファイルを残さない
+    copy_file(source, output, PASSTHROUGH_LINK)
+    assert os.path.samefile(source, output)
+    # ハードリンクの出力先を別の内容で置き換えても、入力ファイルは書き換わらない
+    copy_file(str(other), output, PASSTHROUGH_COPY)
+    assert open(source, "rb").read() == data
+    copy_file(source, output, PASSTHROUGH_LINK)
+    save_with_metadata(Image.new("RGB", (8, 8)), output, exts.PNG_EXT, 100, {}, True)
+    assert open(source, "rb").read() == data
+    assert not os.path.samefile(source, output)
+    assert sorted(os.listdir(tmp_path)) == ["other.png", "output.png", "source.png"]
+
+
+def test_replace_output_removes_temp_file_on_error(tmp_path):
+    source, data = write_source(tmp_path)
+    with pytest.raises(OSError):
+        with replace_output(source) as temp_path:
+            with open(temp_path, "wb") as f:
+                f.write(b"partial")
+            raise OSError("write failed")
+    assert os.listdir(tmp_path) == ["source.png"]
+    assert open(source, "rb").read() == data
+
+
+def test_legacy_metadata_needs_normalization():
+    assert needs_metadata_normalization({"parameters": "1girl\nNAI: {'Software': 'NovelAI'}"})
+    assert not needs_metadata_normalization({"parameters": 'ComfyUI: {"v":1,"d":{}}'})
+    assert not needs_metadata_normalization({"parameters": "1girl\nSteps: 20"})
@@ -0,0 +1,50 @@
+import os
+
+from PIL import Image, PngImagePlugin
+
+from image_converter.prompt_index import PromptIndex
+
+
+def save_webui_png(path, prompt):
+    info = PngImagePlugin.PngInfo()
+    info.add_text("parameters", f"{prompt}\nNegative prompt: lowres\nSteps: 20, Seed: 1")
+    Image.new("RGB", (8, 8)).save(path, pnginfo=info)
+    return str(path)
+
+
+def list_images(folder, is_subfolders):
+    for dirpath, dirnames, filenames in os.walk(folder):
+        for filename in sorted(filenames):
+            yield os.path.join(dirpath, filename)
+        if not is_subfolders:
+            break
+
+
+def test_update_without_subfolders_keeps_subfolder_rows(tmp_path):
+    (tmp_path / "sub").mkdir()
+    save_webui_png(tmp_path / "a.png", "1girl, smile")
+    save_webui_png(tmp_path / "sub" / "b.png", "1boy, sky")
+    index = PromptIndex(str(tmp_path / "prompts.db"))
+    try:
+        assert index.update(list_images(tmp_path, True), str(tmp_path), 1)["added"] == 2
+        stats = index.update(list_images(tmp_path, False), str(tmp_path), 1, is_subfolders=False)
+        assert stats["removed"] == 0
+        os.remove(tmp_path / "a.png")
+        stats = index.update(list_images(tmp_path, False), str(tmp_path), 1, is_subfolders=False)
+        assert stats["removed"] == 1
+        assert [row["path"] for row in index.search("sky")] == [str(tmp_path / "sub" / "b.png")]
+    finally:
+        index.close()
+
+
+def test_search_accepts_comma_separated_tags(tmp_path):
+    save_webui_png(tmp_path / "a.png", "1girl, blue sky, smile")
+    save_webui_png(tmp_path / "b.png", "1girl, smile")
+    index = PromptIndex(str(tmp_path / "prompts.db"))
+    try:
+        index.update([str(tmp_path / "a.png"), str(tmp_path / "b.png")], None, 1)
+        assert [row["path"] for row in index.search("smile, blue sky")] == [str(tmp_path / "a.png")]
+        assert len(index.search("1girl AND smile")) == 2
+        assert index.search(",") == []
+    finally:
+        index.close()
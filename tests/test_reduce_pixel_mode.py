@@ -0,0 +1,50 @@
+import random
+
+from PIL import Image
+
+import image_converter.exts as exts
+from image_converter.worker import reduce_pixel_mode
+
+
+def make_palette_image(mode, colors, size=(64, 64), alpha=None):
+    """
+    colors色のみを使った画像を作成する(alphaを指定した場合はアルファチャンネルを全てその値にする)
+    """
+    rng = random.Random(0)
+    palette = []
+    while len(palette) < colors:
+        color = tuple(rng.randrange(256) for _ in range(3))
+        if mode == "RGBA":
+            color += (rng.randrange(256) if alpha is None else alpha,)
+        if color not in palette:
+            palette.append(color)
+    image = Image.new(mode, size)
+    image.putdata([palette[index % colors] for index in range(size[0] * size[1])])
+    return image
+
+
+def test_rgba_with_few_colors_round_trips_exactly():
+    # 半透明で色数が256色以下の場合も、RGBの値を変えない
+    for alpha in (128, None):
+        image = make_palette_image("RGBA", 200, alpha=alpha)
+        reduced = reduce_pixel_mode(image, exts.PNG_EXT, True)
+        assert reduced.convert("RGBA").tobytes() == image.tobytes()
+
+
+def test_rgb_with_few_colors_becomes_palette():
+    image = make_palette_image("RGB", 200)
+    reduced = reduce_pixel_mode(image, exts.PNG_EXT, True)
+    assert reduced.mode == "P"
+    assert reduced.convert("RGB").tobytes() == image.tobytes()
+
+
+def test_opaque_rgba_drops_alpha():
+    image = make_palette_image("RGBA", 300, alpha=255)
+    reduced = reduce_pixel_mode(image, exts.WEBP_EXT, True)
+    assert reduced.mode == "RGB"
+    assert reduced.convert("RGBA").tobytes() == image.tobytes()
+
+
+def test_lossy_output_is_unchanged():
+    image = make_palette_image("RGBA", 200)
+    assert reduce_pixel_mode(image, exts.WEBP_EXT, False) is image